@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Find caches of product type dict stored next to binary json of types (see ProductTypeDict._ensure_find_caches()).
+Caches file is bound to checksums of types file, terms dawg, context dependent terms definitions and to min meaningful
+type capacity.
+
+File layout (little-endian):
+    header: magic, format version, types file checksum, dawg checksum, context definitions checksum,
+            min meaningful type capacity, number of types
+    sections, each prefixed with uint32 byte length:
+        dawg bytes: cache key => uint32[] type indexes
+        uint32[types + 1] type term offsets, uint32[] type term ids
+"""
+from __future__ import print_function, unicode_literals
+import mmap
+import os
+import struct
+
+import dawg
+
+from ok.dicts.term_snapshot import csr, uint32_array
+
+FIND_CACHES_MAGIC = b'OKFC'
+FIND_CACHES_VERSION = 1
+
+_HEADER = struct.Struct(str('<4sIIIIII'))
+_SECTION_LEN = struct.Struct(str('<I'))
+_UINT32 = struct.Struct(str('<I'))
+
+_SECTIONS = ('dawg', 'type_term_offsets', 'type_term_ids')
+
+# Prefixes of keys of main form cache and similarity groups cache in dawg
+_MAIN_FORM_PREFIX = 'm'
+_SIMILARITY_PREFIX = 's'
+
+
+class FindCachesSnapshotException(Exception):
+    pass
+
+
+def _main_form_key_str(key):
+    """@param frozenset[int] key: main form term ids"""
+    return _MAIN_FORM_PREFIX + '.'.join(map(unicode, sorted(key)))
+
+
+def _similarity_key_str(key):
+    """@param frozenset[unicode] key: first chars of terms"""
+    return _SIMILARITY_PREFIX + ''.join(sorted(key))
+
+
+def write_find_caches(filename, checksums, main_form_cache, similarity_groups_cache):
+    """
+    Write find caches file
+    @param unicode filename: find caches file name
+    @param tuple[int] checksums: types file checksum, dawg checksum, context definitions checksum, min meaningful
+                type capacity
+    @param dict of (frozenset[int], set[ProductType]) main_form_cache: main form key => types
+    @param dict of (frozenset[unicode], set[ProductType]) similarity_groups_cache: similarity group key => types
+    """
+    type_indexes = {}
+    types = []
+    items = []
+    for cache, key_str in ((main_form_cache, _main_form_key_str), (similarity_groups_cache, _similarity_key_str)):
+        for key, cache_types in cache.viewitems():
+            if not cache_types:
+                continue
+            indexes = []
+            for p_type in cache_types:
+                idx = type_indexes.get(p_type)
+                if idx is None:
+                    idx = type_indexes[p_type] = len(types)
+                    types.append(p_type.get_terms_ids())
+                indexes.append(idx)
+            items.append((key_str(key), uint32_array(sorted(indexes))))
+
+    type_term_offsets, type_term_ids = csr(types)
+    sections = (
+        dawg.BytesDAWG(items).tobytes(),
+        uint32_array(type_term_offsets),
+        uint32_array(type_term_ids),
+    )
+    # Caches may be saved by many processes at once. Each one writes to its own temp file
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        f.write(_HEADER.pack(FIND_CACHES_MAGIC, FIND_CACHES_VERSION, *(tuple(checksums) + (len(types),))))
+        for section in sections:
+            f.write(_SECTION_LEN.pack(len(section)))
+            f.write(section)
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+
+
+class FindCachesSnapshot(object):
+    """
+    Read-only access to find caches file. File is memory mapped, types are made on first access by key.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._mm = None
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                raise FindCachesSnapshotException("Find caches file is too short: %s" % filename)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header = _HEADER.unpack_from(self._mm, 0)
+            magic, version = header[:2]
+            if magic != FIND_CACHES_MAGIC or version != FIND_CACHES_VERSION:
+                raise FindCachesSnapshotException("Unsupported find caches file format: %s" % filename)
+            self.checksums = header[2:6]
+            self.types_count = header[6]
+
+            self._sections = {}
+            pos = _HEADER.size
+            for name in _SECTIONS:
+                size, = _SECTION_LEN.unpack_from(self._mm, pos)
+                pos += _SECTION_LEN.size
+                if pos + size > len(self._mm):
+                    raise FindCachesSnapshotException("Find caches file is truncated: %s" % filename)
+                self._sections[name] = (pos, size)
+                pos += size
+
+            start, size = self._sections['dawg']
+            self._dawg = dawg.BytesDAWG().frombytes(self._mm[start:start + size])
+        except (struct.error, FindCachesSnapshotException):
+            self.close()
+            raise
+
+        self._types = {}
+        """@type: dict of (int, ProductType)"""
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _uint32(self, section, idx):
+        return _UINT32.unpack_from(self._mm, self._sections[section][0] + 4 * idx)[0]
+
+    def type_term_ids(self, idx):
+        """@rtype: list[int]"""
+        start = self._uint32('type_term_offsets', idx)
+        end = self._uint32('type_term_offsets', idx + 1)
+        return list(struct.unpack_from(str('<%dI') % (end - start), self._mm,
+                                       self._sections['type_term_ids'][0] + 4 * start))
+
+    def type_indexes(self, key_str):
+        """@rtype: list[int]|None"""
+        values = self._dawg.get(key_str)
+        if not values:
+            return None
+        return list(struct.unpack(str('<%dI') % (len(values[0]) // 4), values[0]))
+
+    def main_form_cache(self, make_type):
+        """
+        @param (list[int])->ProductType make_type: make type from term ids
+        @rtype: FindCache
+        """
+        return FindCache(self, _main_form_key_str, make_type)
+
+    def similarity_groups_cache(self, make_type):
+        """
+        @param (list[int])->ProductType make_type: make type from term ids
+        @rtype: FindCache
+        """
+        return FindCache(self, _similarity_key_str, make_type)
+
+    def get_type(self, idx, make_type):
+        p_type = self._types.get(idx)
+        if p_type is None:
+            p_type = self._types[idx] = make_type(self.type_term_ids(idx))
+        return p_type
+
+
+class FindCache(object):
+    """
+    Read-only view of one of caches in find caches file. It has get() like dict of key => set of types
+    """
+
+    def __init__(self, snapshot, key_str, make_type):
+        """
+        @param FindCachesSnapshot snapshot: find caches file
+        @param (frozenset)->unicode key_str: cache key to dawg key
+        @param (list[int])->ProductType make_type: make type from term ids
+        """
+        self._snapshot = snapshot
+        self._key_str = key_str
+        self._make_type = make_type
+
+    def get(self, key, default=None):
+        """
+        @rtype: set[ProductType]
+        @return: new set of types every time. It can be changed by caller
+        """
+        indexes = self._snapshot.type_indexes(self._key_str(key))
+        if indexes is None:
+            return default
+        return {self._snapshot.get_type(idx, self._make_type) for idx in indexes}
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Manifest of baseline data files: size, mtime and content hashes of files in data directory. It is a cache only
+"""
+from __future__ import print_function, unicode_literals
+import json
+import os
+import threading
+
+MANIFEST_FILENAME = '.ok_manifest.json'
+
+
+class BaselineManifest(object):
+
+    def __init__(self, dirname):
+        self.filename = os.path.join(dirname, MANIFEST_FILENAME)
+        self.__lock = threading.RLock()
+        self.__entries = None
+        """@type: dict of (unicode, dict)"""
+
+    def __load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                entries = json.loads(f.read().decode('utf-8'))
+            if not isinstance(entries, dict):
+                entries = {}
+        except (IOError, ValueError):
+            entries = {}
+        self.__entries = entries
+        return entries
+
+    def __save(self):
+        tmp_filename = '%s.%d.tmp' % (self.filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as f:
+                f.write(json.dumps(self.__entries, ensure_ascii=True, sort_keys=True, indent=1).encode('utf-8'))
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError):
+            # Read-only data dir. Hashes are kept in memory for this process only
+            pass
+
+    @staticmethod
+    def __is_valid(entry, stat):
+        return isinstance(entry, dict) and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime
+
+    def file_hash(self, filename, hash_name, hash_func):
+        """
+        Get content hash of file from manifest or calculate it and save to manifest
+        @param unicode filename: file in manifest directory
+        @param unicode hash_name: name of hash (i.e. hash algorithm)
+        @param (unicode)->int hash_func: calculate hash of file by file name
+        @rtype: int
+        """
+        key = os.path.basename(filename)
+        with self.__lock:
+            stat = os.stat(filename)
+            entries = self.__entries if self.__entries is not None else self.__load()
+            entry = entries.get(key)
+            if not self.__is_valid(entry, stat) or hash_name not in entry['hashes']:
+                # Manifest could be updated by another process
+                entry = self.__load().get(key)
+            if self.__is_valid(entry, stat) and hash_name in entry['hashes']:
+                return entry['hashes'][hash_name]
+
+            value = hash_func(filename)
+            if os.stat(filename).st_mtime != stat.st_mtime:
+                # File has been changed during hash calculation. Do not trust it
+                return value
+            if not self.__is_valid(entry, stat):
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hashes': {}}
+            entry['hashes'][hash_name] = value
+            self.__entries[key] = entry
+            self.__save()
+            return value
+
+
+_manifests = {}
+"""@type: dict of (unicode, BaselineManifest)"""
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(dirname):
+    """@rtype: BaselineManifest"""
+    dirname = os.path.abspath(dirname)
+    with _manifests_lock:
+        manifest = _manifests.get(dirname)
+        if manifest is None:
+            manifest = _manifests[dirname] = BaselineManifest(dirname)
+    return manifest
+
+
+def cached_file_hash(filename, hash_name, hash_func):
+    """
+    Content hash of file cached in manifest of file directory. See BaselineManifest.file_hash()
+    @rtype: int
+    """
+    return get_manifest(os.path.dirname(os.path.abspath(filename))).file_hash(filename, hash_name, hash_func)
@@ -3,7 +3,7 @@ from __future__ import print_function, unicode_literals
 from collections import namedtuple
 from ok.utils import to_str
 
-from ok.dicts.term import TypeTerm, TermContext
+from ok.dicts.term import TypeTerm, TermContext, ContextDependentTypeTerm, main_form_ids
 
 # identical relation is special relation type that is used in runtime type matching only and is not present in regular
 # types dict. It is used to distinguish really the same types and types are 'same-same' i.e. equals (comparing their
@@ -38,7 +38,8 @@ class ProductType(tuple):
         def back_relation(self):
             return self._back_relation
 
-    __slot__ = ('_relations, __relations_cache', '_meaningful', '__same_same_hash_cache', '_singleton')
+    __slot__ = ('_relations, __relations_cache', '_meaningful', '__same_same_hash_cache', '_singleton',
+                '__term_context', '__main_form_term_ids_cache')
 
     # ProductType instances acts as singleton. All instances are kept here
     __v = set()
@@ -71,7 +72,8 @@ class ProductType(tuple):
                 'Unknown ProductType option: %s' % ', '.join(kwargs.keys())
 
             # tuple.__init__(self, args)
-            self.term_context = TermContext(self)
+            self.__term_context = None
+            self.__main_form_term_ids_cache = None
 
             self._singleton = singleton
             if self._singleton:
@@ -81,6 +83,16 @@ class ProductType(tuple):
     def singleton(self):
         return self._singleton
 
+    @property
+    def term_context(self):
+        """
+        Context of type terms. It is created on first request, i.e. only for types with context dependent terms
+        @rtype: TermContext
+        """
+        if self.__term_context is None:
+            self.__term_context = TermContext(self)
+        return self.__term_context
+
     @classmethod
     def make_from_terms(cls, terms, meaningful=False):
         """@param list[TypeTerm] terms: list of TypeTerms"""
@@ -231,6 +243,7 @@ class ProductType(tuple):
     def brake_relations(self):
         copy_relations = self._relations.keys()[:]
         self._relations.clear()
+        self.__relations_cache = None
         for r_type2 in copy_relations:
             r_type2.not_related(self)
 
@@ -255,11 +268,26 @@ class ProductType(tuple):
         return b' + '.join(repr(term) for term in iter(self))
 
     def get_terms_ids(self):
-        return tuple(super(ProductType, self).__iter__())
+        """@rtype: tuple[int]"""
+        return tuple.__getslice__(self, 0, len(self))
 
     def get_main_form_term_ids(self):
-        return [TypeTerm.get_by_id(term_id).get_main_form(context=self.term_context).term_id
-                for term_id in self.get_terms_ids()]
+        """
+        Main form term ids are cached while term dict and context dependent terms definitions are the same
+        @rtype: array.array
+        """
+        state = (TypeTerm.term_dict, ContextDependentTypeTerm.ctx_dependent_terms.version)
+        cached = self.__main_form_term_ids_cache
+        if cached is not None and cached[0] is state[0] and cached[1] == state[1]:
+            return cached[2]
+        terms = map(TypeTerm.get_by_id, self.get_terms_ids())
+        if any(term.is_context_required() for term in terms):
+            self.term_context.resolve_all()
+            main_form_term_ids = main_form_ids(terms, self.term_context)
+        else:
+            main_form_term_ids = main_form_ids(terms)
+        self.__main_form_term_ids_cache = state + (main_form_term_ids,)
+        return main_form_term_ids
 
     @staticmethod
     def calculate_same_same_hash(terms):
@@ -278,9 +306,7 @@ class ProductType(tuple):
             if term is None:
                 raise Exception("No such term in dict with term_id: %d" % term_item)
             type_terms.append(term)
-        term_context = TermContext.ensure_context(type_terms)
-        hash_terms = [term.get_main_form(context=term_context).term_id for term in type_terms]
-        return frozenset(hash_terms).__hash__()
+        return frozenset(main_form_ids(type_terms)).__hash__()
 
     def get_same_same_hash(self):
         """
@@ -2,10 +2,11 @@
 from __future__ import print_function, unicode_literals
 
 from ast import literal_eval
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
 import csv
 import itertools
 import json
+import os
 import re
 
 import Levenshtein
@@ -13,17 +14,92 @@ import gc
 from jsmin import jsmin
 import ujson
 
-from ok.utils import to_str
+from ok.utils import to_str, checksum
+from ok.dicts.find_caches_snapshot import FindCachesSnapshot, FindCachesSnapshotException, write_find_caches
 from ok.dicts.product import Product
 from ok.dicts.product_type import ProductType,\
     TYPE_TUPLE_RELATION_CONTAINS, TYPE_TUPLE_RELATION_EQUALS, TYPE_TUPLE_RELATION_SUBSET_OF, EqWrapper, \
     TYPE_TUPLE_RELATION_SIMILAR, TYPE_TUPLE_RELATION_ALMOST
 from ok.dicts.term import TypeTerm, CompoundTypeTerm, WithPropositionTypeTerm, TagTypeTerm, TypeTermException, \
-    ContextRequiredTypeTermException, ContextDependentTypeTerm, load_term_dict, TermContext
+    ContextRequiredTypeTermException, ContextDependentTypeTerm, load_term_dict, TermContext, main_form_ids, \
+    term_compatibility
 
 TYPE_TUPLE_MIN_CAPACITY = 2  # Number of SQNs covered by word combination
 
 
+class SimilarTypesIndex(object):
+    """
+    Groups of types with candidates for ProductTypeDict.find_similar_relation(). Similarity of types is
+    Levenshtein.setratio() of their terms (mean ratio of paired terms) or Levenshtein.ratio() of their strings. Ratio
+    of strings is limited by their lengths: ratio(s1, s2) <= 1 - abs(len(s1) - len(s2)) / (len(s1) + len(s2)).
+    Pairs which cannot reach required similarity by these limits are not proposed, and similarity of others is
+    calculated from strings of types cached in index, thus, relations are checked for plausible candidates only.
+    """
+
+    def __init__(self, max_similarity=0.85):
+        self.max_similarity = max_similarity
+        self._groups = defaultdict(list)
+        """@type: dict of (object, list[(ProductType, tuple)])"""
+        self._group_keys = dict()
+        """@type: dict of (ProductType, object)"""
+
+    def __contains__(self, p_type):
+        return p_type in self._group_keys
+
+    def clear(self):
+        self._groups.clear()
+        self._group_keys.clear()
+
+    @staticmethod
+    def _signature(p_type):
+        terms = list(p_type)
+        terms_len = sum(map(len, terms))
+        type_str = p_type.as_string() if len(terms) > 1 else None
+        return terms, terms_len, max(map(len, terms)), type_str
+
+    def _is_similar(self, sig1, sig2):
+        terms1, terms_len1, max_term_len1, type_str1 = sig1
+        terms2, terms_len2, max_term_len2, type_str2 = sig2
+        # Small epsilon guards limits from rounding errors of similarity calculation
+        min_similarity = self.max_similarity - 1e-9
+        # Length difference of paired terms is not less than difference of all terms together, and length of each
+        # pair is not more than sum of the longest terms
+        terms_limit = 1 - float(abs(terms_len1 - terms_len2)) / (len(terms1) * (max_term_len1 + max_term_len2))
+        if terms_limit >= min_similarity and Levenshtein.setratio(terms1, terms2) >= min_similarity:
+            return True
+        if type_str1 is not None:
+            type_len1, type_len2 = len(type_str1), len(type_str2)
+            type_limit = 2.0 * min(type_len1, type_len2) / (type_len1 + type_len2)
+            if type_limit >= min_similarity and Levenshtein.ratio(type_str1, type_str2) >= min_similarity:
+                return True
+        return False
+
+    def add(self, group_key, p_type, find_similar=True):
+        """
+        Add type to group and return types of group added before which are similar to it. All types of group must
+        have the same number of terms
+        @param object group_key: key of group
+        @param ProductType p_type: type
+        @param bool find_similar: if False, type is added only
+        @rtype: list[ProductType]
+        """
+        group = self._groups[group_key]
+        sig = self._signature(p_type)
+        similar = [sibling for sibling, sibling_sig in group if self._is_similar(sig, sibling_sig)] if find_similar \
+            else []
+        group.append((p_type, sig))
+        self._group_keys[p_type] = group_key
+        return similar
+
+    def remove(self, p_type):
+        group_key = self._group_keys.pop(p_type, None)
+        if group_key is not None:
+            group = self._groups[group_key]
+            group[:] = [item for item in group if item[0] is not p_type]
+            if not group:
+                del self._groups[group_key]
+
+
 class ProductTypeDict(object):
     """
     @type _root_types: list[ProductType]
@@ -33,6 +109,9 @@ class ProductTypeDict(object):
     # Build type tuples operation may be long. This may help to check progress
     VERBOSE = False
 
+    # Number of products sqns parsed to terms by single TypeTerm.parse_term_strings() call
+    PARSE_CHUNK_SIZE = 1000
+
     def __init__(self):
         # ProductTypes are not contained in other types. These are actual roots of classified types
         # as well as remaining unclassified types with unknown relations
@@ -48,6 +127,15 @@ class ProductTypeDict(object):
         # This is a cache of TypeTerms used in ProductTypes from _type_tuples
         # It MUST be dropped always when _type_tuples is changed
         self._term_set = None
+        # Index of types which may be related to new types in update_with_products(): same-same hash of each terms
+        # variant => types and types grouped for similarity check. Tag types are not indexed.
+        # It is lazily built and have to be drop if _type_tuples are rebuilt
+        self._relations_index = None
+        """@type: (dict of (int, set[ProductType]), SimilarTypesIndex)|None"""
+        # Find caches file of types loaded from binary json and checksum of types file (see _ensure_find_caches()).
+        # It MUST be dropped always when _type_tuples is changed
+        self._find_caches_file = None
+        """@type: (unicode, int)|None"""
 
         self._min_meaningful_type_capacity = TYPE_TUPLE_MIN_CAPACITY
 
@@ -62,7 +150,7 @@ class ProductTypeDict(object):
             self._meaningful_type_tuples = None
 
     @staticmethod
-    def collect_sqn_type_tuples(sqn, with_spellings=True, context=None):
+    def collect_sqn_type_tuples(sqn, with_spellings=True, context=None, term_ids=None, types_cache=None):
         """
         Return dict with tuples for combinations of tokens in each parsed sqn. Source sqn will be as value.
         Join propositions to next word to treat them as single token
@@ -70,11 +158,17 @@ class ProductTypeDict(object):
         It is required to estimate "capacity" of tuple
         @param bool with_spellings: if True above combinations of words also produce combinations with different
             word spellings like morph.normal_form, synonyms etc
+        @param collections.Sequence[int]|None term_ids: sqn already parsed by TypeTerm.parse_term_strings()
+        @param dict of (tuple[int], ProductType|None)|None types_cache: product types made from term ids. Types do not
+            depend on sqn, thus, cache can be shared by calls while terms and types are not reloaded
         @rtype: dict of (ProductType, unicode)
         """
         result = {}
 
-        terms = TypeTerm.parse_term_string(sqn)
+        if term_ids is not None:
+            terms = map(TypeTerm.get_by_id, term_ids)
+        else:
+            terms = TypeTerm.parse_term_string(sqn)
         # NOTE: Parsed terms must go first in context as far as they have more priority in resolving of ambiguity
         context = TermContext.ensure_context(terms + (context or []))
         first_word = terms.pop(0)
@@ -98,15 +192,50 @@ class ProductTypeDict(object):
                 terms_cache[term] = term_list
             return term_list
 
+        # Main form state of term: None - depends on context, False - invalid, True - valid
+        main_form_valid_cache = {}
+        """@type: dict of (int, bool|None)"""
+
+        def is_main_form_valid(pt):
+            term_id = pt.term_id
+            if term_id in main_form_valid_cache:
+                return main_form_valid_cache[term_id]
+            valid = None
+            if not pt.is_context_required():
+                try:
+                    pt.get_main_form(context=None)
+                    valid = True
+                except TypeTermException:
+                    valid = False
+            main_form_valid_cache[term_id] = valid
+            return valid
+
+        def has_main_forms(pt_terms):
+            # Validate product type terms are can produce normal final type. Main form of context free term does not
+            # depend on other terms, so, it is validated once for all combinations
+            states = [is_main_form_valid(pt) for pt in pt_terms]
+            if False in states:
+                return False
+            if None in states:
+                try:
+                    main_form_ids(pt_terms)
+                except TypeTermException:
+                    # Something wrong with terms (context are not full?). Skip combination
+                    return False
+            return True
+
         def make_product_type(pt_terms):
+            key = tuple(pt.term_id for pt in pt_terms)
+            if types_cache is not None and key in types_cache:
+                return types_cache[key]
             pt_type = None
-            try:
-                # Validate product type terms are can produce normal final type
-                ProductType.calculate_same_same_hash(pt_terms)
-                pt_type = ProductType.make_from_terms(pt_terms)
-            except TypeTermException:
-                # Something wrong with terms (context are not full?). Skip combination
-                pass
+            if has_main_forms(pt_terms):
+                try:
+                    pt_type = ProductType.make_from_terms(pt_terms)
+                except TypeTermException:
+                    pass
+            if types_cache is not None:
+                types_cache[key] = pt_type
             return pt_type
 
         def add_result(pt_terms):
@@ -127,31 +256,32 @@ class ProductTypeDict(object):
                     if pt_type:
                         result[pt_type] = sqn
 
-        compatibility_cache = defaultdict(dict)
+        compatibility_cache = {}
+        """@type: dict of (tuple[int, int], bool)"""
 
         def are_terms_compatible(term1, term2, _context):
-            if term1 in compatibility_cache and term2 in compatibility_cache[term1]:
-                compatible = compatibility_cache[term1][term2]
-            else:
-                compatible = term1.is_compatible_with(term2, context=_context)
-                compatibility_cache[term1][term2] = compatible
+            # Terms can be paired if both of them are compatible with each other
+            key = (term1.term_id, term2.term_id)
+            compatible = compatibility_cache.get(key)
+            if compatible is None:
+                compatible = term_compatibility.are_compatible(term1, term2, context=_context)
+                compatibility_cache[key] = compatibility_cache[(key[1], key[0])] = compatible
             return compatible
 
         def add_combinations(_terms, n, _context):
-            vf = [[]]
-            vf[0] = get_term_with_sub_terms(first_word, _context)
-            for wvf in itertools.product(*vf):
-                for _w in itertools.combinations(_terms, n):
-                    v = [[]] * len(_w)
-                    for i, _wi in enumerate(_w):
-                        v[i] = get_term_with_sub_terms(_w[i], _context)
-                    for wv in itertools.product(*v):
-                        pt_terms = wvf + wv
-                        if any(not are_terms_compatible(w_pair[0], w_pair[1], _context) or
-                                       not are_terms_compatible(w_pair[1], w_pair[0], _context)
-                                for w_pair in itertools.permutations(pt_terms, 2) if w_pair[0] and w_pair[1]):
-                            # Do not join words that cannot be paired (like word and the same word with proposition)
-                            continue
+            first_variants = get_term_with_sub_terms(first_word, _context)
+            rest_variants = [[get_term_with_sub_terms(_wi, _context) for _wi in _w]
+                             for _w in itertools.combinations(_terms, n)]
+            for wvf in first_variants:
+                for variants in rest_variants:
+                    # Product of variants in the same order as itertools.product(). Do not join words that cannot
+                    # be paired (like word and the same word with proposition), so, incompatible prefix is
+                    # not expanded further
+                    candidates = [(wvf,)]
+                    for v in variants:
+                        candidates = [prefix + (wv,) for prefix in candidates for wv in v
+                                      if all(are_terms_compatible(pt, wv, _context) for pt in prefix)]
+                    for pt_terms in candidates:
                         add_result(pt_terms)
 
         if terms:
@@ -183,6 +313,10 @@ class ProductTypeDict(object):
 
     __similarity_groups_cache = None
 
+    # Find caches file which find caches are loaded from. It MUST be closed when caches are dropped
+    __find_caches_snapshot = None
+    """@type __find_caches_snapshot: FindCachesSnapshot"""
+
     @staticmethod
     def _similarity_hash_key(p_type):
         chars = []
@@ -195,37 +329,127 @@ class ProductTypeDict(object):
             chars.append(meaningful_word[0])
         return frozenset(chars)
 
+    def _main_form_keys(self, p_type):
+        """
+        @param ProductType p_type: product type
+        @return: main form keys of type. Non-final type has key for each variant of its main forms. None if type cannot
+                be cached at all
+        @rtype: list[frozenset]|None
+        """
+        try:
+            return [self._main_form_key(p_type)]
+        except ContextRequiredTypeTermException:
+            # Bad non-final type detected. What to do?
+            # TODO: ignore? or cache with all variants?
+            terms_matrix = []
+            try:
+                for term in p_type:
+                    if isinstance(term, ContextDependentTypeTerm):
+                        terms_matrix.append(term.all_context_main_forms())
+                    else:
+                        terms_matrix.append([term.get_main_form(p_type)])
+            except ContextRequiredTypeTermException:
+                # If this raises exception again, than so to be. Very bad type. Ignore
+                return None
+
+            return [self._main_form_key([term.term_id for term in term_variants])
+                    for term_variants in itertools.product(*terms_matrix)]
+        except Exception as e:
+            print("Failed to cache type: '%s'" % to_str(p_type))
+            raise
+
     def _ensure_find_caches(self):
+        """
+        Build find caches of meaningful types. If types are loaded from binary json and not changed since that, caches
+        are loaded from find caches file next to json (see find_caches_filename()) or saved to it after build
+        """
         if self.__main_form_cache is None or self.__similarity_groups_cache is None:
+            if self._find_caches_file is not None and self._load_find_caches():
+                return
             all_types = self.get_type_tuples(meaningful_only=True)
             self.__main_form_cache = defaultdict(set)
             """@type dict of (set, set[ProductType])"""
             self.__similarity_groups_cache = defaultdict(set)
             for p_type in all_types:
-                try:
-                    self.__main_form_cache[self._main_form_key(p_type)].add(p_type)
-                except ContextRequiredTypeTermException:
-                    # Bad non-final type detected. What to do?
-                    # TODO: ignore? or cache with all variants?
-                    terms_matrix = []
-                    try:
-                        for term in p_type:
-                            if isinstance(term, ContextDependentTypeTerm):
-                                terms_matrix.append(term.all_context_main_forms())
-                            else:
-                                terms_matrix.append([term.get_main_form(p_type)])
-                    except ContextRequiredTypeTermException:
-                        # If this raises exception again, than so to be. Very bad type. Ignore
-                        continue
+                self._add_to_find_caches(p_type)
+            if self._find_caches_file is not None:
+                self._save_find_caches()
 
-                    for term_variants in itertools.product(*terms_matrix):
-                        term_ids = [term.term_id for term in term_variants]
-                        self.__main_form_cache[self._main_form_key(term_ids)].add(p_type)
-                except Exception as e:
-                    print("Failed to cache type: '%s'" % to_str(p_type))
-                    raise
-
-                self.__similarity_groups_cache[self._similarity_hash_key(p_type)].add(p_type)
+    @staticmethod
+    def find_caches_filename(json_filename):
+        return '%s.find_caches' % os.path.splitext(json_filename)[0]
+
+    def _find_caches_checksums(self):
+        types_checksum = self._find_caches_file[1]
+        return (types_checksum, TypeTerm.term_dict.dawg_checksum(core_only=True),
+                ContextDependentTypeTerm.ctx_dependent_terms_checksum(), self.min_meaningful_type_capacity)
+
+    def _load_find_caches(self):
+        filename = self._find_caches_file[0]
+        if not os.path.isfile(filename):
+            return False
+        try:
+            snapshot = FindCachesSnapshot(filename)
+        except (IOError, FindCachesSnapshotException) as e:
+            if self.VERBOSE:
+                print("WARN: Find caches file is ignored: %s" % to_str(e))
+            return False
+        if snapshot.checksums != self._find_caches_checksums():
+            snapshot.close()
+            if self.VERBOSE:
+                print("WARN: Find caches file '%s' has been saved for different types or terms" % filename)
+            return False
+
+        def make_type(term_ids):
+            return ProductType.make_from_terms(map(TypeTerm.get_by_id, term_ids))
+        self._drop_find_caches()
+        self.__find_caches_snapshot = snapshot
+        self.__main_form_cache = snapshot.main_form_cache(make_type)
+        self.__similarity_groups_cache = snapshot.similarity_groups_cache(make_type)
+        if self.VERBOSE:
+            print("Loaded find caches of %d types from %s" % (snapshot.types_count, filename))
+        return True
+
+    def _save_find_caches(self):
+        filename = self._find_caches_file[0]
+        try:
+            write_find_caches(filename, self._find_caches_checksums(), self.__main_form_cache,
+                              self.__similarity_groups_cache)
+        except (IOError, OSError) as e:
+            # Read-only data dir. Caches are kept in memory for this process only
+            if self.VERBOSE:
+                print("WARN: Find caches cannot be saved: %s" % to_str(e))
+            return
+        if self.VERBOSE:
+            print("Saved find caches to %s" % filename)
+
+    def _drop_find_caches(self):
+        if self.__find_caches_snapshot is not None:
+            self.__find_caches_snapshot.close()
+            self.__find_caches_snapshot = None
+        self.__main_form_cache = None
+        self.__similarity_groups_cache = None
+
+    def _add_to_find_caches(self, p_type):
+        keys = self._main_form_keys(p_type)
+        if keys is None:
+            return
+        for key in keys:
+            self.__main_form_cache[key].add(p_type)
+        self.__similarity_groups_cache[self._similarity_hash_key(p_type)].add(p_type)
+
+    def _remove_from_find_caches(self, p_type):
+        keys = self._main_form_keys(p_type)
+        if keys is None:
+            return
+        for cache, cache_keys in ((self.__main_form_cache, keys),
+                                  (self.__similarity_groups_cache, [self._similarity_hash_key(p_type)])):
+            for key in cache_keys:
+                types = cache.get(key)
+                if types is not None:
+                    types.discard(p_type)
+                    if not types:
+                        del cache[key]
 
     # Not supported for a while. Deprecated
     def find_product_types(self, sqn, with_spellings=True, context=None):
@@ -262,7 +486,8 @@ class ProductTypeDict(object):
         """@type: dict of (ProductType, list[ProductType.Relation])"""
         for t in product_types:
             t_key = self._main_form_key(t)
-            types_exist = self.__main_form_cache.get(t_key, set())
+            # Copy, parsed types must not get to cache
+            types_exist = set(self.__main_form_cache.get(t_key, ()))
             for t_sibling in product_types:
                 # Check relations between parsed types as well even if they are not in types dict
                 if t_sibling != t and t_sibling not in types_exist and self._main_form_key(t_sibling) == t_key:
@@ -288,33 +513,64 @@ class ProductTypeDict(object):
         return result
 
     @staticmethod
-    def collect_type_tuples(products, strict_products=False):
+    def collect_type_tuples(products, strict_products=False, share_types_cache=True):
         """
         Collect product type tuples for all parsed products using @collect_sqn_type_tuples
         @param collections.Iterable[Product] products: sequence of Products
         @rtype: dict of (ProductType, list[unicode])
         @param bool strict_products: if True do not try to collect transformation of type spellings because they are
             considered as 100% correct types. It may happen when loading types form external knowledge bases
+        @param bool share_types_cache: if True types made from the same terms by different products are made once
         """
         result = defaultdict(list)
         """@type: dict of (ProductType, list[unicode])"""
         i_count = 0
+        types_cache = {} if share_types_cache else None
         if ProductTypeDict.VERBOSE:
             print(u'Collecting type tuples from products')
-        for product in products:
-            context = ProductTypeDict.get_product_tag_context(product)
-            product_tuples = ProductTypeDict.collect_sqn_type_tuples(product.sqn, with_spellings=not strict_products, context=context)
-
-            for type_tuple, sqn in product_tuples.viewitems():
-                result[type_tuple].append(sqn)
-
-            i_count += 1
-            if ProductTypeDict.VERBOSE and i_count % 100 == 0: print(u'.', end='')
+        products = iter(products)
+        while True:
+            chunk = list(itertools.islice(products, ProductTypeDict.PARSE_CHUNK_SIZE))
+            if not chunk:
+                break
+            chunk_term_ids = TypeTerm.parse_term_strings(product.sqn for product in chunk)
+            for product, term_ids in itertools.izip(chunk, chunk_term_ids):
+                context = ProductTypeDict.get_product_tag_context(product)
+                product_tuples = ProductTypeDict.collect_sqn_type_tuples(product.sqn, with_spellings=not strict_products,
+                                                                         context=context, term_ids=term_ids,
+                                                                         types_cache=types_cache)
+
+                for type_tuple, sqn in product_tuples.viewitems():
+                    result[type_tuple].append(sqn)
+
+                i_count += 1
+                if ProductTypeDict.VERBOSE and i_count % 100 == 0: print(u'.', end='')
         if ProductTypeDict.VERBOSE:
             print()
             print(u"Collected %d type tuples" % len(result))
         return result
 
+    @staticmethod
+    def prefetch_word_normal_forms(products, processes=None):
+        """
+        Calculate normal forms of all words of products which are not terms yet. See get_word_normal_forms_batch()
+        @param list[Product] products: products
+        @param int|None processes: number of worker processes
+        @rtype: dict of (unicode, ok.dicts.russian.WordMorphology)
+        """
+        import ok.query as query
+        from ok.dicts.russian import get_word_normal_forms_batch
+        words = set()
+        for product in products:
+            for token in query.parse_query(product.sqn).tokens:
+                words.add(token)
+                if u'-' in token:
+                    words.update(token.split(u'-'))
+        words = [w for w in words if w and TypeTerm.term_dict.find_id_by_unicode(w) is None]
+        if ProductTypeDict.VERBOSE:
+            print(u'Calculate normal forms of %d new words' % len(words))
+        return get_word_normal_forms_batch(words, processes=processes)
+
     def filter_meaningful_types(self, types_iter, type_tuples=None):
         """
         Take iterator and return filtered iterator without types to be ignored for processing
@@ -386,13 +642,40 @@ class ProductTypeDict(object):
                 relation = p_type1.similar(p_type2, round(similarity, 2), dont_change=dont_change)
         return relation
 
-    def update_type_tuples_relationship(self, type_tuples):
+    @staticmethod
+    def _variant_same_same_hash(variant, variant_hashes):
+        """
+        @param tuple[int] variant: combination of type term ids
+        @param dict of (tuple[int], int|None) variant_hashes: hashes of variants calculated before. Updated by new ones
+        @return: same-same hash of variant or None if combination cannot be finalized
+        @rtype: int|None
+        """
+        if variant in variant_hashes:
+            v_hash_key = variant_hashes[variant]
+        else:
+            try:
+                v_hash_key = ProductType.calculate_same_same_hash(variant)
+            except ContextRequiredTypeTermException:
+                v_hash_key = None
+            variant_hashes[variant] = v_hash_key
+        return v_hash_key
+
+    @staticmethod
+    def _similar_group_key(p_type):
+        # Group types with the same length and terms with the same first char only
+        # TODO: optimize selection of group - actually first chars may have similar spellings as well (like е and ё)
+        return len(p_type), frozenset({_term[0] if not isinstance(_term, WithPropositionTypeTerm)
+                                       else _term.sub_terms[0][0] for _term in p_type})
+
+    def update_type_tuples_relationship(self, type_tuples, similar_index=None):
         """
         Calculate all non-repeatable combinations of type tuples with capacity not less than MIN_TUPLE_CAPACITY
         and check if one tuple is equals or contains (in terms of sqn set) another.
         NOTE: If type_tuples is big (10+K types) or/and TYPE_TUPLE_MIN_CAPACITY is too low (3 or less) this operation
         can work WAY TOO LONG. Be careful.
         @param dict of (ProductType, list[unicode]) type_tuples: from collect_type_tuples()
+        @param SimilarTypesIndex|None similar_index: types grouped by _similar_group_key(). If given, types are compared
+                with similar types of index and added to it. By default, types are compared with each other only
         """
 
         if self.VERBOSE:
@@ -403,7 +686,10 @@ class ProductTypeDict(object):
         if self._type_tuples:
             for t in self._type_tuples:
                 seen_type_tuples[t.get_same_same_hash()].add(t)
-        same_length_group = defaultdict(list)
+        # Same-same hashes of term combinations met in many types. None if combination cannot be finalized
+        variant_hashes = {}
+        """@type: dict of (tuple[int], int|None)"""
+        same_length_group = similar_index if similar_index is not None else SimilarTypesIndex()
         last_group_length = 0
         i_count = 0
         relations_created = 0
@@ -412,9 +698,8 @@ class ProductTypeDict(object):
             main_form_terms_set = set(t.get_main_form_term_ids())
             for i in range(len(t)):
                 for variant in itertools.combinations(terms, i+1):
-                    try:
-                        v_hash_key = ProductType.calculate_same_same_hash(variant)
-                    except ContextRequiredTypeTermException:
+                    v_hash_key = self._variant_same_same_hash(variant, variant_hashes)
+                    if v_hash_key is None:
                         # Cannot finalize this term set. Ignore
                         continue
                     # Contains & Equals - transitive
@@ -445,17 +730,14 @@ class ProductTypeDict(object):
                                     relations_created += 1
                             if r: relations_created += 1
 
-            if last_group_length != len(t):
+            if similar_index is None and last_group_length != len(t):
                 last_group_length = len(t)
                 same_length_group.clear()
 
-            # Group terms with the same first char only
-            # TODO: optimize selection of group - actually first chars may have similar spellings as well (like е and ё)
-            similarity_hash_key = frozenset({_term[0] if not isinstance(_term, WithPropositionTypeTerm) else _term.sub_terms[0][0] for _term in t})
-            for sibling in same_length_group.get(similarity_hash_key, []):
-                r = self.find_similar_relation(t, sibling)
-                if r: relations_created += 1
-            same_length_group[similarity_hash_key].append(t)
+            if t not in same_length_group:
+                for sibling in same_length_group.add(self._similar_group_key(t), t):
+                    r = self.find_similar_relation(t, sibling, same_length_group.max_similarity)
+                    if r: relations_created += 1
 
             seen_type_tuples[t.get_same_same_hash()].add(t)
 
@@ -466,68 +748,6 @@ class ProductTypeDict(object):
         if self.VERBOSE: print("Created %d relations" % relations_created)
         pass
 
-    # DEPRECATED
-    def find_type_tuples_relationship(self, type_tuples, baseline_dict=None, ignore_sqns=False, force_deep_scan=False, max_similarity=0.8):
-        """
-        Calculate all non-repeatable combinations of type tuples with capacity not less than MIN_TUPLE_CAPACITY
-        and check if one tuple is equals or contains (in terms of sqn set) another.
-        NOTE: If type_tuples is big (10+K types) or/and TYPE_TUPLE_MIN_CAPACITY is too low (3 or less) this operation
-        can work WAY TOO LONG. Be careful.
-        @param dict of (ProductType, list[unicode]) type_tuples: from collect_type_tuples()
-        @param dict of (ProductType, list[unicode]) baseline_dict: If specified try to find relations between type_tuples
-                and some external dict data. If not specified - local existing meaningful dictionary data will be used.
-                Using external dict data is useful for checking of some theories about not-persistent (virtual) data
-        @param bool ignore_sqns: if True do not try to compare sqn data sets but check type tuples only
-        @param bool force_deep_scan: if True scan for similarity all non-identical types even if identical has been found.
-        @return: dict of ProductType mapped to suggested Relations linked to meaningful types in types dict.
-                Relation instances are not in types actually and should be used for analysis or must be merged later
-                if required to types data
-        """
-
-        # if self.VERBOSE:
-        #     print u'Find type tuples relationships: %s' % (u', '.join(map(unicode, type_tuples.keys())))
-
-        i_count = 0
-        types_suggested_relations = defaultdict(list)
-        """@type: dict of (ProductType, list[ProductType.Relation])"""
-
-        type_tuples_for_deep_scan = dict(type_tuples)
-        dict_types = baseline_dict or self.get_type_tuples(meaningful_only=True)
-        if ignore_sqns:
-            # Optimize lookup data set - do not iterate for known types, just map as identical
-            for t in type_tuples:
-                if t in dict_types:
-                    # Must always find identical relation
-                    rel = self.compare_types(t, t)
-                    types_suggested_relations[t].append(rel)
-                    if force_deep_scan:
-                        del type_tuples_for_deep_scan[t]
-
-        if not force_deep_scan and types_suggested_relations:
-            # If identical types have been found deep scan is not required
-            type_tuples_for_deep_scan.clear()
-            # if self.VERBOSE: print "Identical type 's been found, skip deep scan"
-
-        for t1, t2 in itertools.product(type_tuples_for_deep_scan.viewitems(), dict_types.viewitems()):
-            type_input = t1[0]
-            """@type: ProductType"""
-            type_dict = t2[0]
-            """@type: ProductType"""
-
-            rel = self.compare_types(type_input, type_dict, max_similarity)
-
-            if rel:
-                types_suggested_relations[type_input].append(rel)
-
-            i_count += 1
-            if self.VERBOSE and i_count % 10000 == 0: print(u'.', end='')
-            if self.VERBOSE and i_count % 1000000 == 0: print(i_count)
-        if self.VERBOSE and i_count >= 10000:
-            print()
-            # print u'Suggested %d types' % len(types_suggested_relations)
-
-        return types_suggested_relations
-
     def build_tag_types_from_products(self, products, type_tuples):
         if self.VERBOSE:
             print(u"Building tag types from product's data")
@@ -604,12 +824,21 @@ class ProductTypeDict(object):
             print()
             print(u"Tag types created %d with %d relations" % (len(tags_created), len(new_relations)))
 
-    def build_from_products(self, products, strict_products=False):
+    def build_from_products(self, products, strict_products=False, processes=1):
         """
         Build types graph from sequence of products
         @param collections.Iterable[Product] products: iterator of Product
         @param bool strict_products: see comments for collect_type_tuples()
+        @param int|None processes: number of worker processes to calculate normal forms of new words (see
+            prefetch_word_normal_forms()). If None, number of cpus. By default, products are processed in current
+            process
         """
+        products = list(products)
+
+        if processes != 1:
+            # 0. Calculate normal forms of new words in parallel. Terms are created in this process from cached forms
+            self.prefetch_word_normal_forms(products, processes=processes)
+
         p_it1, p_it2 = itertools.tee(products)
 
         # 1. Collect all possible type variants. Those are already in dict as meaningful existing types
@@ -639,6 +868,185 @@ class ProductTypeDict(object):
 
         return self._type_tuples
 
+    def update_with_products(self, added=(), removed=(), strict_products=False):
+        """
+        Update types graph with products added to and removed from source of dict without full rebuild (see
+        build_from_products()). Types are collected for given products only. Relations are updated for new types and
+        already existing types which may be related to them (see _ensure_relations_index()). Removed types lose their
+        relations. Tag types relations depend on sqns of all types, hence, they are re-calculated if dict has tag types.
+        Meaningful types and find caches are updated for affected types only.
+        NOTE: removed product removes one occurrence of its sqn from its types. Its sqn is removed from its tag types if
+        there are no other products with the same sqn in dict
+        @param collections.Iterable[Product] added: new products
+        @param collections.Iterable[Product] removed: products which are not in source of dict anymore
+        @param bool strict_products: see comments for collect_type_tuples()
+        @return: types added to dict and types removed from dict
+        @rtype: (set[ProductType], set[ProductType])
+        """
+        added = list(added)
+        removed = list(removed)
+        self._find_caches_file = None
+        variants, similar_index = self._ensure_relations_index()
+        # Types which sqns or relations are changed. Meaningful flag and caches must be updated for them
+        affected_types = set()
+        """@type: set[ProductType]"""
+
+        # 1. Remove sqns of removed products. Types without sqns are removed with their relations
+        removed_types = set()
+        removed_type_tuples = self.collect_type_tuples(removed, strict_products=strict_products)
+        for t, sqns in removed_type_tuples.viewitems():
+            type_sqns = self._type_tuples.get(t)
+            if type_sqns is None:
+                continue
+            for sqn in sqns:
+                if sqn in type_sqns:
+                    type_sqns.remove(sqn)
+            affected_types.add(t)
+            affected_types.update(t.related_types())
+            if not type_sqns:
+                del self._type_tuples[t]
+                removed_types.add(t)
+                t.brake_relations()
+                self._remove_from_relations_index(t)
+        # Other products with the same sqn may remain in dict. Their tag types must keep sqn
+        remaining_sqns = {sqn for t, sqns in removed_type_tuples.viewitems() for sqn in sqns
+                          if sqn in self._type_tuples.get(t, ())}
+        removed = [product for product in removed if product.sqn not in remaining_sqns]
+
+        # 2. Find relations of new types. Only existing types with the same terms variant or in the same similarity
+        # group can be related to new types. Relations between those are calculated already and not changed
+        type_tuples = self.collect_type_tuples(added, strict_products=strict_products)
+        new_type_tuples = {t: sqns for t, sqns in type_tuples.viewitems() if t not in self._type_tuples}
+        relation_type_tuples = dict(new_type_tuples)
+        for t in new_type_tuples:
+            for f_type in variants.get(t.get_same_same_hash(), ()):
+                relation_type_tuples[f_type] = self._type_tuples[f_type]
+        self.update_type_tuples_relationship(relation_type_tuples, similar_index=similar_index)
+
+        # 3. Merge new sqns to existing types
+        variant_hashes = {}
+        for t, sqns in type_tuples.viewitems():
+            if t in new_type_tuples:
+                self._add_to_relations_index(t, variant_hashes)
+                affected_types.update(t.related_types())
+            self._type_tuples[t].extend(sqns)
+            affected_types.add(t)
+
+        # 4. Re-calculate tag types
+        new_types = set(new_type_tuples)
+        tag_types = [t for t in self._type_tuples if self._is_tag_type(t)]
+        if tag_types or any(product.get('tags') for product in added):
+            affected_types.update(self._rebuild_tag_types(tag_types, added, removed))
+            old_tag_types = set(tag_types)
+            new_types.update(t for t in self._type_tuples if self._is_tag_type(t) and t not in old_tag_types)
+            removed_types.update(t for t in old_tag_types if t not in self._type_tuples)
+
+        # 5. Update caches of affected types
+        self._term_set = None
+        self._root_types = None
+        self._update_meaningful_types(affected_types)
+
+        return new_types, removed_types
+
+    @staticmethod
+    def _is_tag_type(p_type):
+        return any(isinstance(term, TagTypeTerm) for term in p_type)
+
+    def _ensure_relations_index(self):
+        if self._relations_index is None:
+            self._relations_index = (defaultdict(set), SimilarTypesIndex())
+            variant_hashes = {}
+            for p_type in self._type_tuples:
+                self._add_to_relations_index(p_type, variant_hashes)
+        return self._relations_index
+
+    def _variant_hash_keys(self, p_type, variant_hashes):
+        terms = p_type.get_terms_ids()
+        v_hash_keys = {self._variant_same_same_hash(variant, variant_hashes)
+                       for i in range(len(terms)) for variant in itertools.combinations(terms, i+1)}
+        v_hash_keys.discard(None)
+        return v_hash_keys
+
+    def _add_to_relations_index(self, p_type, variant_hashes):
+        if self._is_tag_type(p_type):
+            return
+        variants, similar_index = self._relations_index
+        for v_hash_key in self._variant_hash_keys(p_type, variant_hashes):
+            variants[v_hash_key].add(p_type)
+        if p_type not in similar_index:
+            similar_index.add(self._similar_group_key(p_type), p_type, find_similar=False)
+
+    def _remove_from_relations_index(self, p_type):
+        if self._is_tag_type(p_type):
+            return
+        variants, similar_index = self._relations_index
+        for v_hash_key in self._variant_hash_keys(p_type, {}):
+            types = variants.get(v_hash_key)
+            if types is not None:
+                types.discard(p_type)
+                if not types:
+                    del variants[v_hash_key]
+        similar_index.remove(p_type)
+
+    def _rebuild_tag_types(self, tag_types, added, removed):
+        """
+        Break relations of tag types and build them again from sqns of tag types and products (see
+        build_tag_types_from_products())
+        @param list[ProductType] tag_types: tag types of dict
+        @param list[Product] added: new products
+        @param list[Product] removed: products which are not in source of dict anymore
+        @return: tag types and types which relations with them are changed
+        @rtype: set[ProductType]
+        """
+        affected_types = set(tag_types)
+        for tag_type in tag_types:
+            affected_types.update(tag_type.related_types())
+            tag_type.brake_relations()
+        for product in removed:
+            for tag in product.get('tags', ()):
+                tag_sqns = self._type_tuples.get(ProductType(u'#' + tag.lower()))
+                if tag_sqns and product.sqn in tag_sqns:
+                    tag_sqns.remove(product.sqn)
+
+        # Products are restored from sqns of tag types. Tag type is made from lower case tag, so, it is the same
+        products = [Product(sqn=sqn, tags=[tag_type[0][1:]]) for tag_type in tag_types
+                    for sqn in self._type_tuples.pop(tag_type)]
+        products.extend(added)
+        type_tuples = defaultdict(list, self._type_tuples)
+        self.build_tag_types_from_products(products, type_tuples)
+        for t, sqns in type_tuples.viewitems():
+            if self._is_tag_type(t):
+                self._type_tuples[t] = sqns
+                affected_types.add(t)
+                affected_types.update(t.related_types())
+        return affected_types
+
+    def _update_meaningful_types(self, types):
+        """
+        Re-check meaningful flag of types (see filter_meaningful_types()) and update caches of meaningful types
+        @param set[ProductType] types: types which sqns or relations are changed
+        """
+        meaningful_type_tuples = self._meaningful_type_tuples
+        if not meaningful_type_tuples:
+            # Will be built on demand
+            self._meaningful_type_tuples = None
+            self._drop_find_caches()
+            return
+        find_caches = self.__main_form_cache is not None and self.__similarity_groups_cache is not None
+        if find_caches and not isinstance(self.__main_form_cache, dict):
+            # Caches loaded from file are read-only. Build them on demand
+            self._drop_find_caches()
+            find_caches = False
+        for t in types:
+            if t in meaningful_type_tuples:
+                del meaningful_type_tuples[t]
+                if find_caches:
+                    self._remove_from_find_caches(t)
+        for t, sqns in self.filter_meaningful_types([t for t in types if t in self._type_tuples], self._type_tuples):
+            meaningful_type_tuples[t] = sqns
+            if find_caches:
+                self._add_to_find_caches(t)
+
     def __contains__(self, item):
         assert isinstance(item, ProductType)
         type_tuples = self.get_root_type_tuples()
@@ -648,6 +1056,9 @@ class ProductTypeDict(object):
         self._meaningful_type_tuples = None
         self._term_set = None
         self._root_types = None
+        self._relations_index = None
+        self._find_caches_file = None
+        self._drop_find_caches()
 
     def get_type_tuples(self, meaningful_only=False):
         """
@@ -780,6 +1191,9 @@ class ProductTypeDict(object):
 
         with open(json_filename, 'rb') as f:
             s = f.read()
+        # Find caches can be persisted for global types with ids of terms from dawg only
+        find_caches_file = (self.find_caches_filename(json_filename), checksum(lambda b: b.write(s))) \
+            if binary_format and not dont_change else None
 
         if not pure_json:
             # Please do not pass unicode to jsmin under py2.
@@ -904,6 +1318,7 @@ class ProductTypeDict(object):
         self._type_tuples.clear()
         self._type_tuples.update(type_tuples)
         self._type_tuples_on_change()
+        self._find_caches_file = find_caches_file
 
         gc.enable()
         if self.VERBOSE:
@@ -916,6 +1331,81 @@ class ProductTypeDict(object):
     def get_product_tag_context(product):
         return [tag.strip().lower() for tag in product.get('tags', set()) if tag.strip()]
 
+
+TypeDictDiff = namedtuple('TypeDictDiff', 'added removed equal synonyms more_specific less_specific')
+
+
+def diff_type_dicts(old_types, new_types):
+    """
+    Compare two type dicts, e.g. released and next one. Types of each dict are indexed by term ids and by set of main
+    form term ids (signature). Related types are found by lookup of signature and its subsets, thus, diff takes time
+    linear in size of dicts. Types are equal if they have the same terms. Types are synonyms if they have the same main
+    forms in different terms or order (see ProductType.equals_to()). Type is more specific if its main forms contain
+    all main forms of another type (see ProductType.contains()). Synonyms and more specific types are reported for
+    added and removed types only
+    @param collections.Iterable[ProductType] old_types: types of old dict
+    @param collections.Iterable[ProductType] new_types: types of new dict
+    @rtype: TypeDictDiff
+    @return: sorted lists of added, removed and equal types; pairs of (old type, new type) for synonyms;
+            more_specific pairs of (old type, added type more specific than old one); less_specific pairs of
+            (removed type, new type more general than removed one)
+    """
+    old_by_ids = {p_type.get_terms_ids(): p_type for p_type in old_types}
+    new_by_ids = {p_type.get_terms_ids(): p_type for p_type in new_types}
+    added = sorted((p_type for ids, p_type in new_by_ids.viewitems() if ids not in old_by_ids), key=to_str)
+    removed = sorted((p_type for ids, p_type in old_by_ids.viewitems() if ids not in new_by_ids), key=to_str)
+    equal = sorted((p_type for ids, p_type in new_by_ids.viewitems() if ids in old_by_ids), key=to_str)
+
+    old_signatures, old_index = _main_forms_index(old_by_ids.viewvalues())
+    new_signatures, new_index = _main_forms_index(new_by_ids.viewvalues())
+    synonyms = set()
+    more_specific = set()
+    less_specific = set()
+    for new_type in added:
+        signature = new_signatures.get(new_type)
+        if signature is None:
+            continue
+        synonyms.update((old_type, new_type) for old_type in old_index.get(signature, ()))
+        for sub_signature in _proper_subsets(signature):
+            more_specific.update((old_type, new_type) for old_type in old_index.get(sub_signature, ()))
+    for old_type in removed:
+        signature = old_signatures.get(old_type)
+        if signature is None:
+            continue
+        synonyms.update((old_type, new_type) for new_type in new_index.get(signature, ()))
+        for sub_signature in _proper_subsets(signature):
+            less_specific.update((old_type, new_type) for new_type in new_index.get(sub_signature, ()))
+
+    def sort_pairs(pairs):
+        return sorted(pairs, key=lambda pair: (to_str(pair[0]), to_str(pair[1])))
+    return TypeDictDiff(added, removed, equal, sort_pairs(synonyms), sort_pairs(more_specific),
+                        sort_pairs(less_specific))
+
+
+def _main_forms_index(types):
+    """
+    @param collections.Iterable[ProductType] types: types
+    @return: signature of each type and types by signatures. Types without final main forms are not indexed
+    @rtype: (dict of (ProductType, frozenset[int]), dict of (frozenset[int], list[ProductType]))
+    """
+    signatures = {}
+    index = defaultdict(list)
+    for p_type in types:
+        try:
+            signature = frozenset(p_type.get_main_form_term_ids())
+        except TypeTermException:
+            continue
+        signatures[p_type] = signature
+        index[signature].append(p_type)
+    return signatures, index
+
+
+def _proper_subsets(signature):
+    """@rtype: collections.Iterable[frozenset[int]]"""
+    for n in range(1, len(signature)):
+        for sub_signature in itertools.combinations(signature, n):
+            yield frozenset(sub_signature)
+
 def dump_json(config):
     load_term_dict(config.term_dict)
 
@@ -924,7 +1414,7 @@ def dump_json(config):
     types.min_meaningful_type_capacity = 2
     if config.products_meta_in_csvname:
         products = Product.from_meta_csv(config.products_meta_in_csvname)
-        types.build_from_products(products, strict_products=True)
+        types.build_from_products(products, strict_products=True, processes=None)
     else:
         types.from_json(config.product_types_in_json, pure_json=is_types_file_pure_json(config),
                         binary_format='.bin.' in config.product_types_in_json)
@@ -932,6 +1422,33 @@ def dump_json(config):
     types.to_bin_json('out/product_types_2_bin.json')
 
 
+def diff_json(config):
+    """
+    Print diff of released types dict (-in-product-types-json) and the next one (-out-product-types-json, by default
+    output of dump_json()) for review. See diff_type_dicts()
+    """
+    load_term_dict(config.term_dict)
+
+    type_dicts = []
+    for json_filename in [config.product_types_in_json, config.product_types_out_json or 'out/product_types_2.json']:
+        types = ProductTypeDict()
+        types.VERBOSE = True
+        types.from_json(json_filename, dont_change=True, binary_format='.bin' in json_filename)
+        type_dicts.append(types.get_type_tuples())
+
+    diff = diff_type_dicts(*type_dicts)
+    print(u"Types added: %d, removed: %d, equal: %d, synonyms: %d, more specific: %d, less specific: %d" %
+          tuple(map(len, diff)))
+    for p_type in diff.added:
+        print(u'+ %s' % to_str(p_type))
+    for p_type in diff.removed:
+        print(u'- %s' % to_str(p_type))
+    for label, pairs in [(u'synonym', diff.synonyms), (u'more specific', diff.more_specific),
+                         (u'less specific', diff.less_specific)]:
+        for old_type, new_type in pairs:
+            print(u'~ %s => %s [%s]' % (to_str(old_type), to_str(new_type), label))
+
+
 def update_types_in_product_meta(config):
     import time
     print("Updating types in meta products from %s" % config.products_meta_in_csvname)
@@ -1082,6 +1599,74 @@ def print_sqn_tails():
         print(u'%s: %s' % (t, len(set(s))))
 
 
+def benchmark_collect_type_tuples(config, repeat=3):
+    """
+    Measure collect_type_tuples() over products meta with and without types cache shared by products.
+    Results of both must be identical
+    """
+    import time
+    from ok.dicts.term import load_term_dict
+    load_term_dict()
+    products = list(Product.from_meta_csv(config.products_meta_in_csvname))
+    print(u"Benchmark collect_type_tuples() on %d products" % len(products))
+    results = {}
+    timings = defaultdict(list)
+    # Runs are interleaved to make both variants equally affected by warm up and heap growth
+    for _ in range(repeat):
+        for share_types_cache in [False, True]:
+            ProductType.reload()
+            gc.collect()
+            start_time = time.time()
+            type_tuples = ProductTypeDict.collect_type_tuples(products, share_types_cache=share_types_cache)
+            timings[share_types_cache].append(time.time() - start_time)
+            results[share_types_cache] = {t.get_terms_ids(): sqns for t, sqns in type_tuples.viewitems()}
+    for share_types_cache in [False, True]:
+        print(u"share_types_cache=%s: %d type tuples, best of %d: %.2fs" %
+              (share_types_cache, len(results[share_types_cache]), repeat, min(timings[share_types_cache])))
+    assert results[False] == results[True], "Type tuples differ"
+
+
+def benchmark_prefetch_word_normal_forms(config, processes_list=(1, 2, 4)):
+    """
+    Measure prefetch_word_normal_forms() over products meta by number of worker processes. Each run is made in
+    separate process with empty normal forms cache. Results of all runs must be identical to serial run
+    """
+    import multiprocessing
+    from ok.dicts.russian import get_word_normal_form
+    from ok.dicts.term import load_term_dict
+    load_term_dict()
+    products = list(Product.from_meta_csv(config.products_meta_in_csvname))
+    # Morphology is loaded before fork as it is in dictionary builds
+    get_word_normal_form('молоко')
+    print(u"Benchmark prefetch_word_normal_forms() on %d products with %d cpus" %
+          (len(products), multiprocessing.cpu_count()))
+    results = []
+    for processes in processes_list:
+        # Pool workers are daemons and cannot have own workers, hence, use plain process
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        run = multiprocessing.Process(target=_benchmark_prefetch_word_normal_forms_run,
+                                      args=(products, processes, child_conn))
+        run.start()
+        results.append((processes, conn.recv()))
+        run.join()
+    serial_time = results[0][1][0]
+    for processes, (run_time, morphology) in results:
+        print(u"processes=%d: %d words, %.2fs, speed-up %.2f" %
+              (processes, len(morphology), run_time, serial_time / run_time))
+    assert all(r[1] == results[0][1][1] for _, r in results), "Normal forms differ"
+
+
+def _benchmark_prefetch_word_normal_forms_run(products, processes, conn):
+    import time
+    from ok.dicts.russian import normal_form_cache
+    normal_form_cache.disable_disk_cache()
+    normal_form_cache.clear()
+    start_time = time.time()
+    morphology = ProductTypeDict.prefetch_word_normal_forms(products, processes=processes)
+    run_time = time.time() - start_time
+    conn.send((run_time, {word: tuple(m) for word, m in morphology.viewitems()}))
+
+
 def reload_product_type_dict(config=None, force_text_format=False):
     import ok.dicts
 
@@ -1110,19 +1695,28 @@ def is_types_file_pure_json(config):
 if __name__ == '__main__':
     import sys
     import ok.dicts
+    from ok.dicts.russian import normal_form_disk_cache
     try:
         config = ok.dicts.main_options(sys.argv)
         # print_sqn_tails()
-        if config.action == 'dump-json':
-            config = ok.dicts.main_options(sys.argv, products_meta_in_csvname=None)
-            dump_json(config)
-        elif config.action == 'update-products':
-            update_types_in_product_meta(config)
-        elif config.action == 'gen-types-hdiet-products':
-            # Set defaults
-            config = ok.dicts.main_options(sys.argv, prodcsvname='product_types_raw_hdiet.csv',
-                                           product_types_in_json=None)
-            from_hdiet_csv(config)
+        # Builders share normal forms with each other and with next runs via disk cache
+        with normal_form_disk_cache():
+            if config.action == 'dump-json':
+                config = ok.dicts.main_options(sys.argv, products_meta_in_csvname=None)
+                dump_json(config)
+            elif config.action == 'diff-json':
+                diff_json(config)
+            elif config.action == 'update-products':
+                update_types_in_product_meta(config)
+            elif config.action == 'bench-type-tuples':
+                benchmark_collect_type_tuples(config)
+            elif config.action == 'bench-prefetch-normal-forms':
+                benchmark_prefetch_word_normal_forms(config)
+            elif config.action == 'gen-types-hdiet-products':
+                # Set defaults
+                config = ok.dicts.main_options(sys.argv, prodcsvname='product_types_raw_hdiet.csv',
+                                               product_types_in_json=None)
+                from_hdiet_csv(config)
     except Exception as e:
         print()
         print("Exception caught: %s" % e.message)
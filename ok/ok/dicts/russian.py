@@ -2,8 +2,15 @@
 from __future__ import print_function, unicode_literals
 
 from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
+import os
+import itertools
+import random
 import re
+import threading
+import time
 from ok.dicts import main_options
+from ok.utils import map_chunks
 
 RE_RUSSIAN_CHAR_SET = 'А-Яа-яёЁ'
 RE_ENGLISH_CHAR_SET = 'A-Za-z'
@@ -23,18 +30,20 @@ def is_simple_russian_word(s):
 
 __pymorph_analyzer = None
 """@type: pymorphy2.MorphAnalyzer"""
-__normal_form_word_stats = defaultdict(dict)
-"""@type dict of (unicode, dict of (unicode, unicode))"""
-
 WORD_NORMAL_FORM_KEEP_STATS_DEFAULT = True
 
+# Dictionaries are loaded once on first use. pymorphy2 initialization is not thread-safe
+__dicts_init_lock = threading.RLock()
+
 
 def _ensure_pymorphy():
     global __pymorph_analyzer
 
     if not __pymorph_analyzer:
-        import pymorphy2
-        __pymorph_analyzer = pymorphy2.MorphAnalyzer()
+        with __dicts_init_lock:
+            if not __pymorph_analyzer:
+                import pymorphy2
+                __pymorph_analyzer = pymorphy2.MorphAnalyzer()
 
     return __pymorph_analyzer
 
@@ -43,6 +52,7 @@ def get_word_normal_form(word, strict=True, verbose=False, use_external_word_for
                          collect_stats=WORD_NORMAL_FORM_KEEP_STATS_DEFAULT, return_known=True, seen=None):
     """
     Return first (most relevant by pymorph) normal form of specified russian word.
+    Results are cached in normal_form_cache (not verbose top level calls only). Stats are collected on cache miss.
     @param unicode word: w
     @param bool strict: if True - process nouns and adverbs only because participle and similar has verbs
             as normal form which is useless for product parsing
@@ -51,8 +61,26 @@ def get_word_normal_form(word, strict=True, verbose=False, use_external_word_for
     @param bool return_known: if True (default) return only good known words. No word-creation. If failed to find good
             known form - return word itself. If False, unknown weird words may be returned.
     @param set[unicode]|None seen: recursion history
-    @return:
+    @rtype: unicode
     """
+    collect_stats = collect_stats and normal_form_stats.sample(word)
+    if verbose or seen is not None:
+        return unicode(_get_word_normal_form(word, strict=strict, verbose=verbose,
+                                             use_external_word_forms_dict=use_external_word_forms_dict,
+                                             collect_stats=collect_stats, return_known=return_known, seen=seen))
+    key = (unicode(word), bool(strict), bool(use_external_word_forms_dict), bool(return_known))
+    result = normal_form_cache.get(key)
+    if result is None:
+        result = unicode(_get_word_normal_form(word, strict=strict,
+                                               use_external_word_forms_dict=use_external_word_forms_dict,
+                                               collect_stats=collect_stats, return_known=return_known))
+        normal_form_cache.put(key, result)
+    return result
+
+
+def _get_word_normal_form(word, strict=True, verbose=False, use_external_word_forms_dict=True,
+                          collect_stats=WORD_NORMAL_FORM_KEEP_STATS_DEFAULT, return_known=True, seen=None):
+    start_time = time.time() if collect_stats else None
     pymorph_analyzer = _ensure_pymorphy()
 
     if not strict:
@@ -115,6 +143,7 @@ def get_word_normal_form(word, strict=True, verbose=False, use_external_word_for
     if verbose and not is_w_norm_known:
         print("Morph produced unknown word form: %s => %s" % (word, w_norm))
 
+    morph_time = time.time() if collect_stats else None
     if use_external_word_forms_dict and is_w_norm_known:
         w_form = w_norm
         w_form_tag = parse_norm.tag
@@ -149,8 +178,10 @@ def get_word_normal_form(word, strict=True, verbose=False, use_external_word_for
     # Return only long enough words and good known words (if specified, by default)
     result = w_norm if len(w_norm) >= 3 and (not return_known or is_w_norm_known) else word
     if collect_stats:
-        __normal_form_word_stats[result][word] = str(p_selected.tag) + \
-                                                 (u'?' if not pymorph_analyzer.word_is_known(word) else u'')
+        dict_time = time.time()
+        normal_form_stats.add(word, result, str(p_selected.tag) +
+                              (u'?' if not pymorph_analyzer.word_is_known(word) else u''),
+                              morph_time - start_time, dict_time - morph_time)
 
     if word != result and parse_was_ambiguous and (not seen or result not in seen):
         # Try to retry to check if another word may be produced due to ambiguity
@@ -167,6 +198,257 @@ def get_word_normal_form(word, strict=True, verbose=False, use_external_word_for
     return result
 
 
+class NormalFormCache(object):
+    """
+    Cache of get_word_normal_form() results. Key is (word, strict, use_external_word_forms_dict, return_known).
+    It is a bounded in-memory LRU and optional sqlite file (see enable_disk_cache()). File is shared by all processes
+    and its entries are bound to word forms dict version (see word_forms_dict_version()), i.e. they are ignored if
+    dict files or pymorphy are changed.
+    """
+    # New entries are written to file by batches
+    DISK_FLUSH_SIZE = 1000
+
+    def __init__(self, max_size=200000):
+        """
+        @param int max_size: max number of entries in memory. 0 disables memory cache
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.RLock()
+        self.__entries = OrderedDict()
+        """@type: dict of (tuple, unicode)"""
+        self.__disk_filename = None
+        self.__disk_version = None
+        self.__disk_connection = None
+        self.__disk_pid = None
+        self.__disk_pending = []
+
+    @staticmethod
+    def __disk_flags(key):
+        return int(key[1]) | int(key[2]) << 1 | int(key[3]) << 2
+
+    def __ensure_disk_connection(self):
+        # Must be called under lock. Forked process must not use connection of parent
+        if self.__disk_connection is not None and self.__disk_pid != os.getpid():
+            self.__disk_connection = None
+            self.__disk_pending = []
+        if self.__disk_connection is None:
+            import sqlite3
+            connection = sqlite3.connect(self.__disk_filename, timeout=60, check_same_thread=False)
+            connection.execute('CREATE TABLE IF NOT EXISTS normal_forms (version TEXT, word TEXT, flags INTEGER, '
+                               'result TEXT, PRIMARY KEY (version, word, flags))')
+            connection.commit()
+            self.__disk_connection = connection
+            self.__disk_pid = os.getpid()
+        return self.__disk_connection
+
+    def __disk_get(self, key):
+        import sqlite3
+        try:
+            row = self.__ensure_disk_connection().execute(
+                'SELECT result FROM normal_forms WHERE version = ? AND word = ? AND flags = ?',
+                (self.__disk_version, key[0], self.__disk_flags(key))).fetchone()
+        except sqlite3.Error as e:
+            print("Normal forms disk cache is disabled due to error: %s" % e)
+            self.__disk_filename = self.__disk_connection = None
+            return None
+        return row[0] if row else None
+
+    def flush(self):
+        """Write pending entries to disk cache"""
+        import sqlite3
+        with self.__lock:
+            if self.__disk_filename is None or not self.__disk_pending:
+                return
+            pending = self.__disk_pending
+            self.__disk_pending = []
+            try:
+                connection = self.__ensure_disk_connection()
+                connection.executemany('INSERT OR REPLACE INTO normal_forms VALUES (?, ?, ?, ?)',
+                                       [(self.__disk_version, key[0], self.__disk_flags(key), result)
+                                        for key, result in pending])
+                connection.commit()
+            except sqlite3.Error as e:
+                print("Normal forms disk cache is disabled due to error: %s" % e)
+                self.__disk_filename = self.__disk_connection = None
+
+    def get(self, key):
+        """@rtype: unicode|None"""
+        with self.__lock:
+            result = self.__entries.pop(key, None)
+            if result is not None:
+                self.__entries[key] = result
+            elif self.__disk_filename is not None:
+                result = self.__disk_get(key)
+                if result is not None:
+                    self.__put_memory(key, result)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def __put_memory(self, key, result):
+        if self.max_size:
+            self.__entries[key] = result
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def put(self, key, result):
+        with self.__lock:
+            self.__put_memory(key, result)
+            if self.__disk_filename is not None:
+                self.__disk_pending.append((key, result))
+                if len(self.__disk_pending) >= self.DISK_FLUSH_SIZE:
+                    self.flush()
+
+    def enable_disk_cache(self, filename=None):
+        """
+        @param unicode|None filename: sqlite file name. By default, it is in word forms dict directory
+        """
+        if filename is None:
+            config = main_options([])
+            filename = os.path.join(os.path.dirname(config.word_forms_dict), NORMAL_FORMS_CACHE_FILENAME)
+        with self.__lock:
+            self.disable_disk_cache()
+            self.__disk_version = word_forms_dict_version()
+            self.__disk_filename = filename
+
+    def disable_disk_cache(self):
+        with self.__lock:
+            self.flush()
+            if self.__disk_connection is not None and self.__disk_pid == os.getpid():
+                self.__disk_connection.close()
+            self.__disk_filename = self.__disk_connection = None
+
+    def is_disk_cache_enabled(self):
+        return self.__disk_filename is not None
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self):
+        """@rtype: dict of (unicode, int)"""
+        return {'size': len(self.__entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'disk': self.__disk_filename}
+
+
+NORMAL_FORMS_CACHE_FILENAME = '.ok_normal_forms.db'
+
+normal_form_cache = NormalFormCache()
+
+
+@contextmanager
+def normal_form_disk_cache(filename=None):
+    """
+    Use normal forms disk cache in with-block. It is for dictionary builders and their workers
+    @param unicode|None filename: see NormalFormCache.enable_disk_cache()
+    """
+    if normal_form_cache.is_disk_cache_enabled():
+        # Already enabled by caller
+        yield normal_form_cache
+        return
+    normal_form_cache.enable_disk_cache(filename)
+    try:
+        yield normal_form_cache
+    finally:
+        normal_form_cache.disable_disk_cache()
+
+
+WordMorphology = namedtuple('WordMorphology', 'normal_form is_known')
+
+
+def get_word_normal_forms_batch(words, strict=True, use_external_word_forms_dict=True, return_known=True,
+                                processes=None, chunk_size=1000):
+    """
+    Batch version of get_word_normal_form() for dictionary builds. Unique words which are not in normal_form_cache yet
+    are split by chunks and processed in process pool (see map_chunks(), each worker has own MorphAnalyzer). Results
+    are put into normal_form_cache, thus, following get_word_normal_form() calls with the same flags are cache hits.
+    NOTE: word stats (see dump_word_normal_form_stats()) are not collected for words processed by workers.
+    @param collections.Iterable[unicode] words: words, duplicates are allowed
+    @param int|None processes: number of worker processes. By default, number of cpus. Batch of one chunk
+            or processes=1 is processed in current process
+    @param int chunk_size: number of words sent to worker at once
+    @rtype: dict of (unicode, WordMorphology)
+    """
+    flags = (bool(strict), bool(use_external_word_forms_dict), bool(return_known))
+    result = {}
+    new_words = []
+    for word in OrderedDict.fromkeys(unicode(w) for w in words):
+        normal_form = normal_form_cache.get((word,) + flags)
+        if normal_form is None:
+            new_words.append(word)
+        else:
+            result[word] = WordMorphology(normal_form, is_known_word(word, use_external_word_forms_dict))
+
+    chunks = ((new_words[i:i + chunk_size], flags) for i in range(0, len(new_words), chunk_size))
+    for worker_pid, chunk_result in map_chunks(_word_morphology_chunk, chunks, processes=processes,
+                                               initializer=word_morphology_worker_init):
+        for word, normal_form, is_known in chunk_result:
+            if worker_pid != os.getpid():
+                # Chunks processed in current process are in cache already
+                normal_form_cache.put((word,) + flags, normal_form)
+            result[word] = WordMorphology(normal_form, is_known)
+    return result
+
+
+def word_morphology_worker_init():
+    """
+    Initializer of worker processes which use word morphology (see map_chunks()). Disk cache of normal forms is
+    written by parent process only. Hence, it is disabled in pool workers but kept if chunks are processed in parent
+    """
+    import multiprocessing
+    # Pool workers are always daemons
+    if multiprocessing.current_process().daemon:
+        normal_form_cache.disable_disk_cache()
+
+
+def _word_morphology_chunk(chunk):
+    words, (strict, use_external_word_forms_dict, return_known) = chunk
+    morphology = [(word, get_word_normal_form(word, strict=strict,
+                                              use_external_word_forms_dict=use_external_word_forms_dict,
+                                              return_known=return_known),
+                   is_known_word(word, use_external_word_forms_dict=use_external_word_forms_dict))
+                  for word in words]
+    return os.getpid(), morphology
+
+
+def word_forms_dict_version():
+    """
+    Version of external word forms dicts and pymorphy used by get_word_normal_form()
+    @rtype: unicode
+    """
+    import pymorphy2
+
+    config = main_options([])
+    return u'pymorphy2-%s;%s' % (pymorphy2.__version__, _word_forms_sources_version(config.word_forms_dict))
+
+
+def _word_forms_sources_version(filename):
+    """
+    Version of word forms dict text files. See _word_forms_dict_files()
+    @rtype: unicode
+    """
+    from ok.dicts.manifest import cached_file_hash
+
+    checksums = [u'%s:%d' % (os.path.basename(filename_i),
+                             cached_file_hash(filename_i, 'word_forms_checksum', _word_forms_file_checksum))
+                 for filename_i in _word_forms_dict_files(filename)]
+    return u';'.join(checksums)
+
+
+def _word_forms_file_checksum(filename):
+    from ok.utils import checksum
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return checksum(lambda b: b.write(data))
+
+
 def inflect_normal_form(parse_item):
     """
     Try to inflect one by one sing, masc and nomn. If it cannot be done use previous version.
@@ -182,6 +464,21 @@ def inflect_normal_form(parse_item):
 
 
 def is_known_word(word, use_external_word_forms_dict=True):
+    """
+    Check if word or its umlaut variant is known by pymorphy or word forms dict. Words of known words snapshot are
+    answered by one lookup (see compile_known_words_snapshot()), others are checked by pymorphy
+    @rtype: bool
+    """
+    snapshot = _ensure_known_words_snapshot()
+    if snapshot is not None:
+        flags = snapshot.get(unicode(word))
+        if flags:
+            return bool(int(flags[0]) & (KNOWN_WITH_WORD_FORMS_DICT if use_external_word_forms_dict else
+                                         KNOWN_BY_PYMORPHY))
+    return _is_known_word(word, use_external_word_forms_dict)
+
+
+def _is_known_word(word, use_external_word_forms_dict=True):
     pymorph_analyzer = _ensure_pymorphy()
     word_forms_dict = _ensure_word_forms_dict() if use_external_word_forms_dict else {}
     variants = [word] + collect_umlaut_variants(word)
@@ -194,15 +491,189 @@ def is_known_word(word, use_external_word_forms_dict=True):
     return is_known
 
 
-def dump_word_normal_form_stats(filename):
-    import os.path
-    if __normal_form_word_stats:
-        print("Dump stats about %d words to %s" % (len(__normal_form_word_stats), os.path.abspath(filename)))
+KNOWN_WORDS_SNAPSHOT_FILENAME = 'known_words.dawg'
+KNOWN_WORDS_VERSION_KEY = '#version'
+# Flags of word in known words snapshot
+KNOWN_BY_PYMORPHY = 1
+KNOWN_WITH_WORD_FORMS_DICT = 2
+
+__known_words_snapshot = None
+"""@type: dawg.BytesDAWG|bool"""
+
+
+def known_words_snapshot_filename():
+    config = main_options([])
+    return os.path.join(os.path.dirname(config.word_forms_dict), KNOWN_WORDS_SNAPSHOT_FILENAME)
+
+
+def _ensure_known_words_snapshot():
+    """
+    Load known words snapshot once. Snapshot of other word forms dicts or pymorphy version is not used
+    @rtype: dawg.BytesDAWG|None
+    """
+    global __known_words_snapshot
+
+    if __known_words_snapshot is None:
+        with __dicts_init_lock:
+            if __known_words_snapshot is None:
+                snapshot = False
+                filename = known_words_snapshot_filename()
+                if os.path.isfile(filename):
+                    import dawg
+                    snapshot = dawg.BytesDAWG()
+                    snapshot.load(filename)
+                    version = snapshot.get(KNOWN_WORDS_VERSION_KEY)
+                    if not version or version[0].decode('utf-8') != word_forms_dict_version():
+                        print("Known words snapshot is outdated and will not be used: %s" % filename)
+                        snapshot = False
+                __known_words_snapshot = snapshot
+
+    return __known_words_snapshot or None
+
+
+def compile_known_words_snapshot(words, filename=None):
+    """
+    Save flags of is_known_word() for words and their umlaut variants and pymorphy normal forms as well as
+    for all words of word forms dict. Snapshot is used by is_known_word() of next processes while word forms dicts
+    and pymorphy are not changed
+    @param collections.Iterable[unicode] words: words of baseline, e.g. terms of term dict
+    @param unicode|None filename: by default, it is saved next to word forms dict
+    """
+    global __known_words_snapshot
+    import dawg
+
+    filename = filename or known_words_snapshot_filename()
+    pymorph_analyzer = _ensure_pymorphy()
+    all_words = set(_ensure_word_forms_dict().keys())
+    for word in words:
+        word = unicode(word)
+        all_words.add(word)
+        all_words.update(pymorph_analyzer.normal_forms(word))
+    for word in list(all_words):
+        all_words.update(collect_umlaut_variants(word))
+
+    items = [(word, str(_is_known_word(word, False) * KNOWN_BY_PYMORPHY +
+                        _is_known_word(word, True) * KNOWN_WITH_WORD_FORMS_DICT)) for word in all_words if word]
+    items.append((KNOWN_WORDS_VERSION_KEY, word_forms_dict_version().encode('utf-8')))
+    print("Save known words snapshot of %d words to: %s" % (len(items) - 1, os.path.abspath(filename)))
+    dawg.BytesDAWG(items).save(filename)
+    with __dicts_init_lock:
+        __known_words_snapshot = None
+
+
+class NormalFormStats(object):
+    """
+    Statistics of get_word_normal_form() calls. Only sampled calls are counted (see sample_rate). For each normal
+    form, source words with their morphological tags are kept as well as calls count per source word. Number of
+    kept words is limited by max_words, words over limit are counted in 'dropped' only. Time is measured for cache
+    misses: 'morph' is pymorphy parse (with known word checks), 'dict' is lookups in external word forms dicts
+    """
+
+    def __init__(self, max_words=100000, max_forms_per_word=100, sample_rate=1.0):
+        """
+        @param int max_words: max number of normal forms and of counted source words
+        @param int max_forms_per_word: max number of source words kept for each normal form
+        @param float sample_rate: part of calls to be counted, from 0.0 (disabled) to 1.0 (all calls)
+        """
+        self.max_words = max_words
+        self.max_forms_per_word = max_forms_per_word
+        self.sample_rate = sample_rate
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__normal_forms = defaultdict(dict)
+            """@type: dict of (unicode, dict of (unicode, unicode))"""
+            self.__word_calls = defaultdict(int)
+            """@type: dict of (unicode, int)"""
+            self.__calls = 0
+            self.__sampled = 0
+            self.__misses = 0
+            self.__dropped = 0
+            self.__morph_time = 0.0
+            self.__dict_time = 0.0
+
+    def sample(self, word):
+        """
+        Decide if call for word is counted and count it
+        @rtype: bool
+        """
+        word = unicode(word)
+        with self.__lock:
+            self.__calls += 1
+            if self.sample_rate < 1.0 and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+                return False
+            self.__sampled += 1
+            if word in self.__word_calls or len(self.__word_calls) < self.max_words:
+                self.__word_calls[word] += 1
+            else:
+                self.__dropped += 1
+        return True
+
+    def add(self, word, normal_form, tag, morph_time, dict_time):
+        """
+        Register calculated (not cached) normal form of word
+        @param float morph_time: seconds spent in pymorphy
+        @param float dict_time: seconds spent in external dicts
+        """
+        word = unicode(word)
+        normal_form = unicode(normal_form)
+        with self.__lock:
+            self.__misses += 1
+            self.__morph_time += morph_time
+            self.__dict_time += dict_time
+            forms = self.__normal_forms.get(normal_form)
+            if forms is None:
+                if len(self.__normal_forms) >= self.max_words:
+                    self.__dropped += 1
+                    return
+                forms = self.__normal_forms[normal_form]
+            if word in forms or len(forms) < self.max_forms_per_word:
+                forms[word] = tag
+
+    def snapshot(self):
+        """
+        Copy of current stats. It can be taken at any time from any thread
+        @rtype: dict
+        """
+        with self.__lock:
+            return {
+                'calls': self.__calls,
+                'sampled': self.__sampled,
+                'misses': self.__misses,
+                'dropped': self.__dropped,
+                'morph_time': self.__morph_time,
+                'dict_time': self.__dict_time,
+                'sample_rate': self.sample_rate,
+                'normal_forms': dict((k, dict(v)) for k, v in self.__normal_forms.viewitems()),
+                'word_calls': dict(self.__word_calls),
+            }
+
+    def dump(self, filename):
+        """Dump snapshot of stats to text file. Normal forms with more source words are first"""
+        stats = self.snapshot()
+        normal_forms = stats['normal_forms']
+        if not normal_forms:
+            return
+        word_calls = stats['word_calls']
+        print("Dump stats about %d words to %s" % (len(normal_forms), os.path.abspath(filename)))
         with open(filename, 'wb') as f:
             f.truncate()
+            f.write((u'# calls: %d; sampled: %d; misses: %d; dropped: %d; morph time: %.3fs; dict time: %.3fs\r\n' %
+                     (stats['calls'], stats['sampled'], stats['misses'], stats['dropped'],
+                      stats['morph_time'], stats['dict_time'])).encode('utf-8'))
             f.writelines((u'%s: %d; %s\r\n' %
-                          (k, len(v), u'; '.join(u'%s=%s' % (w, tag) for w, tag in v.viewitems()))).encode('utf-8')
-                         for k, v in sorted(__normal_form_word_stats.viewitems(), key=lambda _v: _v[1], reverse=True))
+                          (k, len(v), u'; '.join(u'%s=%s(%d)' % (w, tag, word_calls.get(w, 0))
+                                                 for w, tag in v.viewitems()))).encode('utf-8')
+                         for k, v in sorted(normal_forms.viewitems(), key=lambda _v: len(_v[1]), reverse=True))
+
+
+normal_form_stats = NormalFormStats()
+
+
+def dump_word_normal_form_stats(filename):
+    normal_form_stats.dump(filename)
 
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 FOLLOWING ARE FUNCTIONS/TASKS TO WORK WITH EXTERNAL DICT DATA
@@ -259,53 +730,35 @@ class _EffrDictParseContext(object):
                 result.append(DictArticle(self.art, [], [], amb, 'efremova'))
         return result
 
-def effr_parse(filename, out_filename=None):
+def effr_parse(filename, out_filename=None, processes=None, chunk_size=2000):
+    """
+    Parse Efremova dict. File is split to chunks of articles which are parsed in process pool. Results are merged
+    in order of chunks, thus, they do not depend on number of processes.
+    @param int|None processes: number of worker processes. By default, number of cpus
+    @param int chunk_size: number of articles in chunk
+    """
     from os.path import getsize, abspath
     effr_dict = defaultdict(list)
     """@type: dict of (unicode, list[DictArticle])"""
     original_dict_file = abspath(filename)
     original_dict_file_size = getsize(original_dict_file)
     print("Parsing Efremova dict from %s (size: %d)" % (original_dict_file, original_dict_file_size))
+    start_time = time.time()
     with open(filename, 'rb') as f:
-        # Articles are separated by empty lines
         art_count = 0
-        parse_context = None
-        """@type _EffrDictParseContext|None"""
         total_ambiguity_count = 0
-        last_line = '\r\n'
-        while last_line:
-            last_line = f.readline()
-            line = last_line.strip().decode('cp1251')
-            if line:
-                if parse_context is None:
-                    # Treat first line of block as article title
-                    parse_context = _EffrDictParseContext(line.lower())
-                    if art_count % 3000 == 0: print('.', end='')
-                    art_count += 1
-                    continue
-                m = re.search(u'Соотносящийся по знач. с сущ.:(.+?)(?: (?:связанный|унаследованный).*)?$', line, re.U | re.I)
-                if m:
-                    _parse_article_refs(m.group(1), parse_context, parse_context.noun_bases, parse_context.noun_bases_ambiguity)
-                    continue
-                m = re.search(u'То же, что:(.+?)\.?$', line, re.U | re.I)
-                if m:
-                    _parse_article_refs(m.group(1), parse_context, parse_context.same, parse_context.same_ambiguity)
-                    continue
-                m = re.search(u'(?:Уменьш.|Ласк.) к сущ.:(.+?)\.?$', line, re.U | re.I)
-                if m:
-                    _parse_article_refs(m.group(1), parse_context, parse_context.pet, parse_context.pet_ambiguity)
-                    continue
-            if not line:
-                # End of article. ready to next
-                if parse_context:
-                    effr_dict[parse_context.art].extend(parse_context.make_dict_article())
-                    total_ambiguity_count += len(parse_context.noun_bases_ambiguity) + \
-                                             len(parse_context.same_ambiguity) + \
-                                             len(parse_context.pet_ambiguity)
-                parse_context = None
+        for chunk_articles, chunk_art_count in map_chunks(_effr_parse_chunk, _effr_read_chunks(f, chunk_size),
+                                                          processes=processes,
+                                                          initializer=word_morphology_worker_init):
+            for art, items, ambiguity_count in chunk_articles:
+                effr_dict[art].extend(items)
+                total_ambiguity_count += ambiguity_count
+            art_count += chunk_art_count
+            print('.', end='')
         print()
         print("Parsed %d terms of %d articles. Found %d ambiguities" %
               (len(effr_dict), art_count, total_ambiguity_count))
+        _print_parse_throughput(art_count, start_time)
 
     if out_filename:
         print("Export parsed dict to %s" % abspath(out_filename))
@@ -328,6 +781,71 @@ def effr_parse(filename, out_filename=None):
     return effr_dict
 
 
+def _effr_read_chunks(f, chunk_size):
+    """
+    Split Efremova dict file to chunks of raw lines. Chunks are split on article boundaries (empty lines)
+    @rtype: collections.Iterable[list[bytes]]
+    """
+    chunk = []
+    chunk_art_count = 0
+    for line in f:
+        chunk.append(line)
+        if not line.strip():
+            chunk_art_count += 1
+            if chunk_art_count >= chunk_size:
+                yield chunk
+                chunk = []
+                chunk_art_count = 0
+    if chunk:
+        yield chunk
+
+
+def _effr_parse_chunk(lines):
+    """
+    Parse chunk of Efremova dict. Article which is not finished by empty line is finished at the end of chunk
+    @param list[bytes] lines: raw lines
+    @return: list of (article title, article with all ambiguity clones, ambiguity count) and count of articles
+    @rtype: (list[(unicode, list[DictArticle], int)], int)
+    """
+    articles = []
+    art_count = 0
+    parse_context = None
+    """@type _EffrDictParseContext|None"""
+    for raw_line in lines + [b'']:
+        line = raw_line.strip().decode('cp1251')
+        if line:
+            if parse_context is None:
+                # Treat first line of block as article title
+                parse_context = _EffrDictParseContext(line.lower())
+                art_count += 1
+                continue
+            m = re.search(u'Соотносящийся по знач. с сущ.:(.+?)(?: (?:связанный|унаследованный).*)?$', line, re.U | re.I)
+            if m:
+                _parse_article_refs(m.group(1), parse_context, parse_context.noun_bases, parse_context.noun_bases_ambiguity)
+                continue
+            m = re.search(u'То же, что:(.+?)\.?$', line, re.U | re.I)
+            if m:
+                _parse_article_refs(m.group(1), parse_context, parse_context.same, parse_context.same_ambiguity)
+                continue
+            m = re.search(u'(?:Уменьш.|Ласк.) к сущ.:(.+?)\.?$', line, re.U | re.I)
+            if m:
+                _parse_article_refs(m.group(1), parse_context, parse_context.pet, parse_context.pet_ambiguity)
+                continue
+        if not line:
+            # End of article. ready to next
+            if parse_context:
+                articles.append((parse_context.art, parse_context.make_dict_article(),
+                                 len(parse_context.noun_bases_ambiguity) + len(parse_context.same_ambiguity) +
+                                 len(parse_context.pet_ambiguity)))
+            parse_context = None
+    return articles, art_count
+
+
+def _print_parse_throughput(art_count, start_time):
+    elapsed = time.time() - start_time
+    print("Parsed %d articles in %.1fs (%d articles/s)" % (art_count, elapsed, art_count / elapsed if elapsed else 0))
+
+
 def _parse_article_refs(article_refs_list_str, parse_context, context_article_refs, context_article_refs_ambiguity):
     """
     @param unicode article_refs_list_str: list of article references
@@ -356,64 +874,198 @@ def _parse_article_refs(article_refs_list_str, parse_context, context_article_re
 
 
 def _parse_article_references_list_string(ref_list_str):
-    article_references = [ref_str.strip().lower() for ref_str in
-                       re.findall(u'\s+([^,(]+?)(?:(?:\s+\([^)]+\)),?|,|$)', ref_list_str, re.U)]
-    # Use simple russian terms only + simple words with hyphen
-    article_references = [ref_str for ref_str in article_references if is_simple_russian_word(ref_str)]
+    article_references = _article_references_words(ref_list_str)
     # Get unique normal forms only
     article_references = OrderedDict.fromkeys(
         [get_word_normal_form(_art_ref, use_external_word_forms_dict=False) for _art_ref in article_references]).keys()
     return article_references
 
+def _article_references_words(ref_list_str):
+    article_references = [ref_str.strip().lower() for ref_str in
+                       re.findall(u'\s+([^,(]+?)(?:(?:\s+\([^)]+\)),?|,|$)', ref_list_str, re.U)]
+    # Use simple russian terms only + simple words with hyphen
+    return [ref_str for ref_str in article_references if is_simple_russian_word(ref_str)]
+
+
+class CompiledWordFormsDict(object):
+    """
+    Read-only word forms dict compiled from all text dicts (see _load_all_word_forms_dicts()) to BytesDAWG.
+    Articles of word are packed into one dawg value and decoded on lookup. Dawg keeps version of text dicts it was
+    compiled from, thus, it can be checked for staleness without parsing of text dicts.
+    """
+    VERSION_KEY = '#version'
+    SOURCES_KEY = '#sources'
+    ARTICLES_SEP = '\x1e'
+    FIELDS_SEP = '\x1f'
+    WORDS_SEP = '|'
+
+    def __init__(self, words_dawg):
+        """@param dawg.BytesDAWG words_dawg: compiled dict"""
+        self.__dawg = words_dawg
+        version = words_dawg.get(self.VERSION_KEY)
+        self.version = version[0].decode('utf-8') if version else None
+        sources = words_dawg.get(self.SOURCES_KEY)
+        self.sources = sources[0].decode('utf-8').split(self.FIELDS_SEP) if sources else []
+
+    @classmethod
+    def from_articles(cls, word_forms_dict, version):
+        """
+        @param dict of (unicode, list[DictArticle]) word_forms_dict: merged text dicts
+        @param unicode version: see _word_forms_sources_version()
+        @rtype: CompiledWordFormsDict
+        """
+        import dawg
+        sources = OrderedDict()
+        items = []
+        for word, articles in word_forms_dict.viewitems():
+            packed = cls.ARTICLES_SEP.join(
+                cls.FIELDS_SEP.join([cls.WORDS_SEP.join(art.noun_base), cls.WORDS_SEP.join(art.same),
+                                     cls.WORDS_SEP.join(art.pet), unicode(sources.setdefault(art.source, len(sources)))])
+                for art in articles)
+            items.append((word, packed.encode('utf-8')))
+        items.append((cls.VERSION_KEY, version.encode('utf-8')))
+        items.append((cls.SOURCES_KEY, cls.FIELDS_SEP.join(sources).encode('utf-8')))
+        return cls(dawg.BytesDAWG(items))
+
+    @classmethod
+    def from_file(cls, filename):
+        """@rtype: CompiledWordFormsDict"""
+        import dawg
+        words_dawg = dawg.BytesDAWG()
+        words_dawg.load(filename)
+        return cls(words_dawg)
+
+    def to_file(self, filename):
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        self.__dawg.save(tmp_filename)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+
+    def __split_words(self, words_str):
+        return words_str.split(self.WORDS_SEP) if words_str else []
+
+    def get(self, word, default=None):
+        """@rtype: list[DictArticle]"""
+        packed = self.__dawg.get(word)
+        if not packed or word.startswith('#'):
+            return default
+        articles = []
+        for packed_art in packed[0].decode('utf-8').split(self.ARTICLES_SEP):
+            nouns, sames, pets, source_idx = packed_art.split(self.FIELDS_SEP)
+            articles.append(DictArticle(word, self.__split_words(nouns), self.__split_words(sames),
+                                        self.__split_words(pets), self.sources[int(source_idx)]))
+        return articles
+
+    def __getitem__(self, word):
+        articles = self.get(word)
+        if articles is None:
+            raise KeyError(word)
+        return articles
+
+    def __contains__(self, word):
+        return word in self.__dawg and not word.startswith('#')
+
+    def keys(self):
+        return [word for word in self.__dawg.iterkeys() if not word.startswith('#')]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+
 __word_forms_dict = None
 
 def _ensure_word_forms_dict():
     """
-    @rtype: dict of (unicode, list[DictArticle])
+    @rtype: CompiledWordFormsDict
     """
-    from os.path import splitext, isfile
     global __word_forms_dict
 
     if __word_forms_dict is None:
-        word_forms_dict = defaultdict(list)
+        with __dicts_init_lock:
+            if __word_forms_dict is None:
+                config = main_options([])
+                __word_forms_dict = _load_compiled_word_forms_dict(config.word_forms_dict)
+
+    return __word_forms_dict
+
+
+def compiled_word_forms_dict_filename(filename):
+    return '%s.dawg' % os.path.splitext(filename)[0]
 
+
+def _load_compiled_word_forms_dict(filename):
+    """
+    Load compiled word forms dict. If it does not exist or any of text dicts has been changed since compilation,
+    compile it again and try to save for next processes.
+    @param unicode filename: main text dict. See _word_forms_dict_files()
+    @rtype: CompiledWordFormsDict
+    """
+    dawg_filename = compiled_word_forms_dict_filename(filename)
+    version = _word_forms_sources_version(filename)
+    if os.path.isfile(dawg_filename):
+        try:
+            compiled = CompiledWordFormsDict.from_file(dawg_filename)
+            if compiled.version == version:
+                return compiled
+        except IOError:
+            pass
+    print("Compile word forms dict to: %s" % os.path.abspath(dawg_filename))
+    compiled = CompiledWordFormsDict.from_articles(_load_all_word_forms_dicts(filename), version)
+    try:
+        compiled.to_file(dawg_filename)
+    except (IOError, OSError):
+        # Read-only data dir. Compiled dict is kept in memory for this process only
+        pass
+    return compiled
+
+
+def _load_all_word_forms_dicts(filename=None):
+    """
+    @rtype: dict of (unicode, list[DictArticle])
+    """
+    word_forms_dict = defaultdict(list)
+
+    if filename is None:
         config = main_options([])
         filename = config.word_forms_dict
+    for filename_i in _word_forms_dict_files(filename):
+        override_word_forms_dict = _load_word_forms_dict(filename_i)
+        for art, items in override_word_forms_dict.viewitems():
+            if art in word_forms_dict:
+                if any(not _it.is_empty() for _it in word_forms_dict[art]) and \
+                        all(_it.is_empty() for _it in items):
+                    # Do not rewrite existing meaningful data by empty articles
+                    continue
+            word_forms_dict[art] = items
 
-        """
-        Load word_form_dicts from multiple files. Sequence (in following order) is checked.
-        If file exist override (merge) with previous data.
-        <filename>_0.<fileext>
-        <filename>_1.<fileext>
-        ...
-        <filename>_9.<fileext>
-        <filename>.<fileext>
-        <filename>_override.<fileext>
-        Numbered dicts are optional generated dicts from multiple sources.
-        One without number suffix is main generated dict
-        _override dict contains manual corrections
-        """
-        file_base, file_ext = splitext(filename)
-        file_variants = []
-        for i in range(10):
-            file_variants.append('%s_%d%s' % (file_base, i, file_ext))
-        file_variants.append(filename)
-        file_variants.append('%s_override%s' % (file_base, file_ext))
-
-        for filename_i in file_variants:
-            if isfile(filename_i):
-                override_word_forms_dict = _load_word_forms_dict(filename_i)
-                for art, items in override_word_forms_dict.viewitems():
-                    if art in word_forms_dict:
-                        if any(not _it.is_empty() for _it in word_forms_dict[art]) and \
-                                all(_it.is_empty() for _it in items):
-                            # Do not rewrite existing meaningful data by empty articles
-                            continue
-                    word_forms_dict[art] = items
-
-        __word_forms_dict = word_forms_dict
+    return word_forms_dict
 
-    return __word_forms_dict
+
+def _word_forms_dict_files(filename):
+    """
+    Load word_form_dicts from multiple files. Sequence (in following order) is checked.
+    If file exist override (merge) with previous data.
+    <filename>_0.<fileext>
+    <filename>_1.<fileext>
+    ...
+    <filename>_9.<fileext>
+    <filename>.<fileext>
+    <filename>_override.<fileext>
+    Numbered dicts are optional generated dicts from multiple sources.
+    One without number suffix is main generated dict
+    _override dict contains manual corrections
+    """
+    file_base, file_ext = os.path.splitext(filename)
+    file_variants = []
+    for i in range(10):
+        file_variants.append('%s_%d%s' % (file_base, i, file_ext))
+    file_variants.append(filename)
+    file_variants.append('%s_override%s' % (file_base, file_ext))
+    return [filename_i for filename_i in file_variants if os.path.isfile(filename_i)]
 
 
 def _load_word_forms_dict(filename):
@@ -579,14 +1231,70 @@ def collect_umlaut_variants(word):
         variants.append(word.replace(u'ё', u'е'))
     return variants
 
-def ozhegov_parse(filename, out_filename=None):
-    # Parse 'same' forms only from Ozhegov dictionary
+# Kinds of definitions of Ozhegov dict line. Only OZHEGOV_SAME has a value - 'same' word.
+# Strings are used instead of object() because definitions are returned from worker processes
+OZHEGOV_SAME = 'same'
+# Same word of previous line is kept
+OZHEGOV_KEEP = 'keep'
+OZHEGOV_SKIP = 'skip'
+OZHEGOV_DEFAULT = 'default'
+
+
+def _ozhegov_parse_chunk(lines):
+    """
+    Parse chunk of Ozhegov dict lines. Lines of not noun articles are filtered out.
+    @param list[bytes] lines: raw lines
+    @return: list of (article title, (definition kind, 'same' word)), see OZHEGOV_SAME
+    @rtype: list[(unicode, (unicode, unicode|None))]
+    """
+    result = []
+    pymorph = _ensure_pymorphy()
+    for line in lines:
+        line = line.strip().decode('cp1251').lower()
+        if line:
+            # "сочник|||||== сочень <...mess...>||" - need a title in zero field and '== <ref>' in 5th field.
+            # After <ref> token might be a mess, parse first token only
+            fields = line.split(u'|')
+            if len(fields) < 6:
+                continue
+            art = fields[0].strip()
+
+            if pymorph.word_is_known(art):
+                if {'NOUN'} not in pymorph.tag(art)[0]:
+                    # Use NOUNs only
+                    continue
+
+            same_def = (OZHEGOV_KEEP, None)
+            m = re.search('^[<=]=((?:\s+[%s]+)+)' % RE_RUSSIAN_CHAR_SET, fields[5], re.U)
+            if m:
+                m = re.findall('\s+([%s]+)' % RE_RUSSIAN_CHAR_SET, m.group(1), re.U)
+                if len(m) > 1 or 'в старину' in fields[4].lower():
+                    # Ignore multi-word definitions as well as ancient word forms.
+                    same_def = (OZHEGOV_SKIP, None)
+                elif pymorph.word_is_known(m[0]):
+                    norm = get_word_normal_form(m[0], use_external_word_forms_dict=False)
+                    if {'NOUN'} in pymorph.tag(norm)[0]:
+                        same_def = (OZHEGOV_SAME, norm)
+            else:
+                same_def = (OZHEGOV_DEFAULT, None)
+            result.append((art, same_def))
+    return result
+
+
+def ozhegov_parse(filename, out_filename=None, processes=None, chunk_size=20000):
+    """
+    Parse 'same' forms only from Ozhegov dictionary. Lines are parsed by chunks in process pool (see map_chunks()) and
+    merged in order of file lines.
+    @param int|None processes: number of worker processes. By default, number of cpus
+    @param int chunk_size: number of lines in chunk
+    """
     from os.path import getsize, abspath
     ozhegov_dict = defaultdict(list)
     """@type: dict of (unicode, list[DictArticle])"""
     original_dict_file = abspath(filename)
     original_dict_file_size = getsize(original_dict_file)
     print("Parsing Ozhegov dict from %s (size: %d)" % (original_dict_file, original_dict_file_size))
+    start_time = time.time()
 
     with open(filename, 'rb') as f:
         # All articles one-liners. Start from article title and fields separated by '|'
@@ -596,6 +1304,7 @@ def ozhegov_parse(filename, out_filename=None):
         previous_art = None
         # True if current art has one of definitions without ==<same> marker, i.e. it has default form as well as 'same' form
         art_seen_default = False
+        same = None
 
         def add_article(_art, _same):
             ambiguity_count = 0
@@ -621,22 +1330,11 @@ def ozhegov_parse(filename, out_filename=None):
 
             return ambiguity_count
 
-        for line in f:
-            line = line.strip().decode('cp1251').lower()
-            if line:
-                # "сочник|||||== сочень <...mess...>||" - need a title in zero field and '== <ref>' in 5th field.
-                # After <ref> token might be a mess, parse first token only
-                fields = line.split(u'|')
-                if len(fields) < 6:
-                    continue
-                art = fields[0].strip()
-
-                pymorph = _ensure_pymorphy()
-                if pymorph.word_is_known(art):
-                    if {'NOUN'} not in pymorph.tag(art)[0]:
-                        # Use NOUNs only
-                        continue
-
+        chunks = (list(itertools.islice(f, chunk_size)) for _ in itertools.count())
+        chunks = itertools.takewhile(bool, chunks)
+        for chunk_lines in map_chunks(_ozhegov_parse_chunk, chunks, processes=processes,
+                                     initializer=word_morphology_worker_init):
+            for art, (def_kind, same_def) in chunk_lines:
                 if previous_art != art:
                     # New article started. Check previous for ambiguity
                     if previous_art is not None and previous_art in ozhegov_dict and art_seen_default:
@@ -648,19 +1346,13 @@ def ozhegov_parse(filename, out_filename=None):
 
                 art_count += 1
 
-                m = re.search('^[<=]=((?:\s+[%s]+)+)' % RE_RUSSIAN_CHAR_SET, fields[5], re.U)
-                if m:
-                    m = re.findall('\s+([%s]+)' % RE_RUSSIAN_CHAR_SET, m.group(1), re.U)
-                    if len(m) > 1 or 'в старину' in fields[4].lower():
-                        # Ignore multi-word definitions as well as ancient word forms.
-                        continue
-                    if pymorph.word_is_known(m[0]):
-                        norm = get_word_normal_form(m[0], use_external_word_forms_dict=False)
-                        if {'NOUN'} in pymorph.tag(norm)[0]:
-                            same = norm
-                else:
+                if def_kind == OZHEGOV_SKIP:
+                    continue
+                elif def_kind == OZHEGOV_DEFAULT:
                     art_seen_default = True
                     same = None
+                elif def_kind == OZHEGOV_SAME:
+                    same = same_def
 
                 if art and same and art != same:
                     total_ambiguity_count += add_article(art, same)
@@ -668,6 +1360,7 @@ def ozhegov_parse(filename, out_filename=None):
         print()
         print("Parsed %d terms of %d articles. Found %d ambiguities" %
               (len(ozhegov_dict), art_count, total_ambiguity_count))
+        _print_parse_throughput(art_count, start_time)
 
     if out_filename:
         from datetime import datetime
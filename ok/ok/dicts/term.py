@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, unicode_literals
+from array import array
+from bisect import bisect_left
 from collections import defaultdict, namedtuple, OrderedDict, deque
 from functools import wraps
+import os
 import re
+import threading
 import dawg
+import heapq
 import itertools
 
 from ok.dicts.russian import get_word_normal_form, is_known_word, is_simple_russian_word, RE_WORD_OR_NUMBER_CHAR_SET
-from ok.utils import EventfulDict, to_str, checksum
+from ok.dicts.term_snapshot import TermDictSnapshot, TermSnapshotException, write_snapshot, \
+    WORD_FORMS_NONE, WORD_FORMS_CACHED, WORD_FORMS_NO_CACHE
+from ok.utils import EventfulDict, to_str, checksum, resident_memory
 
 TYPE_TERM_PROPOSITION_LIST = (u'в', u'во', u'с', u'со', u'из', u'для', u'и', u'на', u'без', u'к', u'не', u'де', u'по', u'под')
 TYPE_TERM_PROPOSITION_AND_WORD_LIST = (u'со',)
@@ -54,15 +61,35 @@ def context_aware(func):
             context_key = context.call_key(func_idx, term.term_id)
             result = context.cached_result(context_key)
             if result is None:
+                global_key = None
+                if context_result_cache.max_size and not context._marked_as_self and context.is_resolution_tracked():
+                    # Top level call result depends on context terms and previous calls in it only and may be shared
+                    # between contexts with the same resolution state. Nested calls depend on resolution in progress
+                    # (see mark_self()) and are cached in this context only
+                    extra_args = args[1:] if 'context' in kwargs else args[2:]
+                    global_key = context_result_cache.make_key(func_idx, term.term_id, context.resolution_state(),
+                                                               extra_args, kwargs)
+                    cached = context_result_cache.get(global_key)
+                    if cached is not None:
+                        context.advance_resolution_state(global_key)
+                        return context.apply_cached(context_key, cached)
+                    context.start_call_log()
                 context.mark_self(context_key)
                 try:
                     result = func(*args, **kwargs)
                     context.cache_result(context_key, result)
+                    if global_key is not None:
+                        context_result_cache.put(global_key, result, None, *context.stop_call_log())
                 except ContextRequiredTypeTermException as cre:
                     context.cache_exception(context_key, cre)
+                    if global_key is not None:
+                        context_result_cache.put(global_key, None, cre, *context.stop_call_log())
                     raise
                 finally:
                     context.unmark_self(context_key)
+                    if global_key is not None:
+                        context.stop_call_log()
+                        context.advance_resolution_state(global_key)
             return result
         return func(*args, **kwargs)
 
@@ -72,58 +99,112 @@ def context_aware(func):
 
 class TypeTermDict(object):
     # Terms storage and dict. It should not be used directly and work through TypeTerm decorator methods.
+    # Thread safety: all reads (by id, by string, by prefix) are lock-free. New terms registration and lazy terms
+    # creation are serialized by lock. Writers publish new term in index before it can be found by string, hence,
+    # if reader has found term id it always can get term by this id.
+    # Committed terms are kept in two layers: immutable base DAWG and small delta (dict + sorted keys) with terms
+    # committed by update_dawg() since last compaction. Delta is merged into base when it grows over threshold.
+
+    # Delta is compacted when it has more terms than max(min size, ratio * base DAWG size)
+    delta_compact_min_size = 1000
+    delta_compact_ratio = 0.25
 
     def __init__(self):
+        self.__lock = threading.RLock()
+
         self.__terms = defaultdict(set)
         """@type: dict of (unicode, int)"""
 
         self.__terms_dawg = dawg.BytesDAWG()
         self.__terms_dawg_checksum = None
+        self.__terms_dawg_size = 0
+
+        self.__delta = {}
+        """@type: dict of (unicode, int)"""
+        self.__delta_keys = []
+        """@type: list[unicode]"""
+
+        # Index of simple (not compound) terms of base DAWG for search by prefix. It is built on first request for
+        # current DAWG: (base DAWG, simple terms DAWG with term ids, counts of simple terms by all their prefixes).
+        # It is built and dropped under lock and published by one assignment, so, readers take it lock-free
+        self.__simple_index = None
 
         self.__terms_idx = [None] * 10000
         """@type: list[unicode]"""
         self.__next_idx = 1  # 0 is not used to avoid matching with None
 
+        # Snapshot of lazy loaded dict. Terms from snapshot are created in index on first access only
+        self.__snapshot = None
+        """@type: TermDictSnapshot"""
+        # Lazy terms are being restored now. They are published in index when all of them are restored
+        self.__restoring = {}
+        """@type: dict of (int, TypeTerm)"""
+
     def __term_to_idx(self, term):
-        # Naive non-thread safe realization
         # If int - Tuple unfolding - referenced directly to indexes. Just return it
         if isinstance(term, int):
             idx = term
         elif isinstance(term, TypeTerm):
             idx = self.find_id_by_unicode(term)
             if idx is None:
-                idx = self.__next_idx
-                self.__terms_idx[idx] = term
-                self.__terms[term] = idx
-                self.__next_idx += 1
-                if self.__next_idx == len(self.__terms_idx):
-                    # Extend index storage
-                    new_idx = [None] * (int(len(self.__terms_idx) * 1.75))
-                    new_idx[:len(self.__terms_idx)] = self.__terms_idx[:]
-                    self.__terms_idx = new_idx
+                with self.__lock:
+                    # Check again - the same term could be registered by another thread while waiting for lock
+                    idx = self.find_id_by_unicode(term)
+                    if idx is None:
+                        idx = self.__next_idx
+                        if idx == len(self.__terms_idx):
+                            # Extend index storage. Readers may use old list still - it has all published terms
+                            new_idx = [None] * (int(len(self.__terms_idx) * 1.75))
+                            new_idx[:len(self.__terms_idx)] = self.__terms_idx[:]
+                            self.__terms_idx = new_idx
+                        # Order matters for lock-free readers: term id, index, next id and only then search by string
+                        term._term_id = idx
+                        self.__terms_idx[idx] = term
+                        self.__next_idx += 1
+                        self.__terms[term] = idx
         else:
             raise Exception("Only TypeTerms or int are accepted but %s is given" % type(term))
         return idx
 
     def find_id_by_unicode(self, term_str):
         term_str_uni = to_str(term_str)
-        dawg_id_list = self.__terms_dawg.get(term_str_uni)
-        term_id = self.__terms.get(term_str_uni) if not dawg_id_list else int(dawg_id_list[0])
+        # Look in non-dawg terms first. update_dawg() and compact() fill next layer before clear of previous one,
+        # so, term is always found
+        term_id = self.__terms.get(term_str_uni)
+        if term_id is None:
+            term_id = self.__delta.get(term_str_uni)
+        if term_id is None:
+            dawg_id_list = self.__terms_dawg.get(term_str_uni)
+            term_id = int(dawg_id_list[0]) if dawg_id_list else None
         return term_id
 
     def clear(self):
-        self.__terms = defaultdict(set)
-        self.__terms_dawg = dawg.BytesDAWG()
-        self.__terms_dawg_checksum = None
-        self.__terms_idx = [None] * 10000
-        self.__next_idx = 1
-
-    def update_dawg(self, skip_word_forms_validation=False):
+        with self.__lock:
+            self.__terms = defaultdict(set)
+            self.__terms_dawg = dawg.BytesDAWG()
+            self.__terms_dawg_checksum = None
+            self.__terms_dawg_size = 0
+            self.__delta = {}
+            self.__delta_keys = []
+            self.__simple_index = None
+            self.__terms_idx = [None] * 10000
+            self.__next_idx = 1
+            if self.__snapshot is not None:
+                self.__snapshot.close()
+                self.__snapshot = None
+        # Term ids are reused after clear. Drop all indexes by term id
+        context_result_cache.clear()
+        term_compatibility.clear()
+        ContextDependentTypeTerm.drop_ctx_triggers_index()
+
+    def update_dawg(self, skip_word_forms_validation=False, compact=False):
         """
-        Convert __terms dict to DAWG and clear. Search by prefixes can be used in DAWG only.
-        All new terms will be saved in __terms only and not searchable by prefixes until next update_dawg()
+        Commit __terms dict to delta layer and clear. Search by prefixes can be used in committed terms only.
+        All new terms will be saved in __terms only and not searchable by prefixes until next update_dawg().
+        Delta is merged into DAWG if it is too big (see compact())
         @param bool skip_word_forms_validation: if True, do not invalidate all word_forms. Use this if absolutely
                     confident that all word_forms are already loaded to term dict
+        @param bool compact: if True, merge delta into DAWG regardless of its size
         """
         if not skip_word_forms_validation:
             count_wf = 0
@@ -141,23 +222,49 @@ class TypeTermDict(object):
                     seen_set.add(term_str)
                 key_set = set(self.__terms.keys())
 
-        # noinspection PyCompatibility
-        new_dawg = dawg.BytesDAWG((to_str(k), bytes(v)) for k, v in
-                                  itertools.chain(self.__terms_dawg.iteritems(), self.__terms.viewitems()))
-        assert len(new_dawg.keys()) == len(self.__terms.keys()) + len(self.__terms_dawg.keys()), \
-            "DAWG does not match to terms dict!"
-        self.__terms_dawg = new_dawg
-        self.__terms_dawg_checksum = self._terms_dawg_checksum(new_dawg)
-        self.__terms.clear()
+        with self.__lock:
+            new_keys = sorted(to_str(k) for k in self.__terms.keys())
+            # Delta dict is updated in place (readers use get() only), sorted keys are replaced as a whole
+            self.__delta.update((k, self.__terms[k]) for k in new_keys)
+            self.__delta_keys = list(heapq.merge(self.__delta_keys, new_keys))
+            self.__terms.clear()
+            if compact or len(self.__delta) > max(self.delta_compact_min_size,
+                                                  self.delta_compact_ratio * self.__terms_dawg_size):
+                self.compact()
 
         # TODO: invalidate PrefixTypeTerms, i.e. check they are still valid PrefixTypeTerm.
         # To pass full check they have to be recreated and converted to simple type if required
-        assert not any(isinstance(self.get_by_unicode(key), PrefixTypeTerm) for key in self.__terms_dawg.keys()), \
+        # Terms were in dawg before have been checked already. Do not touch them to keep lazy loaded terms untouched
+        assert not any(isinstance(self.get_by_unicode(key), PrefixTypeTerm) for key in new_keys), \
             "TODO: INVALIDATE Prefix Types before merge them to DAWG"
 
+    def compact(self):
+        """
+        Merge delta layer into DAWG. It costs full DAWG rebuild, so, it is done rarely by update_dawg() or when
+        complete DAWG is required (checksum, save)
+        """
+        with self.__lock:
+            if not self.__delta:
+                return
+            # noinspection PyCompatibility
+            new_dawg = dawg.BytesDAWG((k, bytes(v)) for k, v in
+                                      itertools.chain(self.__terms_dawg.iteritems(), self.__delta.viewitems()))
+            new_size = len(new_dawg.keys())
+            assert new_size == self.__terms_dawg_size + len(self.__delta), "DAWG does not match to terms dict!"
+            self.__terms_dawg = new_dawg
+            self.__terms_dawg_checksum = None
+            self.__terms_dawg_size = new_size
+            self.__simple_index = None
+            self.__delta_keys = []
+            self.__delta = {}
+
+    def delta_size(self):
+        return len(self.__delta)
+
     def dawg_checksum(self, core_only=False):
         if not core_only and self.__terms:
             raise TypeTermException("DAWG was dynamically updated. Use update_dawg() first to persist terms")
+        self.compact()
 
         dawg_checksum = self.__terms_dawg_checksum
         if dawg_checksum is not None:
@@ -169,6 +276,14 @@ class TypeTermDict(object):
 
     @classmethod
     def dawg_checksum_in_file(cls, dawg_filename):
+        """
+        Checksum of dawg saved in file. It is cached in baseline manifest until file is changed
+        """
+        from ok.dicts.manifest import cached_file_hash
+        return cached_file_hash(dawg_filename, 'dawg_checksum', cls._dawg_file_checksum)
+
+    @classmethod
+    def _dawg_file_checksum(cls, dawg_filename):
         dawg_in_file = dawg.BytesDAWG()
         dawg_in_file.load(dawg_filename)
         return cls._terms_dawg_checksum(dawg_in_file)
@@ -178,9 +293,12 @@ class TypeTermDict(object):
         return checksum(dawg_obj.write)
 
     # noinspection PyCompatibility
-    def ensure_loaded(self, dawg_filename=None, dawg_checksum=None):
+    def ensure_loaded(self, dawg_filename=None, dawg_checksum=None, lazy=False):
+        """
+        @param bool lazy: see from_snapshot()
+        """
         if dawg_checksum is None:
-            loaded = next(self.__terms_dawg.iterkeys(), None) is not None
+            loaded = self.__terms_dawg_size > 0 or bool(self.__delta)
         else:
             loaded = dawg_checksum == self.dawg_checksum(core_only=True)
         if not loaded:
@@ -189,7 +307,7 @@ class TypeTermDict(object):
                 config = main_options([])
                 dawg_filename = config.term_dict
 
-            self.from_file(dawg_filename, required_checksum=dawg_checksum)
+            self.from_file(dawg_filename, required_checksum=dawg_checksum, lazy=lazy)
 
         return self
 
@@ -201,7 +319,70 @@ class TypeTermDict(object):
         @param int term_id: Term ID
         @rtype: TypeTerm|None
         """
-        return self.__terms_idx[term_id] if 0 < term_id < self.__next_idx else None
+        if not 0 < term_id < self.__next_idx:
+            return None
+        term = self.__terms_idx[term_id]
+        if term is None and self.__snapshot is not None:
+            with self.__lock:
+                term = self.__terms_idx[term_id]
+                if term is None:
+                    term = self.__restore_term(term_id)
+        return term
+
+    @staticmethod
+    def __make_term_from_snapshot(term_id, snapshot):
+        term_cls = SNAPSHOT_TERM_CLASSES[snapshot.term_class_code(term_id)]
+        return unicode.__new__(term_cls, snapshot.term_str(term_id))
+
+    def __restore_term(self, term_id):
+        # Must be called under lock. Terms being restored can refer to each other, thus, they are kept aside and
+        # published in index all together when the first one is done. Other threads never see half-restored terms.
+        term = self.__restoring.get(term_id)
+        if term is not None:
+            return term
+        is_first = not self.__restoring
+        term = self.__restoring[term_id] = self.__make_term_from_snapshot(term_id, self.__snapshot)
+        try:
+            term._restore(term_id, self.__snapshot, self)
+            if is_first:
+                for restored_id, restored_term in self.__restoring.viewitems():
+                    self.__terms_idx[restored_id] = restored_term
+        finally:
+            if is_first:
+                self.__restoring.clear()
+        return term
+
+    def is_lazy(self):
+        return self.__snapshot is not None
+
+    def snapshot_word_forms(self, term_id, snapshot):
+        """
+        Word forms of term saved in snapshot. Result has the same format as TypeTerm._word_forms
+        @rtype: list[TypeTerm|unicode]|None
+        """
+        word_forms_state = snapshot.word_forms_state(term_id)
+        if word_forms_state == WORD_FORMS_CACHED:
+            return [self.get_by_id(wf_id) for wf_id in snapshot.word_form_ids(term_id)]
+        elif word_forms_state == WORD_FORMS_NO_CACHE:
+            return [u'__nocache__']
+        return None
+
+    def precomputed_word_forms(self, term_id):
+        """
+        Context-free word forms of lazy loaded term precomputed at dict build time. They do not require morphology.
+        @rtype: list[TypeTerm|unicode]|None
+        @return: None if dict is not lazy or word forms have not been saved in snapshot
+        """
+        snapshot = self.__snapshot
+        if snapshot is None or not 0 < term_id <= snapshot.max_id:
+            return None
+        return self.snapshot_word_forms(term_id, snapshot)
+
+    def count_materialized(self):
+        """
+        Count terms created in index. For lazy loaded dict it is terms have been accessed only
+        """
+        return sum(1 for term in self.__terms_idx if term is not None)
 
     def get_max_id(self):
         return self.__next_idx - 1
@@ -224,16 +405,34 @@ class TypeTermDict(object):
                         complicated
         @rtype: list[TypeTerm]
         """
-        keys = self.__terms_dawg.keys(to_str(prefix))
         if not_compound:
-            keys = [k for k in keys if not CompoundTypeTerm.is_valid_term_for_type(k)]
-        return [term for key in keys if return_self or key != prefix
-                for term in [self.get_by_unicode(key)] if not not_compound or not isinstance(term, CompoundTypeTerm)]
+            return map(self.get_by_id, self.find_ids_by_unicode_prefix(prefix, return_self=return_self))
+        prefix = to_str(prefix)
+        return [self.get_by_unicode(key) for key in self.__committed_keys(prefix) if return_self or key != prefix]
+
+    def find_ids_by_unicode_prefix(self, prefix, return_self=True):
+        """
+        Find ids of simple (not compound) terms with specified prefix in key order. No terms are created.
+        NOTE: dawg must be updated before with terms to find.
+        @param unicode|TypeTerm prefix: prefix string
+        @param bool return_self: if False do not return term with name equal prefix, only longer terms
+        @rtype: list[int]
+        """
+        prefix = to_str(prefix)
+        delta_items = self.__delta_simple_items(prefix)
+        terms_dawg = self.__terms_dawg
+        simple_dawg, _ = self.__ensure_simple_index(terms_dawg)
+        items = simple_dawg.items(prefix)
+        if delta_items:
+            items.extend((key, term_id) for key, term_id in delta_items if key not in terms_dawg)
+            items.sort()
+        return [term_id for key, term_id in items if return_self or key != prefix]
 
     def count_terms_with_prefix(self, prefix, count_self=True, not_compound=True):
         """
         Count terms with specified prefix. NOTE: dawg must be updated before with terms to find.
         If prefix is existing term it will be counted as well except count_self=False is specified.
+        Simple terms are counted by prefix counts table, i.e. without iteration over keys
         @param unicode|TypeTerm prefix: prefix string
         @param bool count_self: if False do not count term with name equal prefix, only longer terms are counted
         @param bool not_compound: Do not count compound terms by default because their string representation is
@@ -241,29 +440,206 @@ class TypeTermDict(object):
         @rtype: int
         """
         key = to_str(prefix)
-        prefixed_keys = self.__terms_dawg.keys(key)
-        if not_compound:
-            prefixed_keys = [k for k in prefixed_keys if not CompoundTypeTerm.is_valid_term_for_type(k)]
-        return len(prefixed_keys) - (1 if not count_self and key in self.__terms_dawg else 0)
+        if not not_compound:
+            prefixed_count = len(self.__committed_keys(key))
+        else:
+            delta_items = self.__delta_simple_items(key)
+            terms_dawg = self.__terms_dawg
+            _, prefix_counts = self.__ensure_simple_index(terms_dawg)
+            prefixed_count = prefix_counts.get(key, 0)
+            if delta_items:
+                prefixed_count += sum(1 for k, _ in delta_items if k not in terms_dawg)
+            if not prefixed_count:
+                return 0
+        # Take delta before DAWG as in __committed_keys()
+        delta = self.__delta
+        terms_dawg = self.__terms_dawg
+        return prefixed_count - (1 if not count_self and (key in terms_dawg or key in delta) else 0)
+
+    def __ensure_simple_index(self, terms_dawg):
+        """
+        @param dawg.BytesDAWG terms_dawg: base DAWG
+        @rtype: (dawg.IntCompletionDAWG, dict of (unicode, int))
+        """
+        simple_index = self.__simple_index
+        if simple_index is None or simple_index[0] is not terms_dawg:
+            with self.__lock:
+                # Check again - the index could be built by another thread while waiting for lock
+                simple_index = self.__simple_index
+                if simple_index is None or simple_index[0] is not terms_dawg:
+                    simple_items = [(key, int(term_id)) for key, term_id in terms_dawg.iteritems()
+                                    if not CompoundTypeTerm.is_valid_term_for_type(key)]
+                    prefix_counts = defaultdict(int)
+                    for key, _ in simple_items:
+                        for i in range(1, len(key) + 1):
+                            prefix_counts[key[:i]] += 1
+                    simple_index = (terms_dawg, dawg.IntCompletionDAWG(simple_items), dict(prefix_counts))
+                    if terms_dawg is self.__terms_dawg:
+                        # Index of DAWG replaced by compaction is used by caller only
+                        self.__simple_index = simple_index
+        return simple_index[1], simple_index[2]
+
+    def __delta_simple_items(self, prefix):
+        # Delta is small and is not indexed. Take its simple keys by bisect. Delta dict is updated in place before
+        # sorted keys and replaced on compaction, so, take it first to find all keys
+        delta = self.__delta
+        delta_keys = self.__delta_keys
+        pos = bisect_left(delta_keys, prefix)
+        if pos == len(delta_keys) or not delta_keys[pos].startswith(prefix):
+            return []
+        return [(key, delta[key]) for key in
+                itertools.takewhile(lambda k: k.startswith(prefix), itertools.islice(delta_keys, pos, None))
+                if key in delta and not CompoundTypeTerm.is_valid_term_for_type(key)]
+
+    def __committed_keys(self, prefix):
+        # Take delta keys before DAWG. If compaction happens in between, delta keys are in DAWG already - skip them
+        delta_keys = self.__delta_keys
+        terms_dawg = self.__terms_dawg
+        keys = terms_dawg.keys(prefix)
+        pos = bisect_left(delta_keys, prefix)
+        if pos < len(delta_keys) and delta_keys[pos].startswith(prefix):
+            for key in itertools.takewhile(lambda k: k.startswith(prefix), itertools.islice(delta_keys, pos, None)):
+                if key not in terms_dawg:
+                    keys.append(key)
+            keys.sort()
+        return keys
 
     def print_stats(self):
-        print('TypeTerm set stats:\r\n\tterms: %d\r\n\tterms(dawg): %d\r\n\tnext term index: %d' %
-              (len(self.__terms), len(self.__terms_dawg.keys()), self.__next_idx))
+        print('TypeTerm set stats:\r\n\tterms: %d\r\n\tterms(dawg): %d\r\n\tterms(delta): %d'
+              '\r\n\tnext term index: %d\r\n\tmaterialized terms: %d%s\r\n\tresident memory: %.1f MB' %
+              (len(self.__terms), self.__terms_dawg_size, len(self.__delta), self.__next_idx, self.count_materialized(),
+               ' (lazy)' if self.__snapshot is not None else '', resident_memory() / 1024.0 / 1024))
 
-    def to_file(self, filename, verbose=False):
+    def to_file(self, filename, verbose=False, with_snapshot=True):
+        """
+        @param bool with_snapshot: if True, save compiled snapshot next to dawg file as well. See to_snapshot()
+        """
         if verbose:
             print("Save current term_dict dawg to file: %s" % filename)
             if self.__terms:
                 print("WARN: Non-dawg dict is NOT empty and will not be saved! Update DAWG first!")
+        self.compact()
         if self.__terms_dawg:
             self.__terms_dawg.save(filename)
+            if with_snapshot and not self.__terms:
+                self.to_snapshot(self.snapshot_filename(filename), verbose=verbose)
         if verbose:
-            print("Dumped %d terms to %s" % (len(self.__terms_dawg.keys()), filename))
+            print("Dumped %d terms to %s" % (self.__terms_dawg_size, filename))
+
+    @staticmethod
+    def snapshot_filename(dawg_filename):
+        return '%s.snapshot' % os.path.splitext(dawg_filename)[0]
 
-    def from_file(self, filename, verbose=False, skip_word_forms_validation=False, required_checksum=None):
+    def to_snapshot(self, filename, verbose=False):
+        """
+        Save compiled snapshot of term dict. Snapshot contains terms dawg and state of every term (type, word forms,
+        sub terms, etc) and can be loaded by from_snapshot() without terms re-creation and word forms validation.
+        Context-free word forms are saved as they are now, thus, update_dawg() with validation should be done before
+        to have all of them precomputed. Terms without saved word forms collect them at runtime as usual
+        """
+        if self.__terms:
+            raise TypeTermException("DAWG was dynamically updated. Use update_dawg() first to persist terms")
+
+        terms = [None]
+        for term_id in range(1, self.__next_idx):
+            term = self.get_by_id(term_id)
+            if type(term) not in SNAPSHOT_TERM_CLASSES:
+                raise TypeTermException("Term of type %s cannot be saved to snapshot: %s" % (type(term), term))
+
+            word_forms = term._persistent_word_forms()
+            if word_forms is None:
+                word_forms_state, word_form_ids = WORD_FORMS_NONE, None
+            elif u'__nocache__' in word_forms:
+                word_forms_state, word_form_ids = WORD_FORMS_NO_CACHE, None
+            else:
+                word_forms_state, word_form_ids = WORD_FORMS_CACHED, [wf.term_id for wf in word_forms]
+            sub_term_ids = [st.term_id for st in term._sub_terms] if isinstance(term, CompoundTypeTerm) else None
+
+            terms.append((term, SNAPSHOT_TERM_CLASSES.index(type(term)), term._is_context_required,
+                          word_forms_state, word_form_ids, sub_term_ids))
+        if self.__terms:
+            raise TypeTermException("New terms appeared during word forms collection. Use update_dawg() first")
+
+        self.compact()
+        write_snapshot(filename, self.__terms_dawg, self.dawg_checksum(),
+                       ContextDependentTypeTerm.ctx_dependent_terms_checksum(), terms)
+        if verbose:
+            print("Saved snapshot of %d terms to %s" % (len(terms) - 1, filename))
+
+    def from_snapshot(self, filename, verbose=False, required_checksum=None, lazy=False):
+        """
+        Load term dict from compiled snapshot (see to_snapshot()). All terms are restored as they were saved.
+        @param int|None required_checksum: if specified, snapshot must be compiled from dawg with the same checksum
+        @param bool lazy: if True, do not create terms on load. Each term is created on first access by id or string.
+                    Snapshot file is kept open (memory mapped) until dict is cleared
+        @raise TypeTermException: if snapshot does not match to required checksum or context dependent definitions
+        """
+        if verbose:
+            print("Load term_dict snapshot from file: %s" % filename)
+            if self.__terms:
+                print("WARN: Non-dawg dict is NOT empty and will be lost!")
+            rss_before = resident_memory()
+        snapshot = TermDictSnapshot(filename)
+        try:
+            if required_checksum is not None and snapshot.dawg_checksum != required_checksum:
+                raise TypeTermException(
+                    "Snapshot '%s' has been compiled from different dawg (required: %d, in snapshot: %d)" %
+                    (filename, required_checksum, snapshot.dawg_checksum))
+            if snapshot.ctx_checksum != ContextDependentTypeTerm.ctx_dependent_terms_checksum():
+                raise TypeTermException(
+                    "Snapshot '%s' has been compiled with different context dependent terms definitions" % filename)
+
+            self.clear()
+            max_id = snapshot.max_id
+            self.__terms_dawg = snapshot.load_dawg()
+            self.__terms_dawg_checksum = snapshot.dawg_checksum
+            self.__terms_dawg_size = len(self.__terms_dawg.keys())
+            self.__terms_idx = [None] * max(len(self.__terms_idx), int((max_id + 2) * 1.75))
+            self.__next_idx = max_id + 1
+
+            if lazy:
+                self.__snapshot = snapshot
+            else:
+                for term_id in range(1, max_id + 1):
+                    self.__terms_idx[term_id] = self.__make_term_from_snapshot(term_id, snapshot)
+                # All terms are in index already, so they can reference each other regardless of ids order
+                for term_id in range(1, max_id + 1):
+                    self.__terms_idx[term_id]._restore(term_id, snapshot, self)
+                snapshot.close()
+        except:
+            if self.__snapshot is snapshot:
+                self.clear()
+            else:
+                snapshot.close()
+            raise
+
+        if verbose:
+            print("Loaded %d terms%s from %s. Resident memory: %.1f MB => %.1f MB" %
+                  (max_id, ' (lazy)' if lazy else '', filename,
+                   rss_before / 1024.0 / 1024, resident_memory() / 1024.0 / 1024))
+
+        return self
+
+    def from_file(self, filename, verbose=False, skip_word_forms_validation=False, required_checksum=None,
+                  use_snapshot=True, lazy=False):
         """
         @param bool skip_word_forms_validation: see description in update_dawg()
+        @param bool use_snapshot: if True and compiled snapshot exists next to dawg file and matches to dawg checksum,
+                    load terms from snapshot
+        @param bool lazy: if snapshot is used, load terms lazily. See from_snapshot()
         """
+        if use_snapshot:
+            snapshot_filename = self.snapshot_filename(filename)
+            if os.path.isfile(snapshot_filename):
+                if required_checksum is None:
+                    required_checksum = self.dawg_checksum_in_file(filename)
+                try:
+                    return self.from_snapshot(snapshot_filename, verbose=verbose, required_checksum=required_checksum,
+                                              lazy=lazy)
+                except (TypeTermException, TermSnapshotException) as e:
+                    if verbose:
+                        print("WARN: Snapshot is ignored: %s" % to_str(e))
+
         if verbose:
             print("Load term_dict dawg from file: %s" % filename)
             if self.__terms:
@@ -271,8 +647,9 @@ class TypeTermDict(object):
         self.clear()
         new_dawg = dawg.BytesDAWG()
         new_dawg.load(filename)
+        from ok.dicts.manifest import cached_file_hash
+        new_checksum = cached_file_hash(filename, 'dawg_checksum', lambda _: self._terms_dawg_checksum(new_dawg))
         if required_checksum is not None:
-            new_checksum = self._terms_dawg_checksum(new_dawg)
             if new_checksum != required_checksum:
                 raise TypeTermException(
                     "Loading term dict from file '%s' was changed and have different checksum than required (required: %d, in file: %d)" %
@@ -287,7 +664,7 @@ class TypeTermDict(object):
             assert term.term_id == term_id
         assert self.__next_idx == term_id + 1, "Internal index does not match to dawg data!"
 
-        self.update_dawg(skip_word_forms_validation=skip_word_forms_validation)
+        self.update_dawg(skip_word_forms_validation=skip_word_forms_validation, compact=True)
 
         try:
             assert list(new_dawg.keys()) == list(self.__terms_dawg.keys()), \
@@ -297,11 +674,13 @@ class TypeTermDict(object):
             print('DAWG diff (new keys appeared during load):')
             print('\r\n'.join(sorted(set(self.__terms_dawg.keys()) - set(new_dawg.keys()))))
             raise
+        # Rebuilt dawg has the same terms with the same ids as in file. Do not serialize it again for checksum
+        self.__terms_dawg_checksum = new_checksum
 
         if verbose:
             if skip_word_forms_validation:
                 print("Word forms invalidation skipped")
-            print("Loaded %d terms from %s" % (len(self.__terms_dawg.keys()), filename))
+            print("Loaded %d terms from %s" % (self.__terms_dawg_size, filename))
 
         return self
 
@@ -356,6 +735,30 @@ class TypeTerm(unicode):
             # Put term to cache and assign id
             self._term_id = self.term_dict.save_term(self)
 
+    def _restore(self, term_id, snapshot, term_dict):
+        """
+        Init term from snapshot instead of __init__(). All referenced terms must be in term_dict already
+        @param int term_id: term id
+        @param TermDictSnapshot snapshot: snapshot
+        @param TypeTermDict term_dict: term dict is being loaded
+        """
+        self._do_not_pair = set()
+        self._always_pair = set()
+
+        # Lazy dict resolves word forms on first use only to avoid creation of all referenced terms.
+        # See TypeTermDict.precomputed_word_forms()
+        self._word_forms = None if term_dict.is_lazy() else term_dict.snapshot_word_forms(term_id, snapshot)
+        self._is_context_required = snapshot.is_context_required(term_id)
+
+        self._term_id = term_id
+
+    def _persistent_word_forms(self):
+        """
+        Context-free word forms to save in snapshot. Format is the same as _word_forms
+        @rtype: list[TypeTerm|unicode]|None
+        """
+        return self._word_forms
+
     def is_new(self):
         return self._term_id is None
 
@@ -435,7 +838,8 @@ class TypeTerm(unicode):
         if not term:
             term = TypeTerm(term_str)
 
-        return term
+        # Another thread could register the same term first. Then both have the same id, but return registered one
+        return TypeTerm.term_dict.get_by_id(term.term_id) or term
 
     def get_main_form(self, context=None):
         """
@@ -474,9 +878,11 @@ class TypeTerm(unicode):
 
     def always_pair(self, *cp):
         self._always_pair.update(cp)
+        term_compatibility.clear()
 
     def do_not_pair(self, *dnp):
         self._do_not_pair.update(dnp)
+        term_compatibility.clear()
 
     @context_aware
     def word_forms(self, context=None, fail_on_context=False):
@@ -488,6 +894,8 @@ class TypeTerm(unicode):
                     if False, return None instead of exception
         @rtype: list[TypeTerm]|None
         """
+        if self._word_forms is None:
+            self._word_forms = self.term_dict.precomputed_word_forms(self._term_id)
         if self._word_forms is None:
             try:
                 result = self._collect_self_word_forms(context=None)
@@ -557,6 +965,38 @@ class TypeTerm(unicode):
         """
         import ok.query as query
         words = query.parse_query(terms_str).tokens
+        return TypeTerm._parse_words(words, TypeTerm.make)
+
+    @staticmethod
+    def parse_term_strings(terms_strs):
+        """
+        Batch version of parse_term_string(). All strings are tokenized first and each unique word (or proposition
+        sequence) of batch is resolved to term once.
+        @param collections.Iterable[unicode|ok.query.tokens.Query] terms_strs: strings of terms
+        @return: list of term ids arrays in order of input strings. Use TypeTerm.get_by_id() to get terms
+        @rtype: list[array.array]
+        """
+        import ok.query as query
+        batch_words = [query.parse_query(terms_str).tokens for terms_str in terms_strs]
+        batch_terms = {}
+        """@type: dict of (unicode, TypeTerm)"""
+
+        def make(term_str):
+            term = batch_terms.get(term_str)
+            if term is None:
+                term = batch_terms[term_str] = TypeTerm.make(term_str)
+            return term
+
+        return [array(str('i'), [term.term_id for term in TypeTerm._parse_words(words, make)])
+                for words in batch_words]
+
+    @staticmethod
+    def _parse_words(words, make):
+        """
+        @param list[unicode] words: query tokens
+        @param (unicode)->TypeTerm make: term factory
+        @rtype: list[TypeTerm]
+        """
         terms = []
         """@type: list[TypeTerm]"""
         buf = u''
@@ -569,7 +1009,7 @@ class TypeTerm(unicode):
                     if TypeTerm.is_proposition_and_word(w):
                         # Some propositions can participate also as words (e.g. when char O is used instead of number 0)
                         # Add such propositions as simple word
-                        terms.append(TypeTerm.make(w))
+                        terms.append(make(w))
                     continue
                 if buf:
                     if w == u'и':
@@ -582,10 +1022,10 @@ class TypeTerm(unicode):
                         buf_count = 0
                         if TypeTerm.is_proposition_and_word(w):
                             # See above comments about dual prop/word cases
-                            terms.append(TypeTerm.make(w))
+                            terms.append(make(w))
                         continue
 
-                    term = TypeTerm.make(u'%s %s' % (buf, w))
+                    term = make(u'%s %s' % (buf, w))
                     buf_count += 1
 
                     if buf_count == 2:
@@ -593,10 +1033,10 @@ class TypeTerm(unicode):
                         buf_count = 0
 
                 if not term:
-                    term = TypeTerm.make(w)
+                    term = make(w)
                 terms.append(term)
         if buf and buf_count == 0:
-            terms.append(TypeTerm.make(buf))
+            terms.append(make(buf))
 
         return list(OrderedDict.fromkeys(terms))  # Filter duplicates
 
@@ -653,6 +1093,12 @@ class CompoundTypeTerm(TypeTerm):
             self._sub_terms = self._make_token_terms(tokens)
         super(CompoundTypeTerm, self).__init__(from_str)
 
+    def _restore(self, term_id, snapshot, term_dict):
+        # Spaced form is not persisted - it is cheap to get it from tokens as it is done in _make_token_terms()
+        self._spaced_form = u' '.join(self._filter_tokens(self._tokenize()))
+        self._sub_terms = [term_dict.get_by_id(sub_term_id) for sub_term_id in snapshot.sub_term_ids(term_id)]
+        super(CompoundTypeTerm, self)._restore(term_id, snapshot, term_dict)
+
     @property
     def sub_terms(self):
         return self._sub_terms[:]
@@ -761,6 +1207,11 @@ class WithPropositionTypeTerm(CompoundTypeTerm):
             self.proposition = None
         super(WithPropositionTypeTerm, self).__init__(from_str)
 
+    def _restore(self, term_id, snapshot, term_dict):
+        # Proposition is set by _filter_tokens()
+        self.proposition = None
+        super(WithPropositionTypeTerm, self)._restore(term_id, snapshot, term_dict)
+
     def _tokenize(self, _=None):
         return super(WithPropositionTypeTerm, self)._tokenize(max_split=1)
 
@@ -915,6 +1366,12 @@ class PrefixTypeTerm(TypeTerm):
 ctx_def = namedtuple('_ctx_def', 'ctx_terms main_form')
 DEFAULT_CONTEXT = u'__default__'
 
+# Reverse index of context maps (see ContextDependentTypeTerm.ctx_triggers_index()):
+#   triggers: trigger term (main form of context term) => list of (context dependent term, main form)
+#   variants: context dependent term => set of its non-default main forms
+#   main_forms: context independent term => its main form. Filled on demand
+CtxTriggersIndex = namedtuple('CtxTriggersIndex', 'triggers variants main_forms')
+
 
 class ContextDependentTypeTerm(TypeTerm):
 
@@ -1078,8 +1535,12 @@ class ContextDependentTypeTerm(TypeTerm):
     # Test definition - is used in smoke tests
     ctx_dependent_terms.update({u'мар': [ctx_def(['йогурт', 'напиток'], 'маракуйя')]})
 
-    ctx_dependent_full_terms = ctx_triggers = None
+    ctx_dependent_full_terms = ctx_triggers = ctx_dependent_prefixes = None
     _last_ctx_dependent_terms_version = ctx_dependent_terms.version - 1
+    _full_term_normal_forms = {}
+    """@type: dict of (unicode, unicode)"""
+    # Incremented when any term learns new context hint. Resolution results depend on learned hints
+    ctx_hints_version = 0
 
     @classmethod
     def ensure_full_terms_index(cls):
@@ -1091,10 +1552,72 @@ class ContextDependentTypeTerm(TypeTerm):
             (ctx.main_form, key.encode('utf-8')) for key, ctx_defs in cls.ctx_dependent_terms.viewitems() for ctx in ctx_defs)
         cls.ctx_triggers = {trigger_term for key, ctx_defs in cls.ctx_dependent_terms.viewitems() for ctx in ctx_defs
                             for trigger_term in ctx.ctx_terms} - {DEFAULT_CONTEXT}
+        cls.ctx_dependent_prefixes = cls._build_prefixes_index()
         cls._last_ctx_dependent_terms_version = cls.ctx_dependent_terms.version
 
+    @classmethod
+    def _build_prefixes_index(cls):
+        """
+        Index of all valid prefixes of full terms to base keys. Prefix is valid if it starts with key, is not a
+        normal form of full term and it is not a key, full term or trigger itself. Normal forms of full terms are
+        calculated once for all versions of definitions
+        @rtype: dawg.BytesDAWG
+        """
+        prefix_keys = defaultdict(set)
+        valid_prefixes = set()
+        for full_term, key in cls.ctx_dependent_full_terms.iteritems():
+            key = key.decode('utf-8')
+            if not full_term.startswith(key):
+                continue
+            normal_form = cls._full_term_normal_forms.get(full_term)
+            if normal_form is None:
+                normal_form = cls._full_term_normal_forms[full_term] = get_word_normal_form(full_term)
+            for i in range(max(len(key), 3), len(full_term) + 1):
+                prefix = full_term[:i]
+                prefix_keys[prefix].add(key)
+                if prefix != normal_form:
+                    valid_prefixes.add(prefix)
+        valid_prefixes -= cls.ctx_triggers
+        return dawg.BytesDAWG((prefix, key.encode('utf-8')) for prefix in valid_prefixes
+                              if prefix not in cls.ctx_dependent_terms and prefix not in cls.ctx_dependent_full_terms
+                              for key in prefix_keys[prefix])
+
     ctx_dependent_terms.after_change(lambda: ContextDependentTypeTerm.ensure_full_terms_index())
 
+    _ctx_triggers_index = None
+    """@type: CtxTriggersIndex"""
+    _ctx_triggers_state = None
+    _ctx_triggers_lock = threading.Lock()
+
+    @classmethod
+    def drop_ctx_triggers_index(cls):
+        with cls._ctx_triggers_lock:
+            cls._ctx_triggers_index = cls._ctx_triggers_state = None
+
+    @classmethod
+    def ctx_triggers_index(cls, terms):
+        """
+        Reverse index of context maps of terms. Terms are added to index on first request and index is dropped when
+        context definitions or term dict are changed
+        @param collections.Iterable[ContextDependentTypeTerm] terms: terms must be in index
+        @rtype: CtxTriggersIndex
+        """
+        with cls._ctx_triggers_lock:
+            state = cls._ctx_triggers_state
+            if state is None or state[0] is not TypeTerm.term_dict or state[1] != cls.ctx_dependent_terms.version:
+                # Readers of old index are not affected
+                cls._ctx_triggers_index = CtxTriggersIndex(defaultdict(list), {}, {})
+                cls._ctx_triggers_state = (TypeTerm.term_dict, cls.ctx_dependent_terms.version)
+            index = cls._ctx_triggers_index
+            for term in terms:
+                if term not in index.variants:
+                    ctx_map = term.get_ctx_map()
+                    for trigger, main_form in ctx_map.viewitems():
+                        if trigger != DEFAULT_CONTEXT:
+                            index.triggers[trigger].append((term, main_form))
+                    index.variants[term] = frozenset(ctx_map.viewvalues()) - {ctx_map.get(DEFAULT_CONTEXT)}
+            return index
+
     _context_log_enabled = False
 
     @classmethod
@@ -1105,27 +1628,45 @@ class ContextDependentTypeTerm(TypeTerm):
     @classmethod
     def is_valid_term_for_prefix(cls, term_str):
         cls.ensure_full_terms_index()
+        return to_str(term_str) in cls.ctx_dependent_prefixes
 
-        if len(term_str) <= 2 or term_str in cls.ctx_dependent_terms or term_str in cls.ctx_dependent_full_terms \
-                or term_str in cls.ctx_triggers:
-            return False
-        # noinspection PyCompatibility
-        found = any(term_str.startswith(key.decode('utf-8')) and term_str != get_word_normal_form(full_term)
-                    for full_term, key in cls.ctx_dependent_full_terms.iteritems(to_str(term_str)))
-        return found
+    @classmethod
+    def ctx_dependent_terms_checksum(cls):
+        import json
+        ctx_definitions = json.dumps(sorted(cls.ctx_dependent_terms.viewitems()), ensure_ascii=True)
+        return checksum(lambda b: b.write(ctx_definitions))
 
     def __init__(self, from_str=''):
         """@param unicode from_str: term string"""
         if self.is_new():
-            self._ctx_map = None
-            """@type: dict of (TypeTerm|unicode, TypeTerm)"""
-            self._last_ctx_dependent_terms_version = self.ctx_dependent_terms.version - 1
-            self._ctx_map_hints = defaultdict(list)
-            """@type: dict of (TypeTerm, list[tuple[TypeTerm])]"""
-            self._context_log = set()
-            self._prefix_base_key = None
+            self._init_ctx_fields()
         super(ContextDependentTypeTerm, self).__init__(from_str)
 
+    def _init_ctx_fields(self):
+        self._ctx_map = None
+        """@type: dict of (TypeTerm|unicode, TypeTerm)"""
+        self._last_ctx_dependent_terms_version = self.ctx_dependent_terms.version - 1
+        self._ctx_map_hints = defaultdict(list)
+        """@type: dict of (TypeTerm, list[tuple[TypeTerm])]"""
+        self._context_log = set()
+        self._prefix_base_key = None
+        # Word forms without context precomputed in snapshot. They are valid for the same context definitions only
+        self._ctx_free_word_forms = None
+        self._ctx_free_word_forms_version = None
+
+    def _restore(self, term_id, snapshot, term_dict):
+        self._init_ctx_fields()
+        super(ContextDependentTypeTerm, self)._restore(term_id, snapshot, term_dict)
+        # Snapshot has been validated against current context definitions on load
+        self._word_forms = None
+        self._ctx_free_word_forms = term_dict.snapshot_word_forms(term_id, snapshot)
+        self._ctx_free_word_forms_version = self.ctx_dependent_terms.version
+
+    def _persistent_word_forms(self):
+        # Context dependent term never caches word forms in _word_forms but context-free result is constant for the
+        # same context definitions
+        return self.word_forms(context=None, fail_on_context=False) or [u'__nocache__']
+
     def get_ctx_map(self):
         """@rtype: dict of (TypeTerm|unicode, TypeTerm)"""
         if self._ctx_map is None or self._last_ctx_dependent_terms_version != self.ctx_dependent_terms.version:
@@ -1180,9 +1721,7 @@ class ContextDependentTypeTerm(TypeTerm):
             if not self.is_prefix():
                 return None
             self.ensure_full_terms_index()
-            # noinspection PyCompatibility
-            keys = [key.decode('utf-8') for full_term, key in self.ctx_dependent_full_terms.iteritems(to_str(self))
-                    if self.startswith(key.decode('utf-8'))]
+            keys = [key.decode('utf-8') for key in self.ctx_dependent_prefixes.get(to_str(self), [])]
             longest_key = None
             for key in sorted(keys):
                 # Keys are different! Assertion fails due to ambiguity
@@ -1254,12 +1793,7 @@ class ContextDependentTypeTerm(TypeTerm):
                         break
 
             if not main_form and context.hints:
-                for ct in context:
-                    for hint in context.hints.get(ct, []):
-                        if all(hint[i] in context for i in range(len(hint)-1)):
-                            if hint[-1] in ctx_map:
-                                self._ctx_map_hints[ct].append(hint)
-                                # print("Ctx_map: %s, %s, %s" % (self, ct, to_str(hint)))
+                self._learn_ctx_hints(context, ctx_map)
 
             if values_variants:
                 for ctx_term in context:
@@ -1319,7 +1853,88 @@ class ContextDependentTypeTerm(TypeTerm):
 
         return main_form
 
+    def _learn_ctx_hints(self, context, ctx_map):
+        for ct in context:
+            for hint in context.hints.get(ct, []):
+                if all(hint[i] in context for i in range(len(hint)-1)):
+                    if hint[-1] in ctx_map and hint not in self._ctx_map_hints[ct]:
+                        self._ctx_map_hints[ct].append(hint)
+                        ContextDependentTypeTerm.ctx_hints_version += 1
+                        # print("Ctx_map: %s, %s, %s" % (self, ct, to_str(hint)))
+
+    def _resolve_by_triggers(self, context, matches, values_variants):
+        """
+        Same as get_main_form() but matches of context terms are found by triggers index already.
+        See TermContext.resolve_all()
+        Only simple cases are resolved here: when result depends on neither other terms resolution nor hints
+        @param TermContext context: term context
+        @param list[tuple] matches: (context term, trigger, main form) of this term in context order
+        @param frozenset values_variants: non-default main forms of this term
+        @rtype: TypeTerm|None
+        @return: None if term cannot be resolved here and get_main_form() must be used
+        """
+        ctx_map = self.get_ctx_map()
+        if not values_variants:
+            # Default definition only
+            main_form = ctx_map.get(DEFAULT_CONTEXT)
+            if main_form and self._context_log_enabled:
+                self._context_log.add(frozenset(context))
+            return main_form
+
+        main_form = None
+        ctx_term_match = trigger_match = None
+        # Context hints are learned by ambiguous terms only (see get_main_form())
+        learn_hints = len(values_variants) > 1
+        values_variants = set(values_variants)
+        if len(values_variants) == 1:
+            # See fast track in get_main_form(). Only context terms which are in context map as is are matched there
+            if self._ctx_map_hints:
+                return None
+            for ctx_term, trigger, ctx_main_form in matches:
+                if trigger is ctx_term:
+                    main_form, ctx_term_match = ctx_main_form, ctx_term
+                    values_variants.pop()
+                    break
+            if not main_form:
+                return None
+        else:
+            for ctx_term, trigger, ctx_main_form in matches:
+                if ctx_term == self:
+                    continue
+                if main_form is None:
+                    if ctx_main_form not in values_variants:
+                        return None
+                    main_form, ctx_term_match, trigger_match = ctx_main_form, ctx_term, trigger
+                    values_variants.remove(main_form)
+                    if not values_variants or ctx_term in context.priority_terms:
+                        break
+                elif ctx_main_form != main_form:
+                    # Too ambiguous. Let get_main_form() raise exception
+                    return None
+
+        if not main_form and not ctx_map.get(DEFAULT_CONTEXT):
+            return None
+
+        if learn_hints and context.hints:
+            self._learn_ctx_hints(context, ctx_map)
+        if not main_form:
+            main_form = ctx_map.get(DEFAULT_CONTEXT)
+        elif not values_variants:
+            context.hint(self, ctx_term_match, main_form)
+            if trigger_match is not None and trigger_match != ctx_term_match:
+                context.hint(self, trigger_match, main_form)
+        if self._context_log_enabled:
+            self._context_log.add(frozenset(context))
+        return main_form
+
     def word_forms(self, context=None, fail_on_context=True):
+        if not context and self._ctx_free_word_forms is not None and \
+                self._ctx_free_word_forms_version == self.ctx_dependent_terms.version:
+            if u'__nocache__' not in self._ctx_free_word_forms:
+                return self._ctx_free_word_forms[:]
+            if fail_on_context:
+                raise ContextRequiredTypeTermException("ContextDependent term must have context: %s" % self)
+            return None
         try:
             main_form = self.get_main_form(context=context)
             collected_forms = []
@@ -1360,6 +1975,11 @@ class ContextDependentTypeTerm(TypeTerm):
                                      else main_form.get_main_form(context=None))
         return list(collected_main_forms)
 
+# Term types can be saved to snapshot. Index in tuple is a type code in snapshot, so new types must be added to the end.
+# PrefixTypeTerm is not here because it is never persisted (see update_dawg())
+SNAPSHOT_TERM_CLASSES = (TypeTerm, CompoundTypeTerm, WithPropositionTypeTerm, AbbreviationTypeTerm, TagTypeTerm,
+                         ContextDependentTypeTerm)
+
 
 class TermContext(deque):
 
@@ -1375,6 +1995,16 @@ class TermContext(deque):
         self.result_cache = dict()
         """@type dict of (int, Any)"""
         self._cache_stamp = 0
+        # Hints and results cached by top level @context_aware call including nested ones. They are replayed when its
+        # result is taken from global cache
+        self._hint_log = None
+        self._result_log = None
+        # Result of resolve_all()
+        self._resolved = None
+        # Id of terms and top level calls history of context. See resolution_state()
+        self._resolution_state = None
+        self._resolution_len = 0
+        self._resolution_tracked = True
 
         self.hints = defaultdict(list)
         """@type dict of (TypeTerm, list[tuple[TypeTerm])]"""
@@ -1383,6 +2013,8 @@ class TermContext(deque):
             if isinstance(iterable, TermContext):
                 self.not_a_terms |= iterable.not_a_terms
                 self.result_cache = iterable.result_cache
+                # Shared result cache is changed by calls in both contexts, so their history is not known anymore
+                self._resolution_tracked = iterable._resolution_tracked = False
                 self.priority_terms = set(iterable.priority_terms)
                 self._marked_as_self = set(iterable._marked_as_self)
                 # All terms were already prepared in original term context
@@ -1456,6 +2088,7 @@ class TermContext(deque):
             if getattr(result, '__cache_stamp', -1) < self._cache_stamp:
                 # New keys has been added to cache - need to refresh ones raised context exceptions
                 self.result_cache[context_key] = None
+                self._log_result(context_key, None)
                 result = None
             else:
                 raise result
@@ -1464,19 +2097,361 @@ class TermContext(deque):
     def cache_result(self, context_key, result):
         self._cache_stamp += 1
         self.result_cache[context_key] = result
+        self._log_result(context_key, result)
 
     def cache_exception(self, context_key, exc):
         setattr(exc, '__cache_stamp', self._cache_stamp)
         self.result_cache[context_key] = exc
+        self._log_result(context_key, exc)
+
+    def _log_result(self, context_key, result):
+        if self._result_log is not None:
+            self._result_log.append((context_key, result[:] if isinstance(result, list) else result,
+                                     self._cache_stamp))
+
+    def resolve_all(self):
+        """
+        Resolve main forms of all context dependent terms in context in one pass over context terms using triggers
+        index (see ContextDependentTypeTerm.ctx_triggers_index()). Results are cached in context, thus, all further
+        get_main_form() and word_forms() calls with this context take them from cache. Terms which cannot be resolved
+        by index only (e.g. their triggers depend on other ambiguous terms) are not touched here and resolved by
+        get_main_form() on demand as usual. It keeps order of nested resolutions the same as without this call.
+        @rtype: dict of (ContextDependentTypeTerm, TypeTerm)
+        @return: main forms of terms resolved by index
+        """
+        if self._resolved is not None:
+            return self._resolved
+        ctx_terms = []
+        for t in self:
+            if isinstance(t, ContextDependentTypeTerm) and t not in ctx_terms:
+                ctx_terms.append(t)
+        if not ctx_terms:
+            self._resolved = {}
+            return self._resolved
+        resolution_state = self.resolution_state() \
+            if self._resolution_tracked and not self._marked_as_self and context_result_cache.max_size else None
+        index = ContextDependentTypeTerm.ctx_triggers_index(ctx_terms)
+        triggers = index.triggers
+        # Main forms of context terms are matched for terms with many variants only (see get_main_form())
+        need_main_forms = any(len(index.variants[t]) > 1 for t in ctx_terms)
+
+        # Single pass over context. Trigger is context term itself or its main form
+        matches = defaultdict(list)
+        """@type: dict of (ContextDependentTypeTerm, list[tuple])"""
+        static_context = True
+        for ctx_term in self:
+            ctx_term_matches = triggers.get(ctx_term)
+            if ctx_term_matches:
+                for term, main_form in ctx_term_matches:
+                    matches[term].append((ctx_term, ctx_term, main_form))
+            if not need_main_forms or not isinstance(ctx_term, TypeTerm) or \
+                    isinstance(ctx_term, ContextDependentTypeTerm):
+                continue
+            ctx_term_main_form = index.main_forms.get(ctx_term)
+            if ctx_term_main_form is None:
+                ctx_term_main_form = index.main_forms[ctx_term] = \
+                    ctx_term.get_main_form(context=None) if not ctx_term.is_context_required() else False
+            if ctx_term_main_form is False:
+                static_context = False
+            elif ctx_term_main_form != ctx_term:
+                for term, main_form in triggers.get(ctx_term_main_form, ()):
+                    if not ctx_term_matches or all(term is not t for t, _ in ctx_term_matches):
+                        matches[term].append((ctx_term, ctx_term_main_form, main_form))
+
+        get_main_form_idx = ContextDependentTypeTerm.get_main_form.context_aware_index
+        result = {}
+        for term in ctx_terms:
+            context_key = self.call_key(get_main_form_idx, term.term_id)
+            main_form = self.result_cache.get(context_key)
+            if isinstance(main_form, ContextRequiredTypeTermException):
+                continue
+            if main_form is None and static_context and not self.is_marked_as_self(context_key):
+                # If other ambiguous term may be resolved to trigger of this term then the order of resolution matters
+                ctx_map = term.get_ctx_map()
+                if len(ctx_terms) == 1 or \
+                        not any(other is not term and any(v in ctx_map for v in other.get_ctx_map().viewvalues())
+                                for other in ctx_terms):
+                    main_form = term._resolve_by_triggers(self, matches.get(term, []), index.variants[term])
+                    if main_form is not None:
+                        self.cache_result(context_key, main_form)
+            if main_form is not None:
+                result[term] = main_form
+        self._resolved = result
+        if resolution_state is not None:
+            self.advance_resolution_state((resolution_state, 'resolve_all'))
+        return result
+
+    def signature(self):
+        """
+        Context state affecting result of @context_aware methods before any call. See resolution_state()
+        """
+        return (tuple(self), frozenset(self.priority_terms), frozenset(self.not_a_terms),
+                tuple(sorted((term, tuple(hints)) for term, hints in self.hints.viewitems() if hints)))
+
+    def is_resolution_tracked(self):
+        return self._resolution_tracked
+
+    def resolution_state(self):
+        """
+        Id of context signature and all top level calls made in context since. Result of next top level call is the
+        same in all contexts with the same state id and the same learned hints, so, it is a key of ContextResultCache.
+        Signature is computed once, terms appended later are added to state as a step.
+        @rtype: int
+        """
+        if self._resolution_state is None:
+            self._resolution_state = context_result_cache.resolution_state((None, self.signature()))
+            self._resolution_len = len(self)
+        elif len(self) != self._resolution_len:
+            new_terms = tuple(self)[self._resolution_len:]
+            self._resolution_state = context_result_cache.resolution_state((self._resolution_state, new_terms))
+            self._resolution_len = len(self)
+        return self._resolution_state
+
+    def advance_resolution_state(self, step):
+        """
+        @param tuple step: top level call key made with current resolution_state()
+        """
+        self._resolution_state = context_result_cache.resolution_state(step)
+
+    def start_call_log(self):
+        self._hint_log = []
+        self._result_log = []
+
+    def stop_call_log(self):
+        """
+        @rtype: (tuple, tuple)
+        @return: hints and results cached in context since start_call_log()
+        """
+        hint_log, result_log = self._hint_log, self._result_log
+        self._hint_log = self._result_log = None
+        return tuple(hint_log or ()), tuple(result_log or ())
+
+    def apply_cached(self, context_key, cached):
+        """
+        Apply result of the same call in another context with the same resolution state
+        @param ContextResultCache.Entry cached: global cache entry
+        """
+        for hint_args in cached.hints:
+            self.hint(*hint_args)
+        # Nested calls results are used by next calls in this context. Cache stamps are the same in both contexts
+        for key, result, cache_stamp in cached.results:
+            self.result_cache[key] = result[:] if isinstance(result, list) else result
+            self._cache_stamp = cache_stamp
+        if cached.exception is not None:
+            raise cached.exception
+        return self.result_cache[context_key]
 
     def hint(self, term, ctx_term_match, main_form, hint_match=None):
         # print("Hint: %s, %s, %s, %s" % (term, ctx_term_match, main_form, to_str(hint_match)))
+        if self._hint_log is not None:
+            self._hint_log.append((term, ctx_term_match, main_form, hint_match))
         if hint_match:
             self.hints[term].append(tuple([ctx_term_match] + list(hint_match[:-1]) + [main_form]))
         else:
             self.hints[term].append((ctx_term_match, main_form))
 
 
+class ContextResultCache(object):
+    """
+    Process-wide LRU cache of top level @context_aware calls results. Key is (context resolution state, learned hints
+    version, method, term id, other call arguments), so, result computed in one context is reused in any other context
+    with the same terms and the same previous calls (see TermContext.resolution_state()).
+    Cache is dropped when context dependent terms definitions or term dict are changed.
+    """
+    Entry = namedtuple('ContextResultCacheEntry', 'result exception hints results')
+
+    def __init__(self, max_size=100000):
+        """
+        @param int max_size: max number of cached results. 0 disables cache
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        """@type: dict of (tuple, ContextResultCache.Entry)"""
+        self.__state = None
+        # Ids are never reused, thus, stale id of context cannot match entries of another resolution state
+        self.__resolution_states = {}
+        """@type: dict of (tuple, int)"""
+        self.__resolution_state_ids = itertools.count(1)
+
+    @staticmethod
+    def make_key(func_idx, term_id, resolution_state, extra_args, kwargs):
+        """
+        @param int resolution_state: call context resolution state. See TermContext.resolution_state()
+        """
+        return (resolution_state, ContextDependentTypeTerm.ctx_hints_version, func_idx, term_id, tuple(extra_args),
+                tuple(sorted((k, v) for k, v in kwargs.viewitems() if k != 'context')))
+
+    def resolution_state(self, step):
+        """
+        @param tuple step: (None, context signature) for initial state or (previous state id, call) for next one
+        @rtype: int
+        """
+        with self.__lock:
+            self.__ensure_state()
+            state_id = self.__resolution_states.get(step)
+            if state_id is None:
+                if len(self.__resolution_states) >= self.max_size:
+                    self.__resolution_states.clear()
+                state_id = self.__resolution_states[step] = next(self.__resolution_state_ids)
+            return state_id
+
+    @staticmethod
+    def __current_state():
+        return TypeTerm.term_dict, ContextDependentTypeTerm.ctx_dependent_terms.version
+
+    def __ensure_state(self):
+        # Must be called under lock
+        state = self.__current_state()
+        if self.__state is None or self.__state[0] is not state[0] or self.__state[1] != state[1]:
+            self.__entries.clear()
+            self.__resolution_states.clear()
+            self.__state = state
+
+    def get(self, key):
+        """@rtype: ContextResultCache.Entry|None"""
+        if not self.max_size:
+            return None
+        with self.__lock:
+            self.__ensure_state()
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.__entries[key] = entry
+            return entry
+
+    def put(self, key, result, exception, hints, results):
+        """
+        @param tuple hints: hints made by call. See TermContext.stop_call_log()
+        @param tuple results: results cached in context by call and its nested calls
+        """
+        if not self.max_size:
+            return
+        with self.__lock:
+            self.__ensure_state()
+            self.__entries.pop(key, None)
+            self.__entries[key] = self.Entry(result[:] if isinstance(result, list) else result, exception, hints,
+                                             results)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__resolution_states.clear()
+            self.__state = None
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self):
+        """@rtype: dict of (unicode, int)"""
+        return {'size': len(self.__entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+
+context_result_cache = ContextResultCache()
+
+
+class TermCompatibilityIndex(object):
+    """
+    Process-wide index for TypeTerm.is_compatible_with(). For each context-free term it keeps ids of all terms it
+    cannot pair with (own word forms and word forms of sub-terms) and propositions of proposition terms. Thus, check
+    is an integer set lookup. Context dependent terms and terms with always_pair/do_not_pair overrides are checked by
+    is_compatible_with() itself. Index is dropped when context dependent terms definitions or term dict are changed.
+    Reads are lock-free: terms are added to index by single dict assignment and result for term is always the same.
+    """
+    # Term entry: ids of incompatible terms and propositions of term and its sub-terms
+    Entry = namedtuple('TermCompatibilityEntry', 'incompatible_ids propositions')
+    NO_ENTRY = Entry(None, None)
+
+    def __init__(self):
+        self.__entries = {}
+        """@type: dict of (int, TermCompatibilityIndex.Entry)"""
+        self.__term_dict = None
+        self.__version = None
+
+    def __ensure_state(self):
+        if self.__term_dict is not TypeTerm.term_dict or \
+                self.__version != ContextDependentTypeTerm.ctx_dependent_terms.version:
+            self.__entries = {}
+            self.__term_dict = TypeTerm.term_dict
+            self.__version = ContextDependentTypeTerm.ctx_dependent_terms.version
+        return self.__entries
+
+    @classmethod
+    def _make_entry(cls, term):
+        """@rtype: TermCompatibilityIndex.Entry"""
+        incompatible_ids = set()
+        propositions = set()
+        stack = [term]
+        while stack:
+            t = stack.pop()
+            if t.term_id is None or t._always_pair or t._do_not_pair or t.is_context_required():
+                return cls.NO_ENTRY
+            incompatible_ids.add(t.term_id)
+            for word_form in t.word_forms(context=None, fail_on_context=True):
+                word_form_id = getattr(word_form, 'term_id', None)
+                if word_form_id is None:
+                    return cls.NO_ENTRY
+                incompatible_ids.add(word_form_id)
+            if isinstance(t, WithPropositionTypeTerm):
+                propositions.add(t.proposition)
+            if isinstance(t, CompoundTypeTerm):
+                stack.extend(t.sub_terms)
+        return cls.Entry(frozenset(incompatible_ids), frozenset(propositions))
+
+    def is_compatible(self, term, another_term, context=None):
+        """
+        The same as term.is_compatible_with(another_term, context=context)
+        @param TypeTerm term: term
+        @param TypeTerm another_term: another term
+        @param TermContext|None context: term context
+        @rtype: bool
+        """
+        entries = self.__ensure_state()
+        entry = entries.get(term.term_id)
+        if entry is None:
+            entry = entries[term.term_id] = self._make_entry(term)
+        another_term_id = getattr(another_term, 'term_id', None)
+        if entry.incompatible_ids is None or another_term_id is None:
+            return term.is_compatible_with(another_term, context=context)
+        if another_term_id in entry.incompatible_ids:
+            return False
+        return not (entry.propositions and isinstance(another_term, WithPropositionTypeTerm) and
+                    another_term.proposition in entry.propositions)
+
+    def are_compatible(self, term1, term2, context=None):
+        """Both terms are compatible with each other"""
+        return self.is_compatible(term1, term2, context=context) and self.is_compatible(term2, term1, context=context)
+
+    def clear(self):
+        self.__entries = {}
+        self.__term_dict = None
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+term_compatibility = TermCompatibilityIndex()
+
+
+def main_form_ids(terms, context=None):
+    """
+    Term ids of main forms of terms. If context is not specified terms are used as context of each other. In this case
+    context is made only if some term requires it
+    @param list[TypeTerm] terms: terms
+    @param TermContext|None context: terms context
+    @rtype: array.array
+    """
+    if context is None and any(term.is_context_required() for term in terms):
+        context = TermContext(terms)
+    return array(str('i'), [term.get_main_form(context=context).term_id for term in terms])
+
+
 def print_prefix_word_candidates():
     term_dict = TypeTerm.term_dict
     prefix_terms = {}
@@ -1484,6 +2459,8 @@ def print_prefix_word_candidates():
         term = term_dict.get_by_id(i)
         if len(term) < 2 or type(term) != TypeTerm or not is_simple_russian_word(term):
             continue
+        if not term_dict.count_terms_with_prefix(term, count_self=False):
+            continue
         full_terms = [_t for _t in term_dict.find_by_unicode_prefix(term, return_self=False) if type(_t) == TypeTerm]
         if full_terms:
             if any(term in _t.word_forms() or term.get_main_form() in _t.word_forms() for _t in full_terms):
@@ -1529,7 +2506,9 @@ def dump_term_dict_from_product_types(config, filename='out/term_dict.dawg'):
     TypeTerm.term_dict = term_dict
     print("Load product type dict...")
     from ok.dicts.product_type_dict import reload_product_type_dict
-    reload_product_type_dict(config=config, force_text_format=True)
+    from ok.dicts.russian import normal_form_disk_cache
+    with normal_form_disk_cache():
+        reload_product_type_dict(config=config, force_text_format=True)
     term_dict.print_stats()
     print("Update dawg...")
     term_dict.update_dawg()
@@ -1537,7 +2516,26 @@ def dump_term_dict_from_product_types(config, filename='out/term_dict.dawg'):
     return term_dict
 
 
-def load_term_dict(filename=None, force_reload=False):
+def compile_term_dict_snapshot(config):
+    print("Compile term dict snapshot")
+    term_dict = TypeTermDict()
+    TypeTerm.term_dict = term_dict
+    term_dict.from_file(config.term_dict, verbose=True, use_snapshot=False)
+    term_dict.to_snapshot(term_dict.snapshot_filename(config.term_dict), verbose=True)
+
+    from ok.dicts.russian import compile_known_words_snapshot
+    words = set()
+    for term_id in range(1, term_dict.get_max_id() + 1):
+        words.update(re.split(u'[ -]', to_str(term_dict.get_by_id(term_id))))
+    compile_known_words_snapshot(words)
+    return term_dict
+
+
+def load_term_dict(filename=None, force_reload=False, lazy=False):
+    """
+    @param bool lazy: create terms on first access only (if compiled snapshot is available). It is for query-only
+                processes and short-lived tools which do not need all terms
+    """
     if not filename:
         from ok.dicts import main_options
         config = main_options([])
@@ -1545,7 +2543,7 @@ def load_term_dict(filename=None, force_reload=False):
     dawg_checksum = TypeTerm.term_dict.dawg_checksum_in_file(filename)
     if force_reload:
         TypeTerm.term_dict.clear()
-    return TypeTerm.term_dict.ensure_loaded(filename, dawg_checksum=dawg_checksum)
+    return TypeTerm.term_dict.ensure_loaded(filename, dawg_checksum=dawg_checksum, lazy=lazy)
 
 
 def print_logged_contexts_for_product_type_dict(config):
@@ -1586,3 +2584,5 @@ if __name__ == '__main__':
     elif _config.action == 'print-logged-context':
         # noinspection PyTypeChecker
         ot.print_logged_contexts_for_product_type_dict(_config)
+    elif _config.action == 'compile-snapshot':
+        ot.compile_term_dict_snapshot(_config)
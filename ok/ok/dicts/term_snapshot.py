@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled term dict snapshot stored next to term_dict.dawg. It restores TypeTerm objects without TypeTerm.make() and
+word forms re-validation. Snapshot is bound to checksums of dawg and of context dependent terms definitions.
+
+File layout (little-endian):
+    header: magic, format version, dawg checksum, context definitions checksum, max term id
+    sections, each prefixed with uint32 byte length:
+        dawg bytes
+        utf-8 term strings blob
+        uint32[max_id + 2] term string offsets
+        uint8[max_id + 1] term class codes
+        uint8[max_id + 1] term flags
+        uint32[max_id + 2] word form offsets, uint32[] word form term ids
+        uint32[max_id + 2] sub-term offsets, uint32[] sub-term ids
+"""
+from __future__ import print_function, unicode_literals
+from array import array
+import mmap
+import os
+import struct
+import sys
+
+import dawg
+
+SNAPSHOT_MAGIC = b'OKTS'
+SNAPSHOT_VERSION = 1
+
+_HEADER = struct.Struct(str('<4sIIII'))
+_SECTION_LEN = struct.Struct(str('<I'))
+_UINT32 = struct.Struct(str('<I'))
+
+# Flag bits 0-1: context required state (0 - unknown, 1 - not required, 2 - required)
+_FLAG_CONTEXT_REQUIRED_MASK = 0x03
+# Flag bits 2-3: word forms state
+_FLAG_WORD_FORMS_SHIFT = 2
+_FLAG_WORD_FORMS_MASK = 0x0c
+
+WORD_FORMS_NONE = 0
+WORD_FORMS_CACHED = 1
+WORD_FORMS_NO_CACHE = 2
+
+_SECTIONS = ('dawg', 'strings', 'string_offsets', 'classes', 'flags',
+             'word_form_offsets', 'word_form_ids', 'sub_term_offsets', 'sub_term_ids')
+
+
+class TermSnapshotException(Exception):
+    pass
+
+
+def uint32_array(values):
+    """@rtype: bytes of little-endian uint32 array"""
+    arr = array(str('I'), values)
+    assert arr.itemsize == 4
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr.tostring()
+
+
+def _uint8_array(values):
+    return array(str('B'), values).tostring()
+
+
+def csr(lists):
+    """
+    Compressed sparse rows: offsets[i]..offsets[i+1] is range of row i in flat items
+    @rtype: (list[int], list)
+    """
+    offsets = [0]
+    items = []
+    for row in lists:
+        if row:
+            items.extend(row)
+        offsets.append(len(items))
+    return offsets, items
+
+
+def write_snapshot(filename, dawg_obj, dawg_checksum, ctx_checksum, terms):
+    """
+    Write snapshot file
+    @param unicode filename: snapshot file name
+    @param dawg.BytesDAWG dawg_obj: terms dawg
+    @param int dawg_checksum: checksum of terms dawg
+    @param int ctx_checksum: checksum of context dependent terms definitions
+    @param list[tuple] terms: list of term data tuples (term_str, class_code, is_context_required, word_forms_state,
+                word_form_ids, sub_term_ids) where list index is term_id. Item with index 0 is ignored
+    """
+    max_id = len(terms) - 1
+    strings = []
+    string_offsets = [0, 0]
+    pos = 0
+    classes = [0]
+    flags = [0]
+    for term_str, class_code, context_required, word_forms_state, _, _ in terms[1:]:
+        encoded = term_str.encode('utf-8')
+        strings.append(encoded)
+        pos += len(encoded)
+        string_offsets.append(pos)
+        classes.append(class_code)
+        flags.append({None: 0, False: 1, True: 2}[context_required] | (word_forms_state << _FLAG_WORD_FORMS_SHIFT))
+
+    word_form_offsets, word_form_ids = csr([None] + [t[4] for t in terms[1:]])
+    sub_term_offsets, sub_term_ids = csr([None] + [t[5] for t in terms[1:]])
+
+    sections = (
+        dawg_obj.tobytes(),
+        b''.join(strings),
+        uint32_array(string_offsets),
+        _uint8_array(classes),
+        _uint8_array(flags),
+        uint32_array(word_form_offsets),
+        uint32_array(word_form_ids),
+        uint32_array(sub_term_offsets),
+        uint32_array(sub_term_ids),
+    )
+    # Write to temp file first. Existing snapshot may be memory mapped by lazy loaded dict and must not be truncated
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, dawg_checksum, ctx_checksum, max_id))
+        for section in sections:
+            f.write(_SECTION_LEN.pack(len(section)))
+            f.write(section)
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+
+
+class TermDictSnapshot(object):
+    """
+    Read-only access to snapshot file. File is memory mapped and all items are read on demand.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._mm = None
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                raise TermSnapshotException("Snapshot file is too short: %s" % filename)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.dawg_checksum, self.ctx_checksum, self.max_id = _HEADER.unpack_from(self._mm, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise TermSnapshotException("Unsupported snapshot file format: %s" % filename)
+
+            self._sections = {}
+            pos = _HEADER.size
+            for name in _SECTIONS:
+                size, = _SECTION_LEN.unpack_from(self._mm, pos)
+                pos += _SECTION_LEN.size
+                if pos + size > len(self._mm):
+                    raise TermSnapshotException("Snapshot file is truncated: %s" % filename)
+                self._sections[name] = pos
+                pos += size
+        except (struct.error, TermSnapshotException):
+            self.close()
+            raise
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _uint32(self, section, idx):
+        return _UINT32.unpack_from(self._mm, self._sections[section] + 4 * idx)[0]
+
+    def _uint32_range(self, section, start, end):
+        return list(struct.unpack_from(str('<%dI') % (end - start), self._mm, self._sections[section] + 4 * start))
+
+    def _uint8(self, section, idx):
+        return ord(self._mm[self._sections[section] + idx])
+
+    def _csr_row(self, offsets_section, items_section, term_id):
+        start = self._uint32(offsets_section, term_id)
+        end = self._uint32(offsets_section, term_id + 1)
+        return self._uint32_range(items_section, start, end) if end > start else []
+
+    def load_dawg(self):
+        """@rtype: dawg.BytesDAWG"""
+        start = self._sections['dawg']
+        size, = _SECTION_LEN.unpack_from(self._mm, start - _SECTION_LEN.size)
+        return dawg.BytesDAWG().frombytes(self._mm[start:start + size])
+
+    def term_str(self, term_id):
+        """@rtype: unicode"""
+        start = self._uint32('string_offsets', term_id)
+        end = self._uint32('string_offsets', term_id + 1)
+        base = self._sections['strings']
+        return self._mm[base + start:base + end].decode('utf-8')
+
+    def term_class_code(self, term_id):
+        return self._uint8('classes', term_id)
+
+    def is_context_required(self, term_id):
+        """@rtype: bool|None"""
+        return (None, False, True)[self._uint8('flags', term_id) & _FLAG_CONTEXT_REQUIRED_MASK]
+
+    def word_forms_state(self, term_id):
+        return (self._uint8('flags', term_id) & _FLAG_WORD_FORMS_MASK) >> _FLAG_WORD_FORMS_SHIFT
+
+    def word_form_ids(self, term_id):
+        """@rtype: list[int]"""
+        return self._csr_row('word_form_offsets', 'word_form_ids', term_id)
+
+    def sub_term_ids(self, term_id):
+        """@rtype: list[int]"""
+        return self._csr_row('sub_term_offsets', 'sub_term_ids', term_id)
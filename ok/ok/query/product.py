@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, print_function
+import itertools
 
 from ok.dicts.product_type_dict import ProductTypeDict
 from ok.dicts.russian import RE_WORD_OR_NUMBER_CHAR_SET
-from ok.dicts.term import TermContext, CompoundTypeTerm, ContextRequiredTypeTermException, TypeTerm
+from ok.dicts.term import TermContext, CompoundTypeTerm, ContextRequiredTypeTermException, TypeTerm, \
+    term_compatibility
 from ok.query import tokens
 from ok.query.tokens import RE_QUERY_SEPARATOR
 from ok.utils import any_item, to_list
@@ -47,6 +49,7 @@ class ProductQuery(object):
         self._sqn_query = None
         self._context = {}
         self._tail = None
+        self._sqn_term_ids = None
 
     @classmethod
     def from_product(cls, product):
@@ -70,6 +73,24 @@ class ProductQuery(object):
                   }
         return cls(fields)
 
+    @classmethod
+    def from_products(cls, products, chunk_size=1000):
+        """
+        Make queries for sequence of products. SQNs of products are parsed to terms by chunks
+        (see TypeTerm.parse_term_strings())
+        @param collections.Iterable[dict] products: products
+        @rtype: collections.Iterable[ProductQuery]
+        """
+        products = iter(products)
+        while True:
+            chunk = [cls.from_product(product) for product in itertools.islice(products, chunk_size)]
+            if not chunk:
+                break
+            chunk_term_ids = TypeTerm.parse_term_strings(pq.sqn_query() for pq in chunk)
+            for pq, term_ids in itertools.izip(chunk, chunk_term_ids):
+                pq._sqn_term_ids = term_ids
+                yield pq
+
     @classmethod
     def from_sqn(cls, sqn, context=None, type_filter=None):
         p_types = cls.ptd.collect_sqn_type_tuples(sqn, context=context)
@@ -187,7 +208,10 @@ class ProductQuery(object):
         if tail is not None:
             return tail
 
-        sqn_terms = TypeTerm.parse_term_string(self.sqn_query())
+        if self._sqn_term_ids is not None:
+            sqn_terms = map(TypeTerm.get_by_id, self._sqn_term_ids)
+        else:
+            sqn_terms = TypeTerm.parse_term_string(self.sqn_query())
         context = self.term_context()
 
         all_type_terms = set()
@@ -201,8 +225,7 @@ class ProductQuery(object):
                 if sub_term not in tail:
 
                     for type_term in all_type_terms:
-                        if not type_term.is_compatible_with(sub_term, context=context) or \
-                           not sub_term.is_compatible_with(type_term, context=context):
+                        if not term_compatibility.are_compatible(type_term, sub_term, context=context):
                             sub_term_in_types = True
                             break
                     else:
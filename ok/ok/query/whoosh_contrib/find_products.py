@@ -62,8 +62,8 @@ def feeder(writer):
     load_term_dict()
 
     products = products_data_source()
-    for p in products:
-        feed_product(p, writer)
+    for pq in ProductQuery.from_products(products):
+        feed_product_query(pq, writer)
     return data_checksum()
 
 
@@ -76,7 +76,10 @@ def products_data_source():
 
 
 def feed_product(p, writer):
-    pq = ProductQuery.from_product(p)
+    feed_product_query(ProductQuery.from_product(p), writer)
+
+
+def feed_product_query(pq, writer):
     # TODO: make test to validate only simple text types are passed to writer as field terms
     # whoosh will serialize terms and on next run their can be a problems with deserialized terms
     writer.add_document(pfqn=pq.pfqn, types=product_type_normalizer(pq.types), tail=map(to_str, pq.tail), brand=pq.brand,
@@ -5,6 +5,15 @@ from whoosh import searching, query
 
 
 def text_data_file_checksum(filename):
+    """
+    Checksum of text data file. It is cached in baseline manifest until file is changed
+    @rtype: long
+    """
+    from ok.dicts.manifest import cached_file_hash
+    return cached_file_hash(filename, 'text_data_checksum', _text_data_file_checksum)
+
+
+def _text_data_file_checksum(filename):
     """@rtype: long"""
     from whoosh.filedb.structfile import ChecksumFile
 
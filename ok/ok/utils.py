@@ -506,6 +506,21 @@ def any_item(seq, default=None, sort=True):
             return next(iter(seq), default)
     return seq
 
+
+def resident_memory():
+    """
+    Resident memory size of current process in bytes. If current value is not available (non-Linux) - peak value
+    @rtype: int
+    """
+    import os
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf(str('SC_PAGE_SIZE'))
+    except (IOError, OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def checksum(write_to_method):
     assert callable(write_to_method)
     from zlib import crc32
@@ -516,3 +531,36 @@ def checksum(write_to_method):
     checksum = crc32(b.getvalue()) & 0xffffffff
     return checksum
 
+
+def map_chunks(func, chunks, processes=None, initializer=None):
+    """
+    Apply func to each chunk in process pool. Results are yielded in order of chunks.
+    @param (object)->object func: module level function (to be pickled)
+    @param collections.Iterable chunks: chunks of work
+    @param int|None processes: number of worker processes. By default, number of cpus. If 1 or there is one chunk
+            only, chunks are processed in current process
+    @param (()->None)|None initializer: module level function called once in each worker process. If chunks are
+            processed in current process, it is called once in current process
+    """
+    import itertools
+    import multiprocessing
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    chunks = iter(chunks)
+    # Pool is not worth it for one chunk
+    first_chunks = list(itertools.islice(chunks, 2))
+    chunks = itertools.chain(first_chunks, chunks)
+    if processes > 1 and len(first_chunks) > 1:
+        pool = multiprocessing.Pool(processes, initializer=initializer)
+        try:
+            for result in pool.imap(func, chunks):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        if initializer is not None:
+            initializer()
+        for chunk in chunks:
+            yield func(chunk)
@@ -60,4 +60,15 @@ def test_relations_sort():
     r5 = t1.equals_to(t4)
 
     rel = t1.relations()
-    assert rel == [r4, r3, r5, r2, r1]
\ No newline at end of file
+    assert rel == [r4, r3, r5, r2, r1]
+
+def test_main_form_term_ids():
+    t = ProductType('тестовый', 'тесты')
+    assert t.get_terms_ids() == (TypeTerm.make('тестовый').term_id, TypeTerm.make('тесты').term_id)
+    main_form_ids = t.get_main_form_term_ids()
+    assert list(main_form_ids) == [term.get_main_form().term_id for term in t]
+    assert all(type(term_id) is int for term_id in main_form_ids)
+    # Types without context dependent terms do not need term context
+    assert t._ProductType__term_context is None
+    assert t.get_main_form_term_ids() is main_form_ids
+    assert t.get_same_same_hash() == ProductType('тесты', 'тестовые').get_same_same_hash()
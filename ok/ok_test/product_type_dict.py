@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, unicode_literals
 from collections import defaultdict, OrderedDict
+import os
 import pytest
 from ok.dicts import build_path, main_options
 from ok.utils import to_str
 from ok.dicts.product import Product
 from ok.dicts.product_type import ProductType, TYPE_TUPLE_RELATION_CONTAINS, TYPE_TUPLE_RELATION_EQUALS, \
     TYPE_TUPLE_RELATION_SUBSET_OF, TYPE_TUPLE_RELATION_ALMOST
-from ok.dicts.product_type_dict import ProductTypeDict, reload_product_type_dict
+from ok.dicts.product_type_dict import ProductTypeDict, SimilarTypesIndex, reload_product_type_dict, \
+    diff_type_dicts
 from ok.dicts.term import load_term_dict, TypeTerm
 from ok.settings import ensure_baseline_dir
 
@@ -206,6 +208,122 @@ def test_to_json_only_meaningful(types_dict):
     assert json_types[p2][1:] == [p2.get_relation(p1)]
 
 
+def test_similar_types_index(types_dict):
+    """@param ProductTypeDict types_dict: pdt"""
+    types = [ProductType('тестмолоко', 'тесткоровье'), ProductType('тестмолоко', 'тесткоровьи'),
+             ProductType('тесткоровье', 'тестмолоко'), ProductType('тестмолоко', 'тесткозье'),
+             ProductType('тестмолоко', 'тест'), ProductType('тестмолоко', 'тестнекоровье')]
+    index = SimilarTypesIndex()
+    similar_count = 0
+    for i, p_type in enumerate(types):
+        expected = [sibling for sibling in types[:i] if types_dict.find_similar_relation(p_type, sibling, dont_change=True)]
+        assert index.add('group', p_type) == expected
+        similar_count += len(expected)
+    assert 0 < similar_count < len(types) * (len(types) - 1) / 2
+    assert index.add('other', ProductType('тестмолоко', 'тесткоровьи')) == []
+
+
+def test_diff_type_dicts(types_dict):
+    """@param ProductTypeDict types_dict: pdt"""
+    t1, t12, t34 = ProductType('тест1'), ProductType('тест1', 'тест2'), ProductType('тест3', 'тест4')
+    t21, t125, t4 = ProductType('тест2', 'тест1'), ProductType('тест1', 'тест2', 'тест5'), ProductType('тест4')
+
+    diff = diff_type_dicts([t1, t12, t34], [t1, t21, t125, t4])
+    assert diff.equal == [t1]
+    assert diff.added == [t125, t21, t4]
+    assert diff.removed == [t12, t34]
+    assert diff.synonyms == [(t12, t21)]
+    assert diff.more_specific == [(t1, t125), (t1, t21), (t12, t125)]
+    assert diff.less_specific == [(t12, t1), (t34, t4)]
+
+    diff = diff_type_dicts([t1, t12], [t1, t12])
+    assert diff.equal == [t1, t12]
+    assert not any(diff[:2] + diff[3:])
+
+
+def test_update_with_products(types_dict):
+    """@param ProductTypeDict types_dict: pdt"""
+    products1 = [Product(sqn='тестмолоко тесткоровье', tags=['таг1']), Product(sqn='тестмолоко тесткозье', tags=['таг1']),
+                 Product(sqn='тестсыр тесттвердый')]
+    products2 = [Product(sqn='тесткоровье тестмолоко', tags=['таг2']), Product(sqn='тестмолоко тесткоровьи'),
+                 Product(sqn='тестсыр тестмягкий', tags=['таг1'])]
+
+    def dump(pdt):
+        pdt._ensure_find_caches()
+        meaningful_types = pdt.get_type_tuples(meaningful_only=True)
+        main_form_cache = pdt._ProductTypeDict__main_form_cache
+        return (sorted((to_str(t), sorted(sqns), sorted(map(to_str, t.relations())), t in meaningful_types)
+                       for t, sqns in pdt.get_type_tuples().items()),
+                sorted((sorted(key), sorted(map(to_str, types))) for key, types in main_form_cache.items() if types))
+
+    def build(products):
+        ProductType.reload()
+        pdt = ProductTypeDict()
+        pdt.build_from_products(products)
+        return pdt
+
+    expected = dump(build(products1 + products2))
+    pdt = build(products1)
+    dump(pdt)
+    new_types, removed_types = pdt.update_with_products(added=products2)
+    assert ProductType('тесткоровье', 'тестмолоко') in new_types and ProductType('#таг2') in new_types
+    assert not removed_types
+    assert dump(pdt) == expected
+
+    expected = dump(build(products1))
+    pdt = build(products1 + products2)
+    dump(pdt)
+    new_types, removed_types = pdt.update_with_products(removed=products2)
+    assert not new_types
+    assert ProductType('тестсыр', 'тестмягкий') in removed_types and ProductType('#таг2') in removed_types
+    assert dump(pdt) == expected
+
+
+def _build_from_products_run(products, processes, conn):
+    ProductType.reload()
+    pdt = ProductTypeDict()
+    max_id = TypeTerm.term_dict.get_max_id()
+    pdt.build_from_products(products, processes=processes)
+    new_terms = [(term_id, unicode(TypeTerm.get_by_id(term_id)))
+                 for term_id in range(max_id + 1, TypeTerm.term_dict.get_max_id() + 1)]
+    types = sorted((t.get_terms_ids(), sorted(sqns), sorted(map(to_str, t.relations())))
+                   for t, sqns in pdt.get_type_tuples().items())
+    conn.send((new_terms, types))
+
+
+def test_build_from_products_processes(types_dict, monkeypatch):
+    """@param ProductTypeDict types_dict: pdt"""
+    import multiprocessing
+    import ok.dicts.russian
+    batch = ok.dicts.russian.get_word_normal_forms_batch
+    # Words of products are sent to workers one by one
+    monkeypatch.setattr(ok.dicts.russian, 'get_word_normal_forms_batch',
+                        lambda words, **kwargs: batch(words, chunk_size=1, **kwargs))
+    products = [Product(sqn='тестмолоко тесткоровье-тестпастер', tags=['таг1']),
+                Product(sqn='тестсыр тестмягкий/тесттвердый', tags=['таг1']),
+                Product(sqn='тесткоровье-тестпастер тестмолоко'), Product(sqn='тестсыр тестмягкий', tags=['таг2'])]
+
+    results = []
+    for processes in (1, 2):
+        # Each build starts from the same term dict in own process
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        run = multiprocessing.Process(target=_build_from_products_run, args=(products, processes, child_conn))
+        run.start()
+        results.append(conn.recv())
+        run.join()
+    new_terms, types = results[0]
+    assert 'тестпастер' in [term_str for _, term_str in new_terms] and types
+    assert results[1] == results[0]
+
+    def fail_on_pool(*_, **__):
+        raise AssertionError("Pool must not be used")
+
+    # Products are processed in current process by default
+    monkeypatch.setattr(multiprocessing, 'Pool', fail_on_pool)
+    types_dict.build_from_products(products)
+    assert types_dict.get_type_tuples()
+
+
 def test_from_bin_json(types_dict_test_data, tmpdir):
     """
     @param ProductTypeDict types_dict_test_data: types_dict
@@ -229,6 +347,48 @@ def test_from_bin_json(types_dict_test_data, tmpdir):
         assert old_types[i].relations() == new_types[i].relations()
 
 
+def test_find_caches_file(types_dict_test_data, tmpdir):
+    """
+    @param ProductTypeDict types_dict_test_data: types_dict
+    @param LocalPath tmpdir: pytest temp dir
+    """
+    filename = str(tmpdir.join('test_types_dict.bin.json'))
+    types_dict_test_data.to_bin_json(json_filename=filename)
+    find_caches_filename = ProductTypeDict.find_caches_filename(filename)
+
+    def load():
+        _pdt = ProductTypeDict()
+        _pdt.from_json(filename, pure_json=True, binary_format=True)
+        _pdt._ensure_find_caches()
+        return _pdt, _pdt._ProductTypeDict__main_form_cache, _pdt._ProductTypeDict__similarity_groups_cache
+
+    pdt, main_form_cache, similarity_groups_cache = load()
+    assert isinstance(main_form_cache, dict) and main_form_cache
+    assert os.path.isfile(find_caches_filename)
+    expected = [sorted((key, sorted(map(to_str, types))) for key, types in cache.items())
+                for cache in (main_form_cache, similarity_groups_cache)]
+
+    # Caches of dict with other meaningful types are not used
+    pdt = ProductTypeDict()
+    pdt.from_json(filename, pure_json=True, binary_format=True)
+    pdt.min_meaningful_type_capacity += 1
+    assert not pdt._load_find_caches()
+
+    pdt, main_form_cache, similarity_groups_cache = load()
+    assert not isinstance(main_form_cache, dict)
+    assert [sorted((key, sorted(map(to_str, cache.get(key)))) for key, _ in cache_items)
+            for cache, cache_items in zip((main_form_cache, similarity_groups_cache), expected)] == expected
+    assert main_form_cache.get(frozenset([0])) is None
+    p_type = next(iter(pdt.get_type_tuples(meaningful_only=True)))
+    assert p_type in pdt.find_product_type_relations(p_type.as_string())
+
+    # Caches file is closed when types are changed or reloaded
+    snapshot = pdt._ProductTypeDict__find_caches_snapshot
+    assert snapshot is not None and snapshot._mm is not None
+    pdt._type_tuples_on_change()
+    assert snapshot._mm is None and pdt._ProductTypeDict__find_caches_snapshot is None
+
+
 def test_from_bin_json_full(types_dict_full_common, tmpdir):
     test_from_bin_json(types_dict_full_common, tmpdir)
 
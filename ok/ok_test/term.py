@@ -2,6 +2,7 @@
 from __future__ import print_function, unicode_literals
 from collections import defaultdict
 from functools import wraps
+import itertools
 import pytest
 
 from ok.dicts import main_options
@@ -12,7 +13,7 @@ from ok.dicts.product_type_dict import reload_product_type_dict, ProductTypeDict
 from ok.dicts.russian import get_word_normal_form
 from ok.dicts.term import load_term_dict, TypeTerm, ContextRequiredTypeTermException, dump_term_dict_from_product_types, \
     CompoundTypeTerm, ContextDependentTypeTerm, ctx_def, DEFAULT_CONTEXT, WithPropositionTypeTerm, TermContext, \
-    context_aware, TypeTermDict
+    context_aware, TypeTermDict, TypeTermException, term_compatibility
 
 
 @pytest.fixture(autouse=True)
@@ -242,6 +243,32 @@ def test_context_terms_def_consistent_prefix():
     # tear down
     del context_terms_def['тестт']
 
+def test_context_terms_prefixes_index(monkeypatch):
+    import ok.dicts.russian
+    context_terms_def = ContextDependentTypeTerm.ctx_dependent_terms
+    context_terms_def['тстт'] = [ctx_def([DEFAULT_CONTEXT], 'тсттпрефикс')]
+    try:
+        ContextDependentTypeTerm.ensure_full_terms_index()
+
+        def fail_on_morphology(*_, **__):
+            raise AssertionError("Morphology must not be used")
+
+        # Normal forms of full terms are precomputed with index
+        monkeypatch.setattr(ok.dicts.russian, '_ensure_pymorphy', fail_on_morphology)
+        monkeypatch.setattr(ok.dicts.russian, '_ensure_word_forms_dict', fail_on_morphology)
+        assert ContextDependentTypeTerm.is_valid_term_for_prefix('тсттпреф')
+        assert not ContextDependentTypeTerm.is_valid_term_for_prefix('тсттпрефикс')
+        assert not ContextDependentTypeTerm.is_valid_term_for_prefix('тстт')
+        assert not ContextDependentTypeTerm.is_valid_term_for_prefix('тсттсуффикс')
+        monkeypatch.undo()
+
+        t = TypeTerm.make('тсттпреф')
+        assert isinstance(t, ContextDependentTypeTerm)
+        assert t.get_prefix_base_key() == 'тстт'
+    finally:
+        # tear down
+        del context_terms_def['тстт']
+
 def test_context_terms_default_all(pdt):
     context_terms_def = ContextDependentTypeTerm.ctx_dependent_terms
 
@@ -294,6 +321,13 @@ def test_context_terms_compound_context_product_load_very_slow(pdt):
     _assert_all_types_are_finalized(types)
     assert ProductType('конфета', 'молоко', 'горький', 'шоколад') in types
 
+def test_collect_type_tuples_shared_types_cache(pdt):
+    products = [Product(sqn='конфеты-классик в мол/гор шок', tags={''}),
+                Product(sqn='конфеты шоколадные с орехами'), Product(sqn='шоколад молочный с орехами')]
+    types = pdt.collect_type_tuples(products, share_types_cache=False)
+    assert pdt.collect_type_tuples(products) == types
+    _assert_all_types_are_finalized(types)
+
 def _assert_all_types_are_finalized(types):
     """@param set[ProductType]|list[ProductType]|dict of (ProductType, Any) types: container of ProductTypes"""
     for t in types:
@@ -596,6 +630,139 @@ def test_context_cache_exceptions():
     # Tear down
     ContextDependentTypeTerm.get_main_form = get_main_form_orig
 
+def test_context_result_global_cache(pdt):
+    from ok.dicts.term import context_result_cache
+    t = TypeTerm.make('шок')
+    context_result_cache.clear()
+    hits = context_result_cache.hits
+
+    context1 = TermContext(['молочный', 'шок'])
+    assert t.get_main_form(context=context1) == get_word_normal_form('шоколадный')
+    assert context_result_cache.hits == hits
+
+    # Another context with the same terms takes result and hints from global cache
+    context2 = TermContext(['молочный', 'шок'])
+    assert t.get_main_form(context=context2) == get_word_normal_form('шоколадный')
+    assert context_result_cache.hits == hits + 1
+    assert context2.hints == context1.hints
+
+    # Context with different terms is not matched
+    context3 = TermContext(['молочный', 'шок', 'глазурь'])
+    assert t.get_main_form(context=context3) == get_word_normal_form('шоколадный')
+    assert context_result_cache.hits == hits + 1
+
+    # Cache is dropped on context definitions change
+    context_terms_def = ContextDependentTypeTerm.ctx_dependent_terms
+    context_terms_def['тестт'] = [ctx_def([DEFAULT_CONTEXT], 'тестт')]
+    try:
+        assert t.get_main_form(context=TermContext(['молочный', 'шок'])) == get_word_normal_form('шоколадный')
+        assert context_result_cache.hits == hits + 1
+        assert len(context_result_cache) == 1
+    finally:
+        del context_terms_def['тестт']
+
+
+def test_context_result_global_cache_resolution_order(pdt):
+    from ok.dicts.term import context_result_cache
+    terms = TypeTerm.parse_term_string('гор шок мол продукт')
+    ctx_terms = [t for t in terms if isinstance(t, ContextDependentTypeTerm)]
+    orders = list(itertools.permutations(ctx_terms))
+
+    def resolve(order):
+        context = TermContext(terms)
+        main_forms = []
+        for term in order:
+            try:
+                main_forms.append(term.get_main_form(context=context))
+            except ContextRequiredTypeTermException:
+                main_forms.append(None)
+        return main_forms, {k: v for k, v in context.hints.items() if v}
+
+    def resolve_all_orders():
+        return [resolve(order) for order in orders]
+
+    max_size = context_result_cache.max_size
+    context_result_cache.max_size = 0
+    try:
+        # Terms learn hints from resolved contexts, so, results of the next pass may differ
+        expected = [resolve_all_orders(), resolve_all_orders()]
+    finally:
+        context_result_cache.max_size = max_size
+    # Hints depend on order of resolution, so, results of one order must not be replayed in another one
+    assert any(hints != expected[0][0][1] for _, hints in expected[0])
+
+    for term in ctx_terms:
+        term._ctx_map_hints.clear()
+    context_result_cache.clear()
+    assert [resolve_all_orders(), resolve_all_orders()] == expected
+    assert context_result_cache.hits > 0
+
+
+def test_context_resolve_all(pdt):
+    t = TypeTerm.make('шок')
+    context = TermContext(['молочный', 'шок', 'глазурь'])
+    assert context.resolve_all() == {t: get_word_normal_form('шоколадный')}
+    # Result is cached in context
+    main_form_key = context.call_key(ContextDependentTypeTerm.get_main_form.context_aware_index, t.term_id)
+    assert context.result_cache[main_form_key] == get_word_normal_form('шоколадный')
+    assert t.get_main_form(context=context) == get_word_normal_form('шоколадный')
+
+    # Resolution by index is the same as by get_main_form()
+    for terms_str in ('гор шок мол продукт', 'кофе мол', 'мол шоколад', 'шок мол глазурь', 'йогурт мар', 'мар'):
+        terms = TypeTerm.parse_term_string(terms_str)
+        context_all = TermContext(terms)
+        resolved = context_all.resolve_all()
+        context_one = TermContext(terms)
+        for term in terms:
+            if isinstance(term, ContextDependentTypeTerm):
+                try:
+                    expected = term.get_main_form(context=context_one)
+                except ContextRequiredTypeTermException:
+                    expected = None
+                assert resolved.get(term, expected) == expected
+                try:
+                    actual = term.get_main_form(context=context_all)
+                except ContextRequiredTypeTermException:
+                    actual = None
+                assert actual == expected
+        # Hints may be made in different order
+        assert {k: set(v) for k, v in context_all.hints.items() if v} == \
+            {k: set(v) for k, v in context_one.hints.items() if v}
+
+
+def test_parse_term_strings(pdt):
+    terms_strs = ['конфеты в гор шок', 'гор шок мол продукт', 'шоколад и конфеты со вкусом и ароматом клубники',
+                  'молочный-шоколад с орехами', '', 'шоколад шоколад']
+    batch = TypeTerm.parse_term_strings(terms_strs)
+    assert len(batch) == len(terms_strs)
+    for terms_str, term_ids in zip(terms_strs, batch):
+        assert list(term_ids) == [t.term_id for t in TypeTerm.parse_term_string(terms_str)]
+    assert map(TypeTerm.get_by_id, batch[-1]) == [TypeTerm.make('шоколад')]
+
+
+def test_term_compatibility_index(pdt):
+    terms = [TypeTerm.make(t) for t in ('шоколад', 'шоколадный', 'в шоколаде', 'в глазури', 'с орехами',
+                                         'молочный-шоколад', 'конфеты', 'конфета', 'йогурт')]
+    terms.append(TypeTerm.make('мар'))
+    context = TermContext(terms)
+    for t1 in terms:
+        for t2 in terms:
+            assert term_compatibility.is_compatible(t1, t2, context=context) == \
+                t1.is_compatible_with(t2, context=context)
+    assert not term_compatibility.are_compatible(TypeTerm.make('в шоколаде'), TypeTerm.make('в глазури'))
+    assert not term_compatibility.are_compatible(TypeTerm.make('конфеты'), TypeTerm.make('конфета'))
+
+    # Overrides drop index
+    t1, t2 = TypeTerm.make('конфеты'), TypeTerm.make('йогурт')
+    assert term_compatibility.is_compatible(t1, t2)
+    t1.do_not_pair(t2)
+    try:
+        assert not term_compatibility.is_compatible(t1, t2)
+    finally:
+        t1._do_not_pair.clear()
+        term_compatibility.clear()
+
+
 def test_context_recursive_def(pdt):
     ctx_dependent_terms = ContextDependentTypeTerm.ctx_dependent_terms
     assert 'том' in ctx_dependent_terms
@@ -639,3 +806,588 @@ def test_dawg_persistence_full():
         assert term_saved is not term_loaded and term_saved == term_loaded and type(term_saved) == type(term_loaded), \
             "Saved and Loaded terms are different!"
     print("test_dawg_persistence(): success")
+
+
+def assert_term_dicts_equal(term_dict_expected, term_dict_actual):
+    max_id = term_dict_expected.get_max_id()
+    assert term_dict_actual.get_max_id() == max_id and max_id > 0, "Term dicts are different size!"
+    for i in range(1, max_id + 1):
+        term_expected = term_dict_expected.get_by_id(i)
+        term_actual = term_dict_actual.get_by_id(i)
+        assert term_expected is not term_actual and term_expected == term_actual and \
+            type(term_expected) == type(term_actual), "Terms are different: %s vs %s" % (term_expected, term_actual)
+        assert term_actual.term_id == i
+        assert term_expected.is_context_required() == term_actual.is_context_required()
+        if not term_expected.is_context_required():
+            assert term_expected.word_forms(context=None) == term_actual.word_forms(context=None)
+        if isinstance(term_expected, CompoundTypeTerm):
+            assert term_expected.sub_terms == term_actual.sub_terms
+            assert term_expected._spaced_form == term_actual._spaced_form
+        if isinstance(term_expected, WithPropositionTypeTerm):
+            assert term_expected.proposition == term_actual.proposition
+
+
+def test_dawg_snapshot(pdt):
+    filename = 'out/_term_dict_snapshot_test.dawg'
+    test_term_dict_saved = TypeTerm.term_dict
+    test_term_dict_saved.update_dawg()
+    test_term_dict_saved.to_file(filename)
+
+    TypeTerm.term_dict = TypeTermDict()
+    try:
+        test_term_dict_loaded = TypeTerm.term_dict.from_snapshot(TypeTermDict.snapshot_filename(filename),
+                                                                 required_checksum=test_term_dict_saved.dawg_checksum())
+        assert_term_dicts_equal(test_term_dict_saved, test_term_dict_loaded)
+        assert test_term_dict_loaded.dawg_checksum() == test_term_dict_saved.dawg_checksum()
+
+        # Loaded terms are fully functional
+        term = TypeTerm.make('шок')
+        assert term is test_term_dict_loaded.get_by_unicode('шок')
+        assert term.get_main_form(context=['молочный']) == get_word_normal_form('шоколадный')
+    finally:
+        TypeTerm.term_dict = test_term_dict_saved
+
+
+def test_dawg_snapshot_checksum_mismatch(pdt, monkeypatch):
+    filename = 'out/_term_dict_snapshot_test.dawg'
+    TypeTerm.term_dict.update_dawg()
+    TypeTerm.term_dict.to_file(filename)
+    dawg_checksum = TypeTerm.term_dict.dawg_checksum()
+
+    with pytest.raises(TypeTermException):
+        TypeTermDict().from_snapshot(TypeTermDict.snapshot_filename(filename), required_checksum=dawg_checksum + 1)
+
+    # Full load is used if snapshot does not match
+    with open(TypeTermDict.snapshot_filename(filename), 'wb') as f:
+        f.write(b'broken')
+    monkeypatch.setattr(TypeTerm, 'term_dict', TypeTermDict())
+    test_term_dict_loaded = load_term_dict(filename)
+    assert test_term_dict_loaded.dawg_checksum() == dawg_checksum
+
+
+def test_dawg_snapshot_full():
+    config = main_options([])
+    term_dict_full = TypeTerm.term_dict.from_file(config.term_dict, use_snapshot=False)
+    filename = 'out/_term_dict_snapshot_test_full.snapshot'
+    term_dict_full.to_snapshot(filename)
+    test_term_dict_loaded = TypeTermDict().from_snapshot(filename, required_checksum=term_dict_full.dawg_checksum())
+    assert_term_dicts_equal(term_dict_full, test_term_dict_loaded)
+
+
+def test_dawg_snapshot_baseline_word_forms_full(monkeypatch):
+    # Baseline snapshot has all context-free word forms precomputed. Morphology must not be used at all
+    import ok.dicts.russian
+
+    def fail_on_morphology(*_, **__):
+        raise AssertionError("Morphology must not be used")
+
+    term_dict = load_term_dict(lazy=True)
+    monkeypatch.setattr(ok.dicts.russian, '_ensure_pymorphy', fail_on_morphology)
+    monkeypatch.setattr(ok.dicts.russian, '_ensure_word_forms_dict', fail_on_morphology)
+    for term_id in range(1, term_dict.get_max_id() + 1):
+        term = term_dict.get_by_id(term_id)
+        if not term.is_context_required():
+            word_forms = term.word_forms(context=None)
+            assert word_forms and term in word_forms
+
+
+def test_dawg_snapshot_lazy(pdt):
+    filename = 'out/_term_dict_snapshot_test.dawg'
+    test_term_dict_saved = TypeTerm.term_dict
+    TypeTerm.parse_term_string('молочный-шоколад с орехами')
+    test_term_dict_saved.update_dawg()
+    test_term_dict_saved.to_file(filename)
+
+    TypeTerm.term_dict = TypeTermDict()
+    try:
+        test_term_dict_loaded = TypeTerm.term_dict.from_file(filename, lazy=True)
+        assert test_term_dict_loaded.count_materialized() == 0
+        assert test_term_dict_loaded.get_max_id() == test_term_dict_saved.get_max_id()
+
+        term = TypeTerm.make('молочный-шоколад')
+        assert isinstance(term, CompoundTypeTerm) and term.term_id == test_term_dict_saved.find_id_by_unicode(term)
+        assert 0 < test_term_dict_loaded.count_materialized() < test_term_dict_loaded.get_max_id()
+        assert term.sub_terms == test_term_dict_saved.get_by_unicode(term).sub_terms
+
+        assert_term_dicts_equal(test_term_dict_saved, test_term_dict_loaded)
+
+        # New terms are added after snapshot terms
+        new_term = TypeTerm.make('абырвалг')
+        assert new_term.term_id == test_term_dict_saved.get_max_id() + 1
+    finally:
+        TypeTerm.term_dict = test_term_dict_saved
+
+
+def test_term_dict_concurrent_make():
+    import sys
+    import random
+    import threading
+
+    term_strings = ['молоко', 'молочный', 'шоколад', 'шоколадный', 'с орехами', 'молочный шоколад', 'сок яблочный',
+                    'йогурт питьевой', 'кофе раст', 'кофе молотый', 'шок', 'мол', 'во фритюре', 'кефир 3.2%',
+                    'чай черный крупнолистовой', 'соус томатный', 'хлеб ржаной', 'сыр плавленный', 'напиток сокосод',
+                    'пюре картофельное', 'колбаса вар', 'масло слив', 'мороженое пломбир', 'молоко-шоколад']
+    # Many new simple terms in the same order for all threads - to register the same term at the same time
+    new_term_strings = ['тест%d' % i for i in range(1000)]
+    threads_count = 16
+    errors = []
+    results = []
+    start = threading.Event()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        result = defaultdict(list)
+        start.wait()
+        try:
+            for term_str in new_term_strings:
+                result[term_str].append(TypeTerm.make(term_str))
+            for term_str in rnd.sample(term_strings, len(term_strings)):
+                terms = TypeTerm.parse_term_string(term_str)
+                for term in terms:
+                    result[term].append(term)
+                    result[term].append(TypeTerm.make(to_str(term)))
+                    term.word_forms(context=terms, fail_on_context=False)
+                    term.word_forms(context=None, fail_on_context=False)
+        except Exception as e:
+            errors.append(e)
+        results.append(result)
+
+    check_interval = sys.getcheckinterval()
+    # Switch threads as often as possible to catch races
+    sys.setcheckinterval(1)
+    try:
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads_count)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setcheckinterval(check_interval)
+
+    assert not errors, errors
+    assert len(results) == threads_count
+
+    term_dict = TypeTerm.term_dict
+    term_ids = {}
+    for result in results:
+        for term_str, terms in result.viewitems():
+            term = term_dict.get_by_unicode(term_str)
+            assert all(t is term for t in terms), "Different instances of the same term: %s" % term_str
+            assert term_ids.setdefault(term_str, term.term_id) == term.term_id
+    assert len(set(term_ids.values())) == len(term_ids), "Ids are not unique"
+    for term_id in range(1, term_dict.get_max_id() + 1):
+        term = term_dict.get_by_id(term_id)
+        assert term is not None and term.term_id == term_id and term_dict.find_id_by_unicode(term) == term_id
+
+
+def test_term_dict_concurrent_lazy_load():
+    import sys
+    import threading
+
+    term_dict = load_term_dict(lazy=True)
+    max_id = term_dict.get_max_id()
+    errors = []
+    results = []
+    start = threading.Event()
+
+    def worker(step):
+        result = {}
+        start.wait()
+        try:
+            for term_id in range(1, max_id + 1, step):
+                term = term_dict.get_by_id(term_id)
+                result[term_id] = term
+                term.word_forms(context=None, fail_on_context=False)
+                TypeTerm.make(to_str(term))
+        except Exception as e:
+            errors.append(e)
+        results.append(result)
+
+    check_interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+        threads = [threading.Thread(target=worker, args=(step,)) for step in (1, 1, 2, 3, 5, 7, 1, 2)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setcheckinterval(check_interval)
+
+    assert not errors, errors
+    assert term_dict.get_max_id() == max_id, "No new terms are expected"
+    for result in results:
+        for term_id, term in result.viewitems():
+            assert term is term_dict.get_by_id(term_id) and term.term_id == term_id
+
+
+def test_term_dict_delta_compaction(monkeypatch):
+    monkeypatch.setattr(TypeTermDict, 'delta_compact_min_size', 5)
+    term_dict = TypeTerm.term_dict
+    TypeTerm.make('тест')
+    term_dict.update_dawg(compact=True)
+    assert term_dict.delta_size() == 0
+
+    TypeTerm.make('тестер')
+    TypeTerm.make('тестовый')
+    # Uncommitted terms are found by string but not by prefix
+    assert term_dict.find_id_by_unicode('тестер') is not None
+    assert term_dict.count_terms_with_prefix('тест') == 1
+
+    term_dict.update_dawg()
+    assert term_dict.delta_size() == 2
+    assert term_dict.count_terms_with_prefix('тест') == 3
+    assert term_dict.count_terms_with_prefix('тестер', count_self=False) == 0
+    assert [to_str(t) for t in term_dict.find_by_unicode_prefix('тест', return_self=False)] == ['тестер', 'тестовый']
+    assert term_dict.get_by_unicode('тестовый') is TypeTerm.make('тестовый')
+
+    # Delta is compacted over threshold
+    for i in range(4):
+        TypeTerm.make('тест%d' % i)
+        term_dict.update_dawg()
+    assert term_dict.delta_size() == 0
+    assert term_dict.count_terms_with_prefix('тест') == 7
+
+    # Compacted DAWG is the same as rebuilt from scratch
+    TypeTerm.make('тестировщик')
+    term_dict.update_dawg()
+    assert term_dict.delta_size() == 1
+    checksum_compacted = term_dict.dawg_checksum()
+    assert term_dict.delta_size() == 0
+    term_strs = [to_str(term_dict.get_by_id(i)) for i in range(1, term_dict.get_max_id() + 1)]
+    term_dict.clear()
+    for term_str in term_strs:
+        TypeTerm.make(term_str)
+    term_dict.update_dawg(compact=True)
+    assert term_dict.dawg_checksum() == checksum_compacted
+
+
+def test_term_dict_simple_prefix_index():
+    term_dict = TypeTerm.term_dict
+    for term_str in ('тест', 'тестер', 'тест-драйв', 'тестовый'):
+        TypeTerm.make(term_str)
+    term_dict.update_dawg(compact=True)
+    # Delta terms are counted and found together with base DAWG
+    TypeTerm.make('тестирование')
+    TypeTerm.make('тест/2')
+    term_dict.update_dawg()
+    assert term_dict.delta_size() > 0
+
+    assert term_dict.count_terms_with_prefix('тест') == 4
+    assert term_dict.count_terms_with_prefix('тест', count_self=False) == 3
+    assert term_dict.count_terms_with_prefix('тест', not_compound=False) > 4
+    assert term_dict.count_terms_with_prefix('тестер', count_self=False) == 0
+    assert term_dict.count_terms_with_prefix('тестю') == 0
+
+    term_ids = term_dict.find_ids_by_unicode_prefix('тест', return_self=False)
+    assert [to_str(term_dict.get_by_id(term_id)) for term_id in term_ids] == ['тестер', 'тестирование', 'тестовый']
+    assert term_dict.find_by_unicode_prefix('тест', return_self=False) == map(term_dict.get_by_id, term_ids)
+
+    term_dict.compact()
+    assert term_dict.find_ids_by_unicode_prefix('тест', return_self=False) == term_ids
+    assert term_dict.count_terms_with_prefix('тест') == 4
+
+
+def test_term_dict_simple_prefix_index_concurrent(monkeypatch):
+    import sys
+    import threading
+    import dawg
+
+    term_dict = TypeTerm.term_dict
+    for term_str in ('тест', 'тестер', 'тестовый'):
+        TypeTerm.make(term_str)
+    term_dict.update_dawg(compact=True)
+    index_builds = []
+    int_completion_dawg = dawg.IntCompletionDAWG
+
+    def build_index(*args):
+        index_builds.append(threading.current_thread())
+        return int_completion_dawg(*args)
+
+    monkeypatch.setattr(dawg, 'IntCompletionDAWG', build_index)
+    new_term_strings = ['тестик%d' % i for i in range(20)]
+    errors = []
+    start = threading.Event()
+
+    def reader():
+        start.wait()
+        try:
+            for _ in range(200):
+                count = term_dict.count_terms_with_prefix('тест')
+                assert 3 <= count <= 3 + len(new_term_strings)
+                assert 3 <= len(term_dict.find_ids_by_unicode_prefix('тест')) <= 3 + len(new_term_strings)
+        except Exception as e:
+            errors.append(e)
+
+    def writer():
+        start.wait()
+        try:
+            for term_str in new_term_strings:
+                TypeTerm.make(term_str)
+                term_dict.update_dawg(compact=True)
+        except Exception as e:
+            errors.append(e)
+
+    check_interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+        readers = [threading.Thread(target=reader) for _ in range(8)]
+        threads = readers + [threading.Thread(target=writer)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setcheckinterval(check_interval)
+
+    assert not errors, errors
+    # Index is built once for each DAWG at most
+    assert len(index_builds) <= len(new_term_strings) + 1
+    assert term_dict.count_terms_with_prefix('тест') == 3 + len(new_term_strings)
+    assert len(term_dict.find_ids_by_unicode_prefix('тест')) == 3 + len(new_term_strings)
+
+
+def test_dawg_checksum_in_file_manifest(pdt, monkeypatch):
+    import os
+    import shutil
+    from ok.dicts.manifest import MANIFEST_FILENAME
+
+    out_dir = 'out/_manifest_test'
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+    filename = os.path.join(out_dir, 'term_dict.dawg')
+    TypeTerm.term_dict.update_dawg()
+    TypeTerm.term_dict.to_file(filename, with_snapshot=False)
+    dawg_checksum = TypeTerm.term_dict.dawg_checksum()
+
+    assert TypeTermDict.dawg_checksum_in_file(filename) == dawg_checksum
+    assert os.path.isfile(os.path.join(out_dir, MANIFEST_FILENAME))
+
+    # Checksum is not calculated again while file is unchanged
+    def fail_checksum(_):
+        raise AssertionError('Checksum must be taken from manifest')
+    monkeypatch.setattr(TypeTermDict, '_terms_dawg_checksum', staticmethod(fail_checksum))
+    assert TypeTermDict.dawg_checksum_in_file(filename) == dawg_checksum
+    test_term_dict_saved = TypeTerm.term_dict
+    TypeTerm.term_dict = TypeTermDict()
+    try:
+        assert TypeTerm.term_dict.from_file(filename, use_snapshot=False).dawg_checksum() == dawg_checksum
+    finally:
+        monkeypatch.undo()
+        TypeTerm.term_dict = test_term_dict_saved
+
+    # Changed file is checked again
+    TypeTerm.make('абырвалг')
+    TypeTerm.term_dict.update_dawg()
+    TypeTerm.term_dict.to_file(filename, with_snapshot=False)
+    os.utime(filename, (0, 0))
+    assert TypeTermDict.dawg_checksum_in_file(filename) == TypeTerm.term_dict.dawg_checksum() != dawg_checksum
+
+
+def test_word_normal_form_cache(monkeypatch, tmpdir):
+    import ok.dicts.russian
+    from ok.dicts.russian import NormalFormCache
+    filename = str(tmpdir.join('normal_forms.db'))
+
+    cache = NormalFormCache(max_size=2)
+    monkeypatch.setattr(ok.dicts.russian, 'normal_form_cache', cache)
+    cache.enable_disk_cache(filename)
+    normal_forms = [get_word_normal_form(w) for w in ['шоколадные', 'конфеты', 'молочного']]
+    assert len(cache) == 2 and cache.misses == 3
+    assert get_word_normal_form('молочного') == normal_forms[2] and cache.hits == 1
+    cache.disable_disk_cache()
+
+    def fail_on_morphology(*_, **__):
+        raise AssertionError("Morphology must not be used")
+
+    # New process (cache) reads normal forms from disk
+    cache = NormalFormCache()
+    monkeypatch.setattr(ok.dicts.russian, 'normal_form_cache', cache)
+    monkeypatch.setattr(ok.dicts.russian, '_ensure_pymorphy', fail_on_morphology)
+    monkeypatch.setattr(ok.dicts.russian, '_ensure_word_forms_dict', fail_on_morphology)
+    cache.enable_disk_cache(filename)
+    try:
+        assert [get_word_normal_form(w) for w in ['шоколадные', 'конфеты', 'молочного']] == normal_forms
+        assert cache.hits == 3 and cache.misses == 0
+        # Flags are part of key
+        with pytest.raises(AssertionError):
+            get_word_normal_form('конфеты', strict=False)
+    finally:
+        cache.disable_disk_cache()
+
+
+def test_compiled_word_forms_dict(tmpdir):
+    import os
+    from ok.dicts.russian import _load_all_word_forms_dicts, _load_compiled_word_forms_dict, \
+        compiled_word_forms_dict_filename
+    filename = str(tmpdir.join('word_forms_dict.txt'))
+    with open(filename, 'wb') as f:
+        f.write('# test dict\nмолочный ~ noun: молоко\nшоколадка ~ same: шоколад ~ pet: шоколадище|шоколадик\n'
+                .encode('utf-8'))
+    override_filename = str(tmpdir.join('word_forms_dict_override.txt'))
+    with open(override_filename, 'wb') as f:
+        f.write('# test override\nмолочный ~ noun: молочко\n'.encode('utf-8'))
+
+    word_forms_dict = _load_compiled_word_forms_dict(filename)
+    assert os.path.isfile(compiled_word_forms_dict_filename(filename))
+    assert 'шоколад' in word_forms_dict and 'кефир' not in word_forms_dict and '#version' not in word_forms_dict
+    text_word_forms_dict = _load_all_word_forms_dicts(filename)
+    assert sorted(word_forms_dict.keys()) == sorted(text_word_forms_dict)
+    for word, articles in text_word_forms_dict.items():
+        assert word_forms_dict[word] == articles
+    assert word_forms_dict['шоколадка'][0] == ('шоколадка', [], ['шоколад'], [], ' test dict')
+    assert word_forms_dict['молочный'][0].noun_base == ['молочко']
+    assert word_forms_dict.get('шоколад')[0].is_empty()
+
+    # Compiled dict is loaded from file while text dicts are unchanged and recompiled on change
+    assert _load_compiled_word_forms_dict(filename).version == word_forms_dict.version
+    with open(override_filename, 'wb') as f:
+        f.write('# test override\nмолочный ~ noun: молоко|молочко\n'.encode('utf-8'))
+    word_forms_dict = _load_compiled_word_forms_dict(filename)
+    assert word_forms_dict['молочный'][0].noun_base == ['молоко', 'молочко']
+
+
+def test_word_normal_forms_batch(monkeypatch):
+    import ok.dicts.russian
+    from ok.dicts.russian import NormalFormCache, get_word_normal_forms_batch
+    cache = NormalFormCache()
+    monkeypatch.setattr(ok.dicts.russian, 'normal_form_cache', cache)
+    words = ['шоколадные', 'конфеты', 'молочного', 'шоколадные', 'абырвалг']
+
+    result = get_word_normal_forms_batch(words, processes=2, chunk_size=2)
+    assert len(result) == len(cache) == 4
+    assert not result['абырвалг'].is_known and result['конфеты'].is_known
+
+    # Workers results are in cache of current process
+    cache.misses = 0
+    for word in words:
+        assert result[word].normal_form == get_word_normal_form(word)
+    assert cache.misses == 0
+    assert get_word_normal_forms_batch(words, processes=1) == result
+
+
+def test_known_words_snapshot(monkeypatch, tmpdir):
+    import ok.dicts.russian
+    from ok.dicts.russian import compile_known_words_snapshot, is_known_word
+    filename = str(tmpdir.join('known_words.dawg'))
+    monkeypatch.setattr(ok.dicts.russian, 'known_words_snapshot_filename', lambda: filename)
+    monkeypatch.setattr(ok.dicts.russian, '__known_words_snapshot', None)
+    compile_known_words_snapshot(['шоколадные', 'абырвалг', 'елка'])
+
+    def fail_on_morphology(*_, **__):
+        raise AssertionError("Morphology must not be used")
+
+    monkeypatch.setattr(ok.dicts.russian, '_ensure_pymorphy', fail_on_morphology)
+    assert is_known_word('шоколадные') and is_known_word('шоколадный') and is_known_word('ёлка')
+    assert not is_known_word('абырвалг') and not is_known_word('абырвалг', use_external_word_forms_dict=False)
+    # Out of snapshot words are checked by pymorphy
+    with pytest.raises(AssertionError):
+        is_known_word('абырвалгище')
+
+
+def test_effr_parse_chunks(tmpdir):
+    from ok.dicts.russian import effr_parse
+    filename = str(tmpdir.join('effr.txt'))
+    with open(filename, 'wb') as f:
+        f.write('шоколадка\r\nУменьш. к сущ.: шоколад.\r\n\r\nмолочный\r\n'
+                '1. Соотносящийся по знач. с сущ.: молоко, связанный с ним.\r\n\r\nконфетка\r\n'
+                '1. Ласк. к сущ.: конфета.\r\n2. То же, что: карамель.\r\n'.encode('cp1251'))
+
+    effr_dict = effr_parse(filename, processes=1)
+    assert sorted(effr_dict) == ['конфетка', 'молочный', 'шоколадка']
+    assert effr_dict['шоколадка'][0].pet == ['шоколад'] and effr_dict['молочный'][0].noun_base == ['молоко']
+    assert effr_dict['конфетка'][0].pet == ['конфета'] and effr_dict['конфетка'][0].same == ['карамель']
+    # Result does not depend on chunks and processes
+    assert effr_parse(filename, processes=2, chunk_size=1) == effr_dict
+
+
+def test_ozhegov_parse_chunks(tmpdir):
+    from ok.dicts.russian import ozhegov_parse
+    filename = str(tmpdir.join('ozhegov.txt'))
+    with open(filename, 'wb') as f:
+        f.write('сочник|||||== сочень||\r\nсочник|||||Лепёшка с творогом.||\r\n'
+                'конфетка|||||== конфета||\r\nшоколадка|||||== быстро||\r\n'
+                'ватрушка|||||Круглая булочка с творогом.||\r\n'.encode('cp1251'))
+
+    ozhegov_dict = ozhegov_parse(filename, processes=1)
+    assert sorted(ozhegov_dict) == ['конфетка', 'сочник', 'шоколадка']
+    assert set(ozhegov_dict['сочник'][0].same) == {'сочень', 'сочник'}
+    # Reference is not a known noun. Same word of previous line is kept
+    assert ozhegov_dict['конфетка'][0].same == ozhegov_dict['шоколадка'][0].same == ['конфета']
+    # Result does not depend on chunks and processes
+    assert ozhegov_parse(filename, processes=2, chunk_size=1) == ozhegov_dict
+
+
+def test_normal_form_stats(monkeypatch, tmpdir):
+    import ok.dicts.russian
+    from ok.dicts.russian import NormalFormCache, NormalFormStats
+    stats = NormalFormStats(max_words=2)
+    monkeypatch.setattr(ok.dicts.russian, 'normal_form_stats', stats)
+    monkeypatch.setattr(ok.dicts.russian, 'normal_form_cache', NormalFormCache())
+
+    for word in ['шоколадные', 'шоколадная', 'шоколадные', 'конфеты', 'молочного']:
+        get_word_normal_form(word)
+    snapshot = stats.snapshot()
+    assert snapshot['calls'] == snapshot['sampled'] == 5 and snapshot['misses'] == 4
+    assert snapshot['word_calls'] == {'шоколадные': 2, 'шоколадная': 1}
+    assert len(snapshot['normal_forms']) == 2 and snapshot['dropped'] > 0
+    assert {'шоколадные', 'шоколадная'} in [set(forms) for forms in snapshot['normal_forms'].values()]
+    assert snapshot['morph_time'] > 0
+
+    filename = str(tmpdir.join('word_stats.txt'))
+    stats.dump(filename)
+    with open(filename, 'rb') as f:
+        assert f.read().decode('utf-8').startswith('# calls: 5; sampled: 5; misses: 4;')
+
+    stats.reset()
+    stats.sample_rate = 0.0
+    get_word_normal_form('ватрушка')
+    assert stats.snapshot()['calls'] == 1 and stats.snapshot()['sampled'] == 0
+
+
+def test_word_normal_form_type():
+    term = TypeTerm.make('сок')
+    assert type(term) is not unicode
+    cached = get_word_normal_form(term)
+    uncached = get_word_normal_form(term, seen=set())
+    assert type(cached) is type(uncached) is unicode and cached == uncached == 'сок'
+    assert type(get_word_normal_form(term, verbose=True)) is unicode
+
+
+def test_normal_form_stats_concurrent():
+    import sys
+    import threading
+    from ok.dicts.russian import NormalFormStats
+
+    stats = NormalFormStats(max_words=3, sample_rate=0.5)
+    words = ['шоколадные', 'конфеты', 'молочного', 'ватрушка']
+    calls_per_thread = 2000
+    start = threading.Event()
+
+    def worker(offset):
+        start.wait()
+        for i in range(calls_per_thread):
+            stats.sample(words[(i + offset) % len(words)])
+            if i % 100 == 0:
+                stats.snapshot()
+
+    check_interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(8)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setcheckinterval(check_interval)
+
+    snapshot = stats.snapshot()
+    assert snapshot['calls'] == len(threads) * calls_per_thread
+    assert 0 < snapshot['sampled'] < snapshot['calls']
+    assert sum(snapshot['word_calls'].values()) + snapshot['dropped'] == snapshot['sampled']
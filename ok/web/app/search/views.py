@@ -16,7 +16,8 @@ mod = Blueprint('search', __name__, url_prefix='/search')
 @cache.cached(key_prefix='_get_term_dict')
 def get_term_dict():
     """@rtype: TypeTermDict"""
-    term_dict = TypeTerm.term_dict.from_file(data_config.term_dict, verbose=True, skip_word_forms_validation=True)
+    term_dict = TypeTerm.term_dict.from_file(data_config.term_dict, verbose=True, skip_word_forms_validation=True,
+                                             lazy=True)
     term_dict.print_stats()
     return term_dict
 
@@ -71,3 +72,13 @@ def product_summary_json():
     q = request.args.get('q')
     results = [{'pfqn': q}]
     return jsonify({'results': results})
+
+
+@mod.route("/stats/morphology/json")
+def morphology_stats_json():
+    from ok.dicts.russian import normal_form_stats
+    stats = normal_form_stats.snapshot()
+    if not request.args.get('words'):
+        # Word lists may be large. Return them on demand only
+        del stats['normal_forms'], stats['word_calls']
+    return jsonify(stats)